@@ -6,6 +6,8 @@ from torchvision import transforms
 import argparse
 from torch import nn
 from utils import supervisor, tools, default_args
+from utils.activation_cache import ActivationCache, dataset_signature
+from other_defenses_tool_box.TED_utils import state_sha256
 import config
 from matplotlib import pyplot as plt
 from sklearn import svm
@@ -61,6 +63,9 @@ parser.add_argument('-seed', type=int, required=False, default=default_args.seed
 # New argument for controlling the fraction of data to visualize
 parser.add_argument('-data_ratio', type=float, default=1.0,
                     help='Ratio of the dataset to use for visualization (0 < data_ratio <= 1.0)')
+parser.add_argument('-cache_dir', type=str, default=None,
+                    help='shared on-disk activation cache, reused across runs of the same checkpoint and split')
+parser.add_argument('-cache_mb', type=float, default=None, help='size bound of -cache_dir (LRU eviction)')
 
 args = parser.parse_args()
 
@@ -68,6 +73,9 @@ args = parser.parse_args()
 os.environ["CUDA_VISIBLE_DEVICES"] = "%s" % args.devices
 tools.setup_seed(args.seed)
 
+# Optional shared activation cache
+activation_cache = ActivationCache(args.cache_dir, max_mb=args.cache_mb) if args.cache_dir else None
+
 # Determine target class
 if args.target_class == -1:
     target_class = config.target_class[args.dataset]
@@ -100,12 +108,12 @@ arch = supervisor.get_arch(args)
 
 # Set up poisoned dataset
 poison_set_dir = supervisor.get_poison_set_dir(args)
-if os.path.exists(os.path.join(poison_set_dir, 'data')):
-    # old version directory
-    poisoned_set_img_dir = os.path.join(poison_set_dir, 'data')
-elif os.path.exists(os.path.join(poison_set_dir, 'imgs')):
+if os.path.exists(os.path.join(poison_set_dir, 'imgs')):
     # new version directory
     poisoned_set_img_dir = os.path.join(poison_set_dir, 'imgs')
+elif os.path.exists(os.path.join(poison_set_dir, 'data')):
+    # old version directory
+    poisoned_set_img_dir = os.path.join(poison_set_dir, 'data')
 else:
     raise FileNotFoundError("Poisoned data directory not found.")
 
@@ -199,9 +207,12 @@ for vid, path in enumerate(model_list):
 
     # Dictionary to store outputs for each layer
     layer_outputs = {}
+    hook_names = []
 
     # Hook function to capture layer outputs
     def get_activation(name):
+        hook_names.append(name)
+
         def hook(model, input, output):
             if name not in layer_outputs:
                 layer_outputs[name] = []
@@ -223,12 +234,28 @@ for vid, path in enumerate(model_list):
     except AttributeError as e:
         raise AttributeError(f"Error registering hooks: {e}. Ensure the model architecture matches the expected layers.")
 
-    # Processing poisoned data to capture features
-    for batch_idx, (data, target) in enumerate(tqdm(poisoned_set_loader, desc="Processing Poisoned Data")):
-        data, target = data.cuda(), target.cuda()
-        targets.append(target.cpu())
-        with torch.no_grad():
-            _ = model(data)
+    # Reuse the activations of an earlier run of this checkpoint on this split (-cache_dir)
+    cached = None
+    if activation_cache is not None:
+        cache_components = {'checkpoint_sha256': state_sha256(model), 'dataset': args.dataset,
+                            'samples': dataset_signature(poisoned_set), 'layers': hook_names, 'reduction': 'none'}
+        cached = activation_cache.load(cache_components)
+    if cached is not None:
+        targets.append(cached['targets'])
+        for name in hook_names:
+            if 'layer.' + name in cached:
+                layer_outputs[name] = [cached['layer.' + name]]
+    else:
+        # Processing poisoned data to capture features
+        for batch_idx, (data, target) in enumerate(tqdm(poisoned_set_loader, desc="Processing Poisoned Data")):
+            data, target = data.cuda(), target.cuda()
+            targets.append(target.cpu())
+            with torch.no_grad():
+                _ = model(data)
+        if activation_cache is not None:
+            arrays = {'layer.' + name: torch.cat(outputs, dim=0) for name, outputs in layer_outputs.items()}
+            arrays['targets'] = torch.cat(targets, dim=0)
+            activation_cache.store(cache_components, arrays)
 
     targets = torch.cat(targets, dim=0)
     ids = torch.arange(len(poisoned_set))
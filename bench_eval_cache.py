@@ -0,0 +1,50 @@
+"""
+End-to-end speedup of the in-memory evaluation splits (utils/eval_cache.py): run other_defense.py for each
+defense with the cache disabled (-eval_cache_mb 0) and enabled, and compare the reported elapsed time.
+Arguments not listed below are passed through to other_defense.py (without -log, its output is parsed here).
+
+    python bench_eval_cache.py -dataset cifar10 -poison_type badnet -poison_rate 0.003
+    python bench_eval_cache.py -defenses STRIP ScaleUp CD Frequency -repeats 3 -dataset gtsrb -poison_type blend \
+        -poison_rate 0.003
+"""
+import argparse
+import re
+import subprocess
+import sys
+
+import numpy as np
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-defenses', type=str, nargs='+', required=False, default=['STRIP', 'ScaleUp'])
+parser.add_argument('-repeats', type=int, required=False, default=1)
+parser.add_argument('-eval_cache_mb', type=float, required=False, default=1024,
+                    help='cache size of the cached runs')
+
+
+def elapsed(defense, eval_cache_mb, passthrough):
+    command = [sys.executable, 'other_defense.py', '-defense', defense, '-eval_cache_mb', str(eval_cache_mb)]
+    output = subprocess.run(command + passthrough, capture_output=True, text=True, check=True).stdout
+    seconds = re.findall(r'Elapsed time: ([0-9.]+)s', output)
+    if not seconds:
+        raise RuntimeError('No elapsed time in the output of %s' % ' '.join(command + passthrough))
+    cache_lines = [line for line in output.splitlines() if line.startswith('[Eval cache]')]
+    return float(seconds[-1]), cache_lines
+
+
+if __name__ == '__main__':
+    args, passthrough = parser.parse_known_args()
+    results = []
+    for defense in args.defenses:
+        uncached = [elapsed(defense, 0, passthrough)[0] for _ in range(args.repeats)]
+        cached, cache_lines = [], []
+        for _ in range(args.repeats):
+            seconds, cache_lines = elapsed(defense, args.eval_cache_mb, passthrough)
+            cached.append(seconds)
+        results.append((defense, np.median(uncached), np.median(cached)))
+        for line in cache_lines:
+            print('%s %s' % (defense, line))
+
+    print('[Bench] median end-to-end time over %d run(s): %s' % (args.repeats, ' '.join(passthrough)))
+    print('  %-10s %12s %12s %8s' % ('defense', 'DataLoader', 'eval cache', 'speedup'))
+    for defense, uncached, cached in results:
+        print('  %-10s %11.2fs %11.2fs %7.2fx' % (defense, uncached, cached, uncached / cached))
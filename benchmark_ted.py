@@ -0,0 +1,875 @@
+"""
+Micro-benchmarks for the TED / TEDPLUS building blocks.
+
+Synthetic benchmarks (no dataset or checkpoint needed):
+    python benchmark_ted.py -bench check
+    python benchmark_ted.py -bench rank -num_defense 1000 -num_queries 100 -dim 4096
+    python benchmark_ted.py -bench capture -num_defense 1000 -storage cpu
+    python benchmark_ted.py -bench index -num_defense 20000 -num_classes 200 -nlist 128 -nprobes 4,8,16
+    python benchmark_ted.py -bench workers -device cpu -num_layers 16 -workers 1,2,4,8,16
+    python benchmark_ted.py -bench incremental -num_defense 2000 -dim 4096 -add_sizes 1,10,100
+
+Detector benchmarks (same data / checkpoint layout as other_defense.py):
+    python benchmark_ted.py -bench reduction -dataset cifar10 -poison_type badnet -poison_rate 0.003 \
+        -method gaussian -ks 16,64,256
+    python benchmark_ted.py -bench layers -dataset cifar10 -poison_types badnet,blend,WaNet -budget_mflops 50
+    python benchmark_ted.py -bench construction -dataset cifar10 -poison_type badnet -poison_rate 0.003
+    python benchmark_ted.py -bench generation -dataset cifar10 -poison_type TaCT -poison_rate 0.003 -cover_rate 0.003
+    python benchmark_ted.py -bench score -dataset cifar10 -poison_type badnet -poison_rate 0.003 \
+        -batch_sizes 1,16,64,256
+    python benchmark_ted.py -bench precision -datasets cifar10,gtsrb -poison_type badnet -poison_rate 0.003 \
+        -precisions float16,bfloat16,int8,int8:channel
+    python benchmark_ted.py -bench headless -dataset cifar10 -poison_type badnet -poison_rate 0.003
+    python benchmark_ted.py -bench bootstrap -dataset cifar10 -poison_type badnet -poison_rate 0.003 -replicates 20
+"""
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+from scipy.stats import kendalltau
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.utils.data as data
+from torchmetrics.functional import pairwise_euclidean_distance
+
+import config
+from utils import default_args
+from other_defenses_tool_box.TED_utils import first_same_label_rank, allocate_activation_buffer, build_rank_index, \
+    rank_layers, DefenseGeometry, defense_group_ranks, query_group_ranks, distance_matrix, RankResampler
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-bench', type=str, required=True, choices=['check', 'rank', 'capture', 'index', 'reduction', 'layers', 'construction', 'generation', 'score', 'precision', 'workers', 'headless', 'bootstrap', 'incremental'])
+parser.add_argument('-num_defense', type=int, default=1000)
+parser.add_argument('-num_queries', type=int, default=100)
+parser.add_argument('-num_classes', type=int, default=10)
+parser.add_argument('-dim', type=int, default=4096)
+parser.add_argument('-batch_size', type=int, default=50)
+parser.add_argument('-storage', type=str, default='device', choices=['device', 'cpu', 'disk'])
+parser.add_argument('-repeat', type=int, default=3)
+parser.add_argument('-device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument('-seed', type=int, default=0)
+parser.add_argument('-nlist', type=int, default=64)
+parser.add_argument('-nprobes', type=str, default='4,8,16')
+parser.add_argument('-num_layers', type=int, default=16)
+parser.add_argument('-workers', type=str, default='1,2,4,8,16')
+parser.add_argument('-add_sizes', type=str, default='1,10,100')
+# detector benchmarks
+parser.add_argument('-dataset', type=str, required=False,
+                    default=default_args.parser_default['dataset'],
+                    choices=default_args.parser_choices['dataset'])
+parser.add_argument('-poison_type', type=str, required=False,
+                    choices=default_args.parser_choices['poison_type'],
+                    default=default_args.parser_default['poison_type'])
+parser.add_argument('-poison_rate', type=float, required=False,
+                    choices=default_args.parser_choices['poison_rate'],
+                    default=default_args.parser_default['poison_rate'])
+parser.add_argument('-cover_rate', type=float, required=False,
+                    choices=default_args.parser_choices['cover_rate'],
+                    default=default_args.parser_default['cover_rate'])
+parser.add_argument('-alpha', type=float, required=False,
+                    default=default_args.parser_default['alpha'])
+parser.add_argument('-test_alpha', type=float, required=False, default=None)
+parser.add_argument('-trigger', type=str, required=False, default=None)
+parser.add_argument('-no_aug', default=False, action='store_true')
+parser.add_argument('-no_normalize', default=False, action='store_true')
+parser.add_argument('-model', type=str, required=False, default=None)
+parser.add_argument('-model_path', required=False, default=None)
+parser.add_argument('-validation_per_class', type=int, required=False, default=20)
+parser.add_argument('-num_test_samples', type=int, required=False, default=50)
+parser.add_argument('-class_ratio', type=float, required=False, default=0)
+parser.add_argument('-method', type=str, default='gaussian', choices=['avgpool', 'gaussian', 'sparse', 'pca'])
+parser.add_argument('-ks', type=str, default='16,64,256')
+parser.add_argument('-poison_types', type=str, default='badnet,blend,WaNet')
+parser.add_argument('-budget_mflops', type=float, default=None)
+parser.add_argument('-budget_mb', type=float, default=None)
+parser.add_argument('-artifact', type=str, default=None)
+parser.add_argument('-batch_sizes', type=str, default='1,16,64,256')
+parser.add_argument('-score_iters', type=int, default=50)
+parser.add_argument('-datasets', type=str, default='cifar10,gtsrb')
+parser.add_argument('-precisions', type=str, default='float16,bfloat16,int8,int8:channel')
+parser.add_argument('-replicates', type=int, default=20)
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def timed(fn, repeat):
+    """Best-of-`repeat` wall time of `fn()`, returning (seconds, last result)."""
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        synchronize()
+        start = time.perf_counter()
+        result = fn()
+        synchronize()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_isolated(fn, *fn_args):
+    """Run `fn` in a fresh process so that its peak RSS is not polluted by earlier runs."""
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(fn, fn_args)
+
+
+def synthetic_activations(num_samples, dim, num_classes, device, generator):
+    """Class-clustered Gaussian activations so that same-label neighbours are not trivially first."""
+    centers = torch.randn(num_classes, dim, generator=generator)
+    labels = torch.randint(num_classes, (num_samples,), generator=generator)
+    activations = centers[labels] + 2.0 * torch.randn(num_samples, dim, generator=generator)
+    return activations.to(device), labels.to(device)
+
+
+# ------------------------------
+# check: rank engine, indices and incremental geometry against a brute-force sort, CPU only
+# ------------------------------
+def brute_force_rank(queries, query_labels, references, reference_labels, self_indices=None):
+    """
+    Position of the first same-label reference in the float64 `torch.cdist` row sorted with `torch.sort`,
+    skipping `self_indices` (-1 for none). Returns (nn_dist, rank, nn_index) like first_same_label_rank.
+    """
+    dis = torch.cdist(queries.double(), references.double())
+    rows = torch.arange(len(queries))
+    if self_indices is not None:
+        valid = self_indices >= 0
+        dis[rows[valid], self_indices[valid]] = float('inf')
+    sorted_dis, order = torch.sort(dis, dim=1)
+    same_label = (reference_labels[order] == query_labels.unsqueeze(1)) & torch.isfinite(sorted_dis)
+    rank = same_label.int().argmax(dim=1)
+    found = same_label.any(dim=1)
+    nn_index = torch.where(found, order[rows, rank], torch.full_like(rank, -1))
+    nn_dist = torch.where(found, sorted_dis[rows, rank], torch.full_like(sorted_dis[:, 0], float('inf')))
+    return nn_dist.float(), rank, nn_index
+
+
+def same_ranks(result, expected):
+    (nn_dist, rank, nn_index), (expected_dist, expected_rank, expected_index) = result, expected
+    found = expected_index >= 0
+    return torch.equal(nn_index, expected_index) and torch.equal(rank[found], expected_rank[found]) \
+        and torch.allclose(nn_dist[found], expected_dist[found], rtol=1e-4)
+
+
+def bench_check(args):
+    """
+    Small CPU-only equivalence checks on synthetic activations, exiting with status 1 on any mismatch:
+    first_same_label_rank and the 'exact' / 'class' / fully probed 'ivf' rank indices (with and without
+    self exclusion) against a brute-force sort, and DefenseGeometry.add against the brute-force defense ranks.
+    """
+    generator = torch.Generator().manual_seed(args.seed)
+    num_defense, num_queries, num_added, dim, num_classes, k = 300, 60, 40, 32, 5, 10
+    references, reference_labels = synthetic_activations(num_defense, dim, num_classes, 'cpu', generator)
+    queries, query_labels = synthetic_activations(num_queries, dim, num_classes, 'cpu', generator)
+    self_indices = torch.randperm(num_defense, generator=generator)[:num_queries]
+    self_indices[::4] = -1
+    own = references[self_indices.clamp(min=0)]
+    own[self_indices < 0] = queries[self_indices < 0]
+    own_labels = torch.where(self_indices >= 0, reference_labels[self_indices.clamp(min=0)], query_labels)
+
+    expected = brute_force_rank(queries, query_labels, references, reference_labels)
+    expected_self = brute_force_rank(own, own_labels, references, reference_labels, self_indices)
+    checks = [
+        ('first_same_label_rank', same_ranks(
+            first_same_label_rank(queries, query_labels, references, reference_labels, chunk_size=16), expected)),
+        ('first_same_label_rank self excluded', same_ranks(
+            first_same_label_rank(own, own_labels, references, reference_labels, self_indices=self_indices,
+                                  chunk_size=16), expected_self)),
+    ]
+    for kind, kwargs in [('exact', {}), ('class', {}), ('ivf', {'nlist': 8, 'nprobe': 8, 'seed': args.seed})]:
+        index = build_rank_index(kind, references, reference_labels, chunk_size=16, device='cpu', **kwargs)
+        checks.append((f'RankIndex {kind}', same_ranks(index.query(queries, query_labels), expected)))
+        checks.append((f'RankIndex {kind} self excluded',
+                       same_ranks(index.query(own, own_labels, self_indices=self_indices), expected_self)))
+
+    added, added_labels = synthetic_activations(num_added, dim, num_classes, 'cpu', generator)
+    all_references = torch.cat([references, added])
+    all_labels = torch.cat([reference_labels, added_labels])
+    geometry = DefenseGeometry(references, reference_labels, k, chunk_size=16, device='cpu')
+    geometry.add(added, added_labels)
+    expected_defense = brute_force_rank(all_references, all_labels, all_references, all_labels,
+                                        torch.arange(num_defense + num_added))
+    dis = torch.cdist(all_references.double(), all_references.double())
+    dis.fill_diagonal_(float('inf'))
+    dis[all_labels.unsqueeze(1) != all_labels.unsqueeze(0)] = float('inf')
+    expected_thresholds = DefenseGeometry.compute_thresholds(torch.topk(dis, k, dim=1, largest=False)[0].float())
+    checks.append(('DefenseGeometry.add ranks', same_ranks((geometry.nn_dist, geometry.rank, geometry.nn_index),
+                                                           expected_defense)))
+    checks.append(('DefenseGeometry.add thresholds', torch.allclose(geometry.thresholds, expected_thresholds,
+                                                                    rtol=1e-4)))
+    checks.append(('DefenseGeometry.add query', same_ranks(geometry.query(queries, query_labels),
+                                                           brute_force_rank(queries, query_labels, all_references,
+                                                                            all_labels))))
+
+    print(f"[check] defense={num_defense}+{num_added} queries={num_queries} dim={dim} classes={num_classes} cpu")
+    for name, passed in checks:
+        print(f"  {name:<40} {'ok' if passed else 'MISMATCH'}")
+    if not all(passed for _, passed in checks):
+        sys.exit(1)
+
+
+# ------------------------------
+# rank: batched rank engine vs. the get_dis_sort loop
+# ------------------------------
+def legacy_rank(queries, query_labels, references, reference_labels, device):
+    """The per-sample `get_dis_sort` loop TED used before the batched rank engine."""
+    ranks = []
+    for item, label in zip(queries, query_labels):
+        new_dis = pairwise_euclidean_distance(item.reshape(1, -1).to(device), references.to(device))
+        _, sorted_indices = torch.sort(new_dis.squeeze(0))
+        sorted_indices = sorted_indices.cpu()
+        for i, idx in enumerate(sorted_indices):
+            if reference_labels[idx] == label:
+                ranks.append(i)
+                break
+    return torch.tensor(ranks)
+
+
+def bench_rank(args):
+    generator = torch.Generator().manual_seed(args.seed)
+    references, reference_labels = synthetic_activations(args.num_defense, args.dim, args.num_classes,
+                                                         args.device, generator)
+    queries, query_labels = synthetic_activations(args.num_queries, args.dim, args.num_classes,
+                                                  args.device, generator)
+
+    t_legacy, legacy = timed(lambda: legacy_rank(queries, query_labels, references, reference_labels.cpu(),
+                                                 args.device), args.repeat)
+    t_engine, (_, rank, _) = timed(lambda: first_same_label_rank(queries, query_labels, references,
+                                                                 reference_labels, device=args.device), args.repeat)
+
+    agreement = (legacy == rank).float().mean().item() * 100
+    print(f"[rank] defense={args.num_defense} queries={args.num_queries} dim={args.dim} device={args.device}")
+    print(f"  legacy get_dis_sort loop : {t_legacy * 1000:.1f} ms")
+    print(f"  batched rank engine      : {t_engine * 1000:.1f} ms  ({t_legacy / t_engine:.1f}x)")
+    print(f"  identical ranks          : {agreement:.2f}%")
+
+
+# ------------------------------
+# capture: preallocated activation buffers vs. list append + torch.stack
+# ------------------------------
+def hooked_resnet18(device, num_classes):
+    """A ResNet18 hooked the same way TED hooks its models (non-1x1 Conv2d, ReLU, Linear)."""
+    from utils.resnet import ResNet18
+    model = ResNet18(num_classes=num_classes).to(device).eval()
+    activations = {}
+
+    def get_activation(name):
+        def hook(module, input, output):
+            activations[name] = output.detach()
+        return hook
+
+    index = 0
+    for child in model.modules():
+        if (isinstance(child, nn.Conv2d) and child.kernel_size != (1, 1)) or isinstance(child, (nn.ReLU, nn.Linear)):
+            child.register_forward_hook(get_activation(type(child).__name__ + '_' + str(index)))
+            index += 1
+    return model, activations
+
+
+def capture_worker(mode, args):
+    torch.manual_seed(args.seed)
+    model, activations = hooked_resnet18(args.device, args.num_classes)
+    dataset = data.TensorDataset(torch.randn(args.num_defense, 3, 32, 32),
+                                 torch.randint(args.num_classes, (args.num_defense,)))
+    loader = data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False)
+    rss_before = peak_rss_mb()
+
+    synchronize()
+    start = time.perf_counter()
+    with torch.no_grad():
+        if mode == 'legacy':
+            container = {}
+            for images, _ in loader:
+                model(images.to(args.device))
+                break
+            for key in activations:
+                container[key] = []
+            activations.clear()
+            for images, _ in loader:
+                model(images.to(args.device))
+                for key in activations:
+                    for h in activations[key].view(images.shape[0], -1):
+                        container[key].append(h.to(args.device))
+                activations.clear()
+            for key in container:
+                container[key] = torch.stack(container[key])
+        else:
+            container, offset = {}, 0
+            for images, _ in loader:
+                model(images.to(args.device))
+                batch_size = images.shape[0]
+                if not container:
+                    for key in activations:
+                        container[key] = allocate_activation_buffer(
+                            args.num_defense, activations[key][0].numel(), storage=args.storage,
+                            device=args.device, path=f'/tmp/benchmark_ted_capture/{key}.npy'
+                        )
+                for key in activations:
+                    container[key][offset:offset + batch_size].copy_(activations[key].reshape(batch_size, -1))
+                offset += batch_size
+                activations.clear()
+    synchronize()
+    elapsed = time.perf_counter() - start
+
+    cuda_peak = torch.cuda.max_memory_allocated() / 2 ** 20 if torch.cuda.is_available() else 0.0
+    return elapsed, peak_rss_mb() - rss_before, cuda_peak
+
+
+def bench_capture(args):
+    print(f"[capture] samples={args.num_defense} batch={args.batch_size} device={args.device} storage={args.storage}")
+    for mode in ['legacy', 'preallocated']:
+        elapsed, rss_growth, cuda_peak = run_isolated(capture_worker, mode, args)
+        print(f"  {mode:<13}: {elapsed:.2f}s, peak RSS growth {rss_growth:.0f} MB, peak CUDA {cuda_peak:.0f} MB")
+
+
+# ------------------------------
+# index: recall vs. speed of the rank indices against the exact path
+# ------------------------------
+def bench_index(args):
+    generator = torch.Generator().manual_seed(args.seed)
+    references, reference_labels = synthetic_activations(args.num_defense, args.dim, args.num_classes,
+                                                         args.device, generator)
+    queries, query_labels = synthetic_activations(args.num_queries, args.dim, args.num_classes,
+                                                  args.device, generator)
+
+    configs = [('exact', {}), ('class', {})]
+    configs += [('ivf', {'nlist': args.nlist, 'nprobe': int(nprobe)}) for nprobe in args.nprobes.split(',')]
+
+    print(f"[index] defense={args.num_defense} queries={args.num_queries} dim={args.dim} "
+          f"classes={args.num_classes} device={args.device}")
+    exact = None
+    for kind, kwargs in configs:
+        t_build, index = timed(lambda: build_rank_index(kind, references, reference_labels, device=args.device,
+                                                        seed=args.seed, **kwargs), 1)
+        t_query, (nn_dist, rank, nn_index) = timed(lambda: index.query(queries, query_labels), args.repeat)
+        if exact is None:
+            exact = (rank, nn_index)
+        neighbour_recall = (nn_index == exact[1]).float().mean().item() * 100
+        rank_match = (rank == exact[0]).float().mean().item() * 100
+        rank_error = (rank - exact[0]).abs().float().mean().item()
+        name = kind + ''.join(f' {key}={value}' for key, value in kwargs.items())
+        print(f"  {name:<24} build {t_build * 1000:8.1f} ms  query {t_query * 1000:8.1f} ms  "
+              f"neighbour recall {neighbour_recall:6.2f}%  exact ranks {rank_match:6.2f}%  "
+              f"mean |rank error| {rank_error:.2f}")
+
+
+# ------------------------------
+# workers: per-layer ranks sharded over a process pool
+# ------------------------------
+def bench_workers(args):
+    """Wall time of rank_layers over -num_layers synthetic layers for every -workers count, on the CPU."""
+    generator = torch.Generator().manual_seed(args.seed)
+    layers = []
+    for _ in range(args.num_layers):
+        references, reference_labels = synthetic_activations(args.num_defense, args.dim, args.num_classes,
+                                                             'cpu', generator)
+        queries, query_labels = synthetic_activations(args.num_queries, args.dim, args.num_classes, 'cpu', generator)
+        layers.append((references, reference_labels, queries, query_labels))
+
+    def tasks():
+        return [{'defense_activations': references, 'defense_preds': reference_labels,
+                 'labels': list(range(args.num_classes)), 'queries': {'Query': (queries, query_labels)},
+                 'k': 10, 'saturation': args.num_defense - 1, 'index': 'exact', 'index_kwargs': {},
+                 'chunk_size': 256} for references, reference_labels, queries, query_labels in layers]
+
+    print(f"[workers] layers={args.num_layers} defense={args.num_defense} queries={args.num_queries} "
+          f"dim={args.dim} cpus={os.cpu_count()}")
+    baseline, reference = None, None
+    for workers in [int(workers) for workers in args.workers.split(',')]:
+        elapsed, results = timed(lambda: rank_layers(tasks(), workers=workers), args.repeat)
+        ranks = [np.concatenate([r[1][label][0].numpy() for label in sorted(r[1])] + [r[2]['Query'][0].numpy()])
+                 for r in results]
+        if baseline is None:
+            baseline, reference = elapsed, ranks
+        identical = all(np.array_equal(a, b) for a, b in zip(ranks, reference))
+        print(f"  {workers:3d} workers  {elapsed:8.2f} s  speedup {baseline / elapsed:5.2f}x  "
+              f"ranks {'identical' if identical else 'DIFFER'}")
+
+
+def bench_incremental(args):
+    """
+    DefenseGeometry.add of k samples against a rebuild on all the samples, for every -add_sizes k: wall time,
+    and whether thresholds, neighbours, ranks and saturated defense ranks agree.
+    """
+    generator = torch.Generator().manual_seed(args.seed)
+    max_add = max(int(k) for k in args.add_sizes.split(','))
+    activations, labels = synthetic_activations(args.num_defense + max_add, args.dim, args.num_classes,
+                                                args.device, generator)
+    print(f"[incremental] defense={args.num_defense} dim={args.dim} classes={args.num_classes} device={args.device}")
+    for k in [int(k) for k in args.add_sizes.split(',')]:
+        total = args.num_defense + k
+        add_time, rebuild_time = float('inf'), float('inf')
+        for _ in range(args.repeat):
+            geometry = DefenseGeometry(activations[:args.num_defense], labels[:args.num_defense], 10)
+            synchronize()
+            start = time.perf_counter()
+            changed = geometry.add(activations[args.num_defense:total], labels[args.num_defense:total])
+            synchronize()
+            add_time = min(add_time, time.perf_counter() - start)
+            start = time.perf_counter()
+            rebuilt = DefenseGeometry(activations[:total], labels[:total], 10)
+            synchronize()
+            rebuild_time = min(rebuild_time, time.perf_counter() - start)
+        same = all(torch.allclose(getattr(geometry, key), getattr(rebuilt, key), rtol=1e-4)
+                   for key in ['knn_dist', 'nn_dist', 'thresholds'])
+        same = same and torch.equal(geometry.rank, rebuilt.rank) and torch.equal(geometry.nn_index, rebuilt.nn_index)
+        same = same and all(torch.equal(defense_group_ranks(geometry, labels[:total], label, 999)[0],
+                                        defense_group_ranks(rebuilt, labels[:total], label, 999)[0])
+                            for label in range(args.num_classes))
+        print(f"  k={k:<5} add {add_time * 1000:9.2f} ms  rebuild {rebuild_time * 1000:9.2f} ms  "
+              f"speedup {rebuild_time / add_time:6.1f}x  {len(changed)} neighbours changed  "
+              f"{'identical' if same else 'DIFFER'}")
+
+
+# ------------------------------
+# detector benchmarks
+# ------------------------------
+def detector_args(args, **overrides):
+    """
+    Copy of `args` completed with the dataset-dependent fields other_defense.py sets for TEDPLUS.
+    """
+    det = argparse.Namespace(**vars(args))
+    det.defense = 'TEDPLUS'
+    det.noisy_test = False
+    if det.dataset in ['cifar10', 'gtsrb']:
+        det.input_height, det.input_width, det.input_channel = 32, 32, 3
+    elif det.dataset == 'mnist':
+        det.input_height, det.input_width, det.input_channel = 28, 28, 1
+    elif det.dataset in ['imagenet', 'pubfig', 'imagenette', 'tinyimagenet200']:
+        det.input_height, det.input_width, det.input_channel = 64, 64, 3
+    elif det.dataset == 'imagenet200':
+        det.input_height, det.input_width, det.input_channel = 224, 224, 3
+    det.class_number = {'cifar10': 10, 'gtsrb': 43, 'mnist': 10, 'imagenet': 100, 'pubfig': 83,
+                        'imagenette': 10, 'imagenet200': 200, 'tinyimagenet200': 200}.get(det.dataset, 10)
+    det.data_root = './data/'
+    det.bs = 50
+    det.num_workers = 2
+    for key, value in overrides.items():
+        setattr(det, key, value)
+    if det.poison_type != 'SSDT' and det.trigger is None:
+        det.trigger = config.trigger_default[det.dataset][det.poison_type]
+    return det
+
+
+def run_detector(det_args):
+    """Build TEDPLUS with the module-level seeds reset, so every configuration sees the same splits."""
+    from other_defenses_tool_box.TEDPLUS import TEDPLUS
+    random.seed(42)
+    np.random.seed(42)
+    torch.manual_seed(42)
+    defense = TEDPLUS(det_args)
+    start = time.perf_counter()
+    results = defense.test()
+    results['wall_time'] = time.perf_counter() - start
+    results['num_layers'] = len(defense.layers)
+    return results
+
+
+def detector_worker(det_args):
+    """run_detector in a spawned process, adding its peak RSS and peak CUDA memory."""
+    results = run_detector(det_args)
+    results['peak_rss_mb'] = peak_rss_mb()
+    results['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2 ** 20 if torch.cuda.is_available() else 0.0
+    return results
+
+
+def print_result_row(name, results):
+    print(f"  {name:<20} AUC {results['AUC']:.4f}  TPR {results['TPR'] * 100:6.2f}%  "
+          f"FPR {results['FPR'] * 100:6.2f}%  inference {results['inference_time']:.2f}s  "
+          f"wall {results['wall_time']:.2f}s")
+
+
+def bench_layers(args):
+    """Full vs. selected hook layers per attack: AUC, detection latency and peak memory."""
+    if args.budget_mflops is None and args.budget_mb is None:
+        raise ValueError('-bench layers needs -budget_mflops and/or -budget_mb')
+    for poison_type in args.poison_types.split(','):
+        rows = []
+        for name, overrides in [('full', {}),
+                                ('selected', {'ted_layer_budget_mflops': args.budget_mflops,
+                                              'ted_layer_budget_mb': args.budget_mb})]:
+            det_args = detector_args(args, poison_type=poison_type, trigger=None, **overrides)
+            rows.append((name, run_isolated(detector_worker, det_args)))
+        print(f"[layers] {args.dataset} / {poison_type}")
+        for name, results in rows:
+            print(f"  {name:<9} {results['num_layers']:3d} layers  AUC {results['AUC']:.4f}  "
+                  f"TPR {results['TPR'] * 100:6.2f}%  FPR {results['FPR'] * 100:6.2f}%  "
+                  f"inference {results['inference_time']:.2f}s  wall {results['wall_time']:.2f}s  "
+                  f"peak RSS {results['peak_rss_mb']:.0f} MB  peak CUDA {results['peak_cuda_mb']:.0f} MB")
+
+
+def bench_reduction(args):
+    rows = [('none', run_detector(detector_args(args, ted_reduction='none')))]
+    for k in [int(k) for k in args.ks.split(',')]:
+        rows.append((f'{args.method} k={k}',
+                     run_detector(detector_args(args, ted_reduction=args.method, ted_reduction_dim=k))))
+    print(f"[reduction] {args.dataset} / {args.poison_type}")
+    for name, results in rows:
+        print_result_row(name, results)
+
+
+def count_reads(dataset):
+    """
+    Make `dataset` count the samples it decodes (`dataset.reads`) and their size (`dataset.read_bytes`).
+    The class is swapped for a subclass, so isinstance checks and label lookups keep working.
+    """
+    base = type(dataset)
+
+    def __getitem__(self, idx):
+        img, label = base.__getitem__(self, idx)
+        self.reads += 1
+        self.read_bytes += img.numel() * img.element_size() if torch.is_tensor(img) else 0
+        return img, label
+
+    dataset.__class__ = type(base.__name__, (base,), {'__getitem__': __getitem__})
+    dataset.reads, dataset.read_bytes = 0, 0
+    return dataset
+
+
+def legacy_build_defense_set(defense):
+    """The TEDPLUS defense-set construction before the inference cache: four passes over the data."""
+    defense_set = defense.defense_subset
+    underlying_dataset, subset_indices = defense_set.dataset, defense_set.indices
+
+    all_labels = []
+    for _, labels in data.DataLoader(defense_set, batch_size=50, shuffle=True, num_workers=0):
+        all_labels.extend(labels.tolist())
+    label_to_indices = defaultdict(list)
+    for idx in subset_indices:
+        _, label = underlying_dataset[idx]
+        label_to_indices[label].append(idx)
+
+    correct_indices_per_class = defaultdict(list)
+    current_idx = 0
+    with torch.no_grad():
+        for inputs, labels in data.DataLoader(defense_set, batch_size=50, shuffle=False, num_workers=0):
+            preds = torch.argmax(defense.model(inputs.to(defense.device)), dim=1).cpu()
+            for i in range(len(labels)):
+                if preds[i] == labels[i]:
+                    correct_indices_per_class[labels[i].item()].append(subset_indices[current_idx])
+                current_idx += 1
+
+    defense_indices_final = []
+    for label in range(defense.num_classes - defense.NUM_MISSING_CLASS):
+        correct_indices = correct_indices_per_class[label]
+        defense_indices_final.extend(np.random.choice(correct_indices, defense.SAMPLES_PER_CLASS,
+                                                      replace=len(correct_indices) < defense.SAMPLES_PER_CLASS))
+
+    preds, ori_labels = [], []
+    with torch.no_grad():
+        for inputs, labels in data.DataLoader(data.Subset(underlying_dataset, defense_indices_final),
+                                              batch_size=50, shuffle=True, num_workers=0):
+            preds.extend(torch.argmax(defense.model(inputs.to(defense.device)), dim=1).cpu().numpy())
+            ori_labels.extend(labels.numpy())
+    benign_indices = np.array(defense_indices_final)[np.array(ori_labels) == np.array(preds)]
+    if len(benign_indices) > defense.DEFENSE_TRAIN_SIZE:
+        benign_indices = np.random.choice(benign_indices, defense.DEFENSE_TRAIN_SIZE, replace=False)
+    return benign_indices
+
+
+def bench_construction(args):
+    """Time and images decoded by the legacy and the cached defense-set construction, on the same split."""
+    from other_defenses_tool_box.TEDPLUS import TEDPLUS
+    defense = TEDPLUS(detector_args(args))
+    dataset = count_reads(defense.defense_subset.dataset)
+
+    rows = []
+    for name, build in [('legacy', lambda: legacy_build_defense_set(defense)),
+                        ('cached', lambda: (defense.build_defense_set(), defense.defense_loader.dataset.indices)[1])]:
+        np.random.seed(42)
+        dataset.reads, dataset.read_bytes = 0, 0
+        t, indices = timed(build, 1)
+        rows.append((name, t, dataset.reads, dataset.read_bytes, sorted(np.asarray(indices).tolist())))
+
+    print(f"[construction] {args.dataset} / {args.poison_type}, defense split of {len(defense.defense_subset)} samples")
+    for name, t, reads, read_bytes, _ in rows:
+        print(f"  {name:<8} {t:8.2f} s  {reads:8d} images decoded  {read_bytes / 2 ** 20:10.1f} MB")
+    print(f"  same defense samples: {rows[0][4] == rows[1][4]}")
+
+
+def legacy_generate_targeted(defense):
+    """
+    The TaCT / SSDT Poison/Clean generation before the streaming pass: batches of 50 from the test loader,
+    separate forward passes for the poisoned and clean parts and many small CPU tensors. Returns the counts.
+    """
+    poison, clean = [], []
+    poison_count, clean_count = 0, 0
+    while poison_count < defense.NUM_SAMPLES or clean_count < defense.NUM_SAMPLES:
+        for inputs, labels in defense.test_loader:
+            inputs, labels = inputs.to(defense.device), labels.to(defense.device)
+            if poison_count < defense.NUM_SAMPLES:
+                victim = labels == config.source_class
+                if victim.sum().item() > 0:
+                    if defense.poison_type == 'SSDT':
+                        bd_inputs = defense.create_bd(inputs[victim])
+                    else:
+                        bd_inputs, _ = defense.poison_transform.transform(inputs[victim], labels[victim])
+                    success = torch.argmax(defense.model(bd_inputs), dim=1) == defense.target
+                    if success.sum().item() > 0:
+                        poison.append(bd_inputs[success].cpu())
+                        poison_count += int(success.sum().item())
+            if clean_count < defense.NUM_SAMPLES:
+                non_victim = labels != config.source_class
+                if non_victim.sum().item() > 0:
+                    torch.argmax(defense.model(inputs[non_victim]), dim=1)
+                    clean.append(inputs[non_victim].cpu())
+                    clean_count += int(non_victim.sum().item())
+            if poison_count >= defense.NUM_SAMPLES and clean_count >= defense.NUM_SAMPLES:
+                break
+    return min(poison_count, defense.NUM_SAMPLES), min(clean_count, defense.NUM_SAMPLES)
+
+
+def bench_generation(args):
+    """Legacy vs. streaming Poison/Clean generation of TEDPLUS on the same test split."""
+    from other_defenses_tool_box.TEDPLUS import TEDPLUS
+    defense = TEDPLUS(detector_args(args))
+    print(f"[generation] {args.dataset} / {args.poison_type}, {defense.NUM_SAMPLES} samples per side")
+    if defense.poison_type in ['TaCT', 'SSDT']:
+        t, counts = timed(lambda: legacy_generate_targeted(defense), args.repeat)
+        print(f"  {'legacy':<10} {t:8.2f} s  poison {counts[0]}  clean {counts[1]}")
+    for batch_size in [50, 256, 1024]:
+        defense.generation_batch_size = batch_size
+        t, _ = timed(defense.generate_poison_clean_sets, args.repeat)
+        print(f"  {'stream ' + str(batch_size):<10} {t:8.2f} s  poison {defense.poison_count}  clean {defense.clean_count}")
+
+
+def bench_score(args):
+    """
+    Throughput and latency of TEDPLUS.score_batch on a fitted detector, one batch size at a time.
+    The input batches are taken from the test split and moved to the device before timing.
+    """
+    from other_defenses_tool_box.TEDPLUS import TEDPLUS
+    defense = TEDPLUS(detector_args(args))
+    path = args.artifact if args.artifact is not None else defense.default_artifact_path()
+    if os.path.exists(path):
+        defense.load(path)
+    else:
+        defense.fit(path)
+
+    batch_sizes = [int(batch_size) for batch_size in args.batch_sizes.split(',')]
+    pool, pool_size = [], 0
+    for images, _ in defense.test_loader:
+        pool.append(images)
+        pool_size += images.shape[0]
+        if pool_size >= max(batch_sizes):
+            break
+    pool = torch.cat(pool).to(defense.device)
+
+    print(f"[score] {args.dataset} / {args.poison_type}, {len(defense.layers)} layers, "
+          f"{args.score_iters} iterations per batch size")
+    for batch_size in batch_sizes:
+        batch = pool[torch.arange(batch_size) % pool.shape[0]]
+        defense.score_batch(batch)  # warm-up
+        latencies = []
+        for _ in range(args.score_iters):
+            synchronize()
+            start = time.perf_counter()
+            defense.score_batch(batch)
+            synchronize()
+            latencies.append(time.perf_counter() - start)
+        latencies = np.array(latencies) * 1000
+        print(f"  batch {batch_size:4d}  {batch_size * 1000 / np.median(latencies):10.1f} samples/s  "
+              f"p50 {np.percentile(latencies, 50):8.2f} ms  p99 {np.percentile(latencies, 99):8.2f} ms")
+
+
+# ------------------------------
+# precision: low-precision activation storage against float32
+# ------------------------------
+def precision_worker(det_args):
+    """
+    run_detector, keeping what the precision comparison needs: the rank matrix of all samples, the first
+    same-label neighbour of every Poison / Clean sample per layer and the bytes of stored activations.
+    """
+    from other_defenses_tool_box.TEDPLUS import TEDPLUS
+    random.seed(42)
+    np.random.seed(42)
+    torch.manual_seed(42)
+    defense = TEDPLUS(det_args)
+    results = defense.test()
+    representation = defense.topological_representation
+    results['ranks'] = representation.matrix(list(representation.groups)).copy()
+    results['nn_index'] = {}
+    preds = torch.cat([defense.h_poison_preds, defense.h_clean_preds])
+    for layer in defense.layers:
+        queries = torch.cat([defense.h_poison_activations[layer], defense.h_clean_activations[layer]])
+        queries = defense.activation_quantizer.distance_view(layer, queries)
+        results['nn_index'][layer] = defense.defense_geometry[layer].query(queries, preds)[2].numpy()
+    stored = [defense.h_defense_activations, defense.h_poison_activations, defense.h_clean_activations]
+    results['activation_mb'] = sum(h.numel() * h.element_size() for activations in stored
+                                   for h in activations.values()) / 2 ** 20
+    return results
+
+
+def bench_precision(args):
+    """
+    Per dataset, every -precisions entry (precision[:granularity]) against float32 storage: Kendall tau of the
+    per-layer ranks (mean over layers), first-neighbour agreement, detection deltas and stored activation MB.
+    """
+    for dataset in args.datasets.split(','):
+        dataset_args = argparse.Namespace(**vars(args))
+        dataset_args.dataset = dataset
+        reference = precision_worker(detector_args(dataset_args, trigger=None, ted_precision='float32'))
+        print(f"[precision] {dataset} / {args.poison_type}: float32 AUC {reference['AUC']:.4f}  "
+              f"TPR {reference['TPR'] * 100:6.2f}%  FPR {reference['FPR'] * 100:6.2f}%  "
+              f"{reference['activation_mb']:.1f} MB")
+        for entry in args.precisions.split(','):
+            precision, _, granularity = entry.partition(':')
+            results = precision_worker(detector_args(dataset_args, trigger=None, ted_precision=precision,
+                                                     ted_precision_granularity=granularity or 'layer'))
+            if results['ranks'].shape == reference['ranks'].shape:
+                taus = [kendalltau(reference['ranks'][:, column], results['ranks'][:, column])[0]
+                        for column in range(reference['ranks'].shape[1])]
+                tau = f"{np.nanmean(taus):.4f}"
+            else:
+                tau = 'n/a'
+            neighbours = np.mean([(results['nn_index'][layer] == reference['nn_index'][layer]).mean()
+                                  for layer in reference['nn_index']]) * 100
+            saved = results['activation_mb'] / reference['activation_mb'] * 100
+            print(f"  {entry:<14} tau {tau:>6}  first neighbour {neighbours:6.2f}%  "
+                  f"dAUC {results['AUC'] - reference['AUC']:+.4f}  "
+                  f"dTPR {(results['TPR'] - reference['TPR']) * 100:+6.2f}  "
+                  f"dFPR {(results['FPR'] - reference['FPR']) * 100:+6.2f}  "
+                  f"{results['activation_mb']:.1f} MB ({saved:.0f}% of float32)")
+
+
+# ------------------------------
+# headless: import cost and console output of the plotting / progress code
+# ------------------------------
+IMPORT_PROBE = '''
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start, sorted(m for m in ['matplotlib', 'plotly', 'seaborn', 'umap'] if m in sys.modules))
+'''
+
+
+def import_time(module):
+    """Import time of `module` in a fresh interpreter and the plotting libraries it pulled in."""
+    output = subprocess.run([sys.executable, '-c', IMPORT_PROBE.format(module=module)], check=True,
+                            capture_output=True, text=True).stdout.split(maxsplit=1)
+    return float(output[0]), output[1].strip()
+
+
+def headless_worker(det_args):
+    """run_detector with stdout / stderr captured, adding the bytes the run wrote to the console."""
+    stdout, stderr = io.StringIO(), io.StringIO()
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        results = run_detector(det_args)
+    results['console_kb'] = (len(stdout.getvalue()) + len(stderr.getvalue())) / 1024
+    return results
+
+
+def bench_headless(args):
+    """Default vs. -ted_headless TEDPLUS: import time, end-to-end wall time and console output."""
+    seconds, loaded = import_time('other_defenses_tool_box.TEDPLUS')
+    print(f"[headless] import TEDPLUS {seconds:.2f}s, plotting modules loaded: {loaded}")
+    seconds, _ = import_time('matplotlib.pyplot, plotly.express')
+    print(f"[headless] import matplotlib.pyplot + plotly.express {seconds:.2f}s (deferred to the figures)")
+    print(f"[headless] {args.dataset} / {args.poison_type}")
+    for name, headless in [('default', False), ('headless', True)]:
+        results = run_isolated(headless_worker, detector_args(args, ted_headless=headless))
+        print_result_row(name, results)
+        print(f"  {'':<20} console output {results['console_kb']:.1f} KB")
+
+
+# ------------------------------
+# bootstrap: resampled evaluation from cached distances against independent seeded runs
+# ------------------------------
+def resampler_matches_geometry(args, generator):
+    """RankResampler on a random subset of a synthetic pool gives the ranks DefenseGeometry computes on it."""
+    references, reference_labels = synthetic_activations(args.num_defense, 256, args.num_classes, 'cpu', generator)
+    queries, query_labels = synthetic_activations(args.num_queries, 256, args.num_classes, 'cpu', generator)
+    resampler = RankResampler({'layer': distance_matrix(references, references)},
+                              {'layer': distance_matrix(queries, references)},
+                              reference_labels, query_labels, k=10, saturation=args.num_defense - 1)
+    defense_rows = torch.randperm(args.num_defense, generator=generator)[:args.num_defense // 2]
+    query_rows = torch.randperm(args.num_queries, generator=generator)[:args.num_queries // 2]
+    benign, unknown, kept = resampler.ranks(defense_rows, query_rows)
+
+    geometry = DefenseGeometry(references[defense_rows], reference_labels[defense_rows], 10)
+    expected = np.zeros(len(defense_rows), dtype=np.int64)
+    found = np.zeros(len(defense_rows), dtype=bool)
+    for label in range(args.num_classes):
+        ranks, origin = defense_group_ranks(geometry, reference_labels[defense_rows], label, args.num_defense - 1)
+        expected[origin.numpy()], found[origin.numpy()] = ranks.numpy(), True
+    ranks, origin = query_group_ranks(geometry, queries[query_rows], query_labels[query_rows], args.num_defense - 1)
+    expected_queries = np.zeros(len(query_rows), dtype=np.int64)
+    expected_queries[origin.numpy()] = ranks.numpy()
+    return np.array_equal(benign[:, 0], expected[found]) and np.array_equal(unknown[:, 0], expected_queries[kept])
+
+
+def bench_bootstrap(args):
+    """
+    -replicates independently seeded TEDPLUS runs against one -ted_bootstrap run with as many replicates:
+    total wall time and the mean / 95% interval of every metric.
+    """
+    identical = resampler_matches_geometry(args, torch.Generator().manual_seed(args.seed))
+    print(f"[bootstrap] resampled ranks {'match' if identical else 'DIFFER from'} DefenseGeometry")
+    print(f"[bootstrap] {args.dataset} / {args.poison_type}, {args.replicates} replicates")
+    from other_defenses_tool_box.TEDPLUS import TEDPLUS
+    runs, start = [], time.perf_counter()
+    for seed in range(args.replicates):
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        runs.append(TEDPLUS(detector_args(args, ted_headless=True)).test())
+    independent = time.perf_counter() - start
+
+    random.seed(42)
+    np.random.seed(42)
+    torch.manual_seed(42)
+    start = time.perf_counter()
+    resampled = TEDPLUS(detector_args(args, ted_headless=True, ted_bootstrap=args.replicates)).bootstrap()
+    elapsed = time.perf_counter() - start
+    print(f"  independent runs {independent:8.2f} s   bootstrap {elapsed:8.2f} s   ({independent / elapsed:.1f}x less)")
+    for metric in ['TPR', 'FPR', 'AUC', 'F1']:
+        values = np.array([run[metric] for run in runs])
+        low, high = np.percentile(values, [2.5, 97.5])
+        summary = resampled[metric]
+        print(f"  {metric:<4} independent {values.mean():.4f} [{low:.4f}, {high:.4f}]   "
+              f"bootstrap {summary['mean']:.4f} [{summary['ci_low']:.4f}, {summary['ci_high']:.4f}]")
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.bench == 'check':
+        bench_check(args)
+    elif args.bench == 'rank':
+        bench_rank(args)
+    elif args.bench == 'capture':
+        bench_capture(args)
+    elif args.bench == 'index':
+        bench_index(args)
+    elif args.bench == 'reduction':
+        bench_reduction(args)
+    elif args.bench == 'layers':
+        bench_layers(args)
+    elif args.bench == 'construction':
+        bench_construction(args)
+    elif args.bench == 'generation':
+        bench_generation(args)
+    elif args.bench == 'score':
+        bench_score(args)
+    elif args.bench == 'precision':
+        bench_precision(args)
+    elif args.bench == 'workers':
+        bench_workers(args)
+    elif args.bench == 'headless':
+        bench_headless(args)
+    elif args.bench == 'bootstrap':
+        bench_bootstrap(args)
+    elif args.bench == 'incremental':
+        bench_incremental(args)
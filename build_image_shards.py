@@ -0,0 +1,123 @@
+"""
+Build the pre-resized uint8 image shards (utils.image_shards) of the ImageFolder / ImageNet splits once, then
+point the loaders at them: `config.shard_dir`, generate_dataloader(..., shard_dir=...) or
+`other_defense.py -shard_dir ...` (generate_dataloader and defense_dataloader.get_dataloader).
+
+Each split is decoded and resized by -build_workers processes; the build reports images/s and images/s per
+core. -verify compares samples read through the loaders with and without the shards, -bench compares the read
+throughput of one pass over -bench samples.
+
+Defaults match the loader transforms: short 256 for imagenette / imagenet50/100/200 (Resize(256) +
+CenterCrop(224)), fixed 256 for imagenet (Resize((256, 256))), fixed 64 for tinyimagenet200 and pubfig.
+defense_dataloader resizes imagenette / tinyimagenet200 / pubfig to 64 x 64, so build fixed 64 shards in a
+shard_dir of their own for it.
+
+    python build_image_shards.py -dataset imagenette
+    python build_image_shards.py -dataset imagenet200 -split train test -build_workers 16 -bench 4096
+    python build_image_shards.py -dataset imagenette -size 64 -resize fixed -shard_dir data/shards/fixed64
+"""
+import argparse
+import os
+
+import numpy as np
+import torch
+
+import config
+import defense_dataloader
+from other_defenses_tool_box import tools
+from utils import image_shards
+from utils.tools import loader_throughput
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-dataset', type=str, required=True,
+                    choices=['imagenette', 'imagenet50', 'imagenet100', 'imagenet200', 'tinyimagenet200', 'imagenet',
+                             'pubfig'])
+parser.add_argument('-split', type=str, nargs='+', required=False, default=['train', 'std_test', 'test'],
+                    choices=['train', 'std_test', 'test', 'valid'])
+parser.add_argument('-data_root', type=str, required=False, default='./data/')
+parser.add_argument('-shard_dir', type=str, required=False, default=None,
+                    help='default: data/shards/<resize><size>')
+parser.add_argument('-size', type=int, required=False, default=None)
+parser.add_argument('-resize', type=str, required=False, default=None, choices=['short', 'fixed'])
+parser.add_argument('-shard_size', type=int, required=False, default=1024)
+parser.add_argument('-build_workers', type=int, required=False, default=os.cpu_count())
+parser.add_argument('-rebuild', default=False, action='store_true', help='rebuild splits that are already sharded')
+parser.add_argument('-verify', type=int, required=False, default=16,
+                    help='samples compared through the loaders with and without the shards')
+parser.add_argument('-bench', type=int, required=False, default=0,
+                    help='read this many samples from the source and from the shards and compare throughput')
+parser.add_argument('-num_workers', type=int, required=False, default=4, help='DataLoader workers for -bench')
+parser.add_argument('-batch_size', type=int, required=False, default=128)
+parser.add_argument('-seed', type=int, required=False, default=0)
+
+DEFAULT_GEOMETRY = {
+    'imagenet': (256, 'fixed'),
+    'tinyimagenet200': (64, 'fixed'),
+    'pubfig': (64, 'fixed'),
+}
+
+
+def split_dataset(args, split, shard_dir):
+    """The dataset of `split` as the loaders build it (default transform), read from `shard_dir` unless None."""
+    if args.dataset == 'pubfig':  # only loaded through defense_dataloader
+        opt = argparse.Namespace(dataset=args.dataset, data_root=args.data_root, input_height=64, input_width=64,
+                                 shard_dir=shard_dir)
+        return defense_dataloader.get_dataset(opt, train=True)
+    config.shard_dir = None
+    return tools.generate_dataloader(dataset=args.dataset, dataset_path=args.data_root, split=split,
+                                     shuffle=False, shard_dir=shard_dir).dataset
+
+
+def verify(source, sharded, num_samples, seed):
+    indices = np.random.default_rng(seed).choice(len(source), size=min(num_samples, len(source)), replace=False)
+    max_error, label_mismatches = 0., 0
+    for i in indices:
+        (x, y), (x_shard, y_shard) = source[i], sharded[i]
+        max_error = max(max_error, (torch.as_tensor(x) - torch.as_tensor(x_shard)).abs().max().item())
+        label_mismatches += int(int(y) != int(y_shard))
+    print('[Verify] %d samples: max |source - shards| after the transform %.5f, %d label mismatches'
+          % (len(indices), max_error, label_mismatches))
+
+
+def bench(source, sharded, num_samples, num_workers, batch_size, seed):
+    indices = np.random.default_rng(seed).permutation(len(source))[:num_samples].tolist()
+    print('[Bench] %d samples, %d DataLoader workers, batch size %d' % (len(indices), num_workers, batch_size))
+    for name, dataset in [('source', source), ('shards', sharded)]:
+        loader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, indices), batch_size=batch_size,
+                                             shuffle=False, num_workers=num_workers)
+        _, images_per_s, images_per_s_per_core = loader_throughput(loader)
+        print('  %-7s %9.1f images/s  %8.1f images/s per core' % (name, images_per_s, images_per_s_per_core))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    size, resize = DEFAULT_GEOMETRY.get(args.dataset, (256, 'short'))
+    args.size = args.size or size
+    args.resize = args.resize or resize
+    if args.shard_dir is None:
+        args.shard_dir = os.path.join(config.data_dir, 'shards', '%s%d' % (args.resize, args.size))
+    splits = ['train'] if args.dataset == 'pubfig' else args.split
+
+    for split in splits:
+        source = split_dataset(args, split, None)
+        sources = image_shards.image_sources(source)
+        if not sources:
+            print('[Shards] %s %s is not an ImageFolder / ImageNet split, nothing to shard' % (args.dataset, split))
+            continue
+        for source_dir, paths, labels in sources:
+            path = image_shards.shard_path(args.shard_dir, source_dir)
+            if image_shards.read_header(path) is not None and not args.rebuild:
+                print('[Shards] %s is already sharded in %s' % (source_dir, path))
+                continue
+            stats = image_shards.build_shards(source_dir, paths, labels, path, size=args.size, resize=args.resize,
+                                              shard_size=args.shard_size, num_workers=args.build_workers)
+            print('[Shards] %s -> %s (%d images, %s %d): %.1fs, %.1f images/s with %d workers, '
+                  '%.1f images/s per core'
+                  % (source_dir, path, stats['images'], args.resize, args.size, stats['wall_s'],
+                     stats['images_per_s'], stats['workers'], stats['images_per_s_per_core']))
+
+        sharded = split_dataset(args, split, args.shard_dir)
+        if args.verify > 0:
+            verify(source, sharded, args.verify, args.seed)
+        if args.bench > 0:
+            bench(source, sharded, args.bench, args.num_workers, args.batch_size, args.seed)
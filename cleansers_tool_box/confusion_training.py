@@ -490,10 +490,11 @@ def iterative_poison_distillation(inspection_set, clean_set, params, args, debug
     lamb = params['lamb_distillation']
     weight_decay = params['weight_decay']
 
+    # labels come from the dataset's label storage, no image is decoded to learn them
+    inspection_labels = tools.dataset_labels(inspection_set)
     class_cnt = np.zeros(num_classes)
-    for i in range(num_samples):
-        _, gt = inspection_set[i]
-        class_cnt[gt.item()]+=1
+    for label, indices in tools.indices_by_class(inspection_set).items():
+        class_cnt[label] = len(indices)
 
     arch = params['base_arch']
 
@@ -672,8 +673,8 @@ def iterative_poison_distillation(inspection_set, clean_set, params, args, debug
             median_sample_indices = []
             sorted_indices_each_class = [[] for _ in range(num_classes)]
             for temp_id in sorted_indices:
-                _, gt = inspection_set[temp_id]
-                sorted_indices_each_class[gt.item()].append(temp_id)
+                gt = inspection_labels[temp_id]
+                sorted_indices_each_class[gt].append(temp_id)
 
             for i in range(num_classes):
                 num_class_i = len(sorted_indices_each_class[i])
@@ -684,13 +685,13 @@ def iterative_poison_distillation(inspection_set, clean_set, params, args, debug
 
             class_dist = np.zeros(num_classes, dtype=int)
             for t in distilled_samples_indices:
-                _, gt = inspection_set[t]
-                class_dist[gt.item()] += 1
+                gt = inspection_labels[t]
+                class_dist[gt] += 1
 
             median_indices_each_class = [[] for _ in range(num_classes)]
             for t in median_sample_indices:
-                _, gt = inspection_set[t]
-                median_indices_each_class[gt.item()].append(t)
+                gt = inspection_labels[t]
+                median_indices_each_class[gt].append(t)
 
             # slightly rebalance the distilled set
             for i in range(num_classes):
@@ -713,8 +714,8 @@ def iterative_poison_distillation(inspection_set, clean_set, params, args, debug
             median_sample_indices = []
             sorted_indices_each_class = [[] for _ in range(num_classes)]
             for temp_id in sorted_indices:
-                _, gt = inspection_set[temp_id]
-                sorted_indices_each_class[gt.item()].append(temp_id)
+                gt = inspection_labels[temp_id]
+                sorted_indices_each_class[gt].append(temp_id)
 
             for i in range(num_classes):
                 num_class_i = len(sorted_indices_each_class[i])
@@ -725,13 +726,13 @@ def iterative_poison_distillation(inspection_set, clean_set, params, args, debug
 
             class_dist = np.zeros(num_classes, dtype=int)
             for t in distilled_samples_indices:
-                _, gt = inspection_set[t]
-                class_dist[gt.item()] += 1
+                gt = inspection_labels[t]
+                class_dist[gt] += 1
 
             median_indices_each_class = [[] for _ in range(num_classes)]
             for t in median_sample_indices:
-                _, gt = inspection_set[t]
-                median_indices_each_class[gt.item()].append(t)
+                gt = inspection_labels[t]
+                median_indices_each_class[gt].append(t)
 
 
             # slightly rebalance the distilled set
@@ -12,6 +12,9 @@ from torchvision import models
 data_dir = './data' # defaul clean dataset directory
 triggers_dir = './triggers' # default triggers directory
 imagenet_dir = './data/imagenet50' # ImageNet dataset directory (USE YOUR OWN!)
+shard_dir = None # pre-resized uint8 image shards read instead of the ImageFolder / ImageNet images (build_image_shards.py)
+loader_backend = 'torch' # 'torch' DataLoader or 'ffcv' CPU Loader for generate_dataloader / unpack_poisoned_train_set
+eval_cache_mb = 0 # > 0: evaluation splits up to this size are served from memory by generate_dataloader (utils/eval_cache.py)
 target_class = {
     'cifar10' : 0,
     'gtsrb' : 2,
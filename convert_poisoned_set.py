@@ -0,0 +1,160 @@
+"""
+Convert a poisoned set to the compact uint8 image set format read by utils.tools.IMG_Dataset, and benchmark
+the formats.
+
+Both legacy formats are converted in place: `imgs` (one torch-saved float tensor, moved to `imgs.pt`) and
+`data/` (one PNG per sample, left where it is). The compact set is written to `imgs/`, which the poisoned set
+loaders (unpack_poisoned_train_set, train_on_poisoned_set.py, cleanser.py, the visualizations, ...) prefer over
+`data/`. Pass -remove_legacy to delete the legacy images afterwards.
+
+Only poisoned sets (holding `poison_indices`) are converted: the clean_set splits are read from their `data/`
+directory by the defenses and the evaluation loaders, so a compact copy of them would never be read.
+
+    python convert_poisoned_set.py -dataset cifar10 -poison_type badnet -poison_rate 0.003
+    python convert_poisoned_set.py -dir poisoned_train_set/cifar10/badnet_0.003
+    python convert_poisoned_set.py -dataset gtsrb -poison_type blend -poison_rate 0.003 -bench -num_workers 4
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import time
+
+import torch
+from PIL import Image
+from torchvision import transforms
+
+import config
+from utils import supervisor, default_args, tools
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-dir', type=str, required=False, default=None,
+                    help='poisoned set directory (holding labels, poison_indices and imgs or data/); '
+                         'default: the poisoned set of the args below')
+parser.add_argument('-dataset', type=str, required=False,
+                    default=default_args.parser_default['dataset'],
+                    choices=default_args.parser_choices['dataset'])
+parser.add_argument('-poison_type', type=str, required=False,
+                    choices=default_args.parser_choices['poison_type'],
+                    default=default_args.parser_default['poison_type'])
+parser.add_argument('-poison_rate', type=float, required=False,
+                    choices=default_args.parser_choices['poison_rate'],
+                    default=default_args.parser_default['poison_rate'])
+parser.add_argument('-cover_rate', type=float, required=False,
+                    choices=default_args.parser_choices['cover_rate'],
+                    default=default_args.parser_default['cover_rate'])
+parser.add_argument('-alpha', type=float, required=False,
+                    default=default_args.parser_default['alpha'])
+parser.add_argument('-trigger', type=str, required=False, default=None)
+parser.add_argument('-layout', type=str, required=False, default='NCHW', choices=['NCHW', 'NHWC'])
+parser.add_argument('-remove_legacy', default=False, action='store_true')
+parser.add_argument('-bench', default=False, action='store_true',
+                    help='compare load time, epoch time and peak RSS of the legacy and the compact format')
+parser.add_argument('-num_workers', type=int, required=False, default=4)
+parser.add_argument('-batch_size', type=int, required=False, default=128)
+
+
+class PNGImages:
+    """The `data/` PNG directory as a sequence of (C, H, W) float tensors, sliceable for save_image_set."""
+
+    def __init__(self, directory, num_samples):
+        self.directory = directory
+        self.num_samples = num_samples
+        self.to_tensor = transforms.ToTensor()
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.num_samples))]
+        return self.to_tensor(Image.open(os.path.join(self.directory, '%d.png' % index)))
+
+
+def convert(set_dir, layout='NCHW', remove_legacy=False):
+    img_path = os.path.join(set_dir, 'imgs')
+    if tools.read_image_set_header(img_path) is not None:
+        print('[Convert] %s is already in the compact format' % img_path)
+        return
+    poison_indices_path = os.path.join(set_dir, 'poison_indices')
+    if not os.path.exists(poison_indices_path):
+        raise ValueError('%s is not a poisoned set (no poison_indices): clean / test splits are read from their '
+                         'data/ directory and are not converted' % set_dir)
+    labels = torch.load(os.path.join(set_dir, 'labels'))
+    poison_indices = torch.load(poison_indices_path)
+
+    start = time.perf_counter()
+    if os.path.isfile(img_path):  # torch-saved float tensor
+        legacy_path = img_path + '.pt'
+        img_set = torch.load(img_path)
+    elif os.path.isdir(os.path.join(set_dir, 'data')):  # one PNG per sample
+        legacy_path = os.path.join(set_dir, 'data')
+        img_set = PNGImages(legacy_path, len(labels))
+    else:
+        raise FileNotFoundError('No imgs or data/ under %s' % set_dir)
+    # the legacy images stay in place until the compact set is completely written
+    compact_path = img_path + '.compact'
+    max_error = tools.save_image_set(img_set, compact_path, labels=labels, poison_indices=poison_indices,
+                                     layout=layout)
+    if os.path.isfile(img_path):
+        os.rename(img_path, legacy_path)
+    os.rename(compact_path, img_path)
+    print('[Convert] %s -> %s (%d images, %s) in %.2fs, uint8 rounding error <= %.5f'
+          % (legacy_path, img_path, len(labels), layout, time.perf_counter() - start, max_error))
+
+    if remove_legacy:
+        if os.path.isdir(legacy_path):
+            shutil.rmtree(legacy_path)
+        else:
+            os.remove(legacy_path)
+        print('[Convert] Removed %s' % legacy_path)
+
+
+def load_worker(data_dir, label_path, num_workers, batch_size):
+    """Build IMG_Dataset and run one epoch through a DataLoader; runs in a fresh process (see bench)."""
+    start = time.perf_counter()
+    dataset = tools.IMG_Dataset(data_dir=data_dir, label_path=label_path,
+                                transforms=transforms.Compose([transforms.ToTensor()]))
+    load_time = time.perf_counter() - start
+    load_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    start = time.perf_counter()
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+    for _ in loader:
+        pass
+    epoch_time = time.perf_counter() - start
+    return {
+        'load_s': load_time, 'epoch_s': epoch_time, 'load_rss_mb': load_rss,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_worker_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def bench(set_dir, num_workers, batch_size):
+    label_path = os.path.join(set_dir, 'labels')
+    formats = [('compact uint8', os.path.join(set_dir, 'imgs')),
+               ('torch tensor', os.path.join(set_dir, 'imgs.pt')),
+               ('PNG', os.path.join(set_dir, 'data'))]
+    print('[Bench] %s, %d DataLoader workers, batch size %d' % (set_dir, num_workers, batch_size))
+    for name, data_dir in formats:
+        if not os.path.exists(data_dir):
+            print('  %-14s (not on disk)' % name)
+            continue
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            results = pool.apply(load_worker, (data_dir, label_path, num_workers, batch_size))
+        print('  %-14s load %7.2fs  epoch %7.2fs  RSS after load %8.1f MB  peak %8.1f MB  peak worker %8.1f MB'
+              % (name, results['load_s'], results['epoch_s'], results['load_rss_mb'], results['peak_rss_mb'],
+                 results['peak_worker_rss_mb']))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.dir is not None:
+        set_dir = args.dir
+    else:
+        if args.trigger is None:
+            args.trigger = config.trigger_default[args.dataset][args.poison_type]
+        set_dir = supervisor.get_poison_set_dir(args)
+    convert(set_dir, layout=args.layout, remove_legacy=args.remove_legacy and not args.bench)
+    if args.bench:
+        bench(set_dir, args.num_workers, args.batch_size)
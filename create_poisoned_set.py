@@ -25,10 +25,28 @@ parser.add_argument('-alpha', type=float, required=False,
                     default=default_args.parser_default['alpha'])
 parser.add_argument('-trigger', type=str, required=False,
                     default=None)
+parser.add_argument('-img_format', type=str, required=False, default='tensor', choices=['tensor', 'uint8'],
+                    help="'tensor': one torch-saved float tensor, 'uint8': compact memory-mapped image set directory "
+                         "(lossy for float-valued triggers / blends)")
+parser.add_argument('-img_layout', type=str, required=False, default='NCHW', choices=['NCHW', 'NHWC'])
 args = parser.parse_args()
 
 tools.setup_seed(0)
 
+
+def save_img_set(img_set, img_path, label_set, poison_indices):
+    if args.img_format == 'uint8':
+        max_error = tools.save_image_set(img_set, img_path, labels=label_set, poison_indices=poison_indices,
+                                         layout=args.img_layout)
+        if max_error > 0:
+            print('[Generate Poisoned Set] Warning: %s holds non-uint8 pixel values (float trigger / blend), '
+                  'quantized to uint8 with rounding error <= %.5f; use -img_format tensor to keep them exact'
+                  % (img_path, max_error))
+    else:
+        torch.save(img_set, img_path)
+    print('[Generate Poisoned Set] Save %s' % img_path)
+
+
 print('[target class : %d]' % config.target_class[args.dataset])
 
 data_dir = config.data_dir  # directory to save standard clean set
@@ -513,8 +531,7 @@ if args.poison_type in ['basic', 'badnet', 'blend', 'clean_label', 'refool',
         print('[Generate Poisoned Set] Save %s' % cover_indices_path)
 
     img_path = os.path.join(poison_set_dir, 'imgs')
-    torch.save(img_set, img_path)
-    print('[Generate Poisoned Set] Save %s' % img_path)
+    save_img_set(img_set, img_path, label_set, poison_indices)
 
     label_path = os.path.join(poison_set_dir, 'labels')
     torch.save(label_set, label_path)
@@ -550,8 +567,7 @@ elif args.poison_type == 'dynamic':
     print('[Generate Poisoned Set] Save %d Images' % len(label_set))
 
     img_path = os.path.join(poison_set_dir, 'imgs')
-    torch.save(img_set, img_path)
-    print('[Generate Poisoned Set] Save %s' % img_path)
+    save_img_set(img_set, img_path, label_set, poison_indices)
 
     label_path = os.path.join(poison_set_dir, 'labels')
     torch.save(label_set, label_path)
@@ -585,8 +601,7 @@ elif args.poison_type == 'ISSBA':
     print('[Generate Poisoned Set] Save %d Images' % len(label_set))
 
     img_path = os.path.join(poison_set_dir, 'imgs')
-    torch.save(img_set, img_path)
-    print('[Generate Poisoned Set] Save %s' % img_path)
+    save_img_set(img_set, img_path, label_set, poison_indices)
 
     label_path = os.path.join(poison_set_dir, 'labels')
     torch.save(label_set, label_path)
@@ -8,6 +8,8 @@ import csv
 import os
 from PIL import Image
 from torchvision import datasets
+from utils.tools import LabeledDataset, dataset_labels
+from utils.image_shards import image_folder
 
 class ToNumpy:
     def __call__(self, x):
@@ -48,15 +50,15 @@ def get_transform(opt, train=True):
     return transforms.Compose(transforms_list)
 
 
-class GTSRB(data.Dataset):
+class GTSRB(LabeledDataset, data.Dataset):
     def __init__(self, opt, train, transforms):
         super(GTSRB, self).__init__()
         if train:
             self.data_folder = os.path.join(opt.data_root, "GTSRB/Train")
-            self.images, self.labels = self._get_data_train_list()
+            self.images, self.targets = self._get_data_train_list()
         else:
             self.data_folder = os.path.join(opt.data_root, "GTSRB/Test")
-            self.images, self.labels = self._get_data_test_list()
+            self.images, self.targets = self._get_data_test_list()
 
         self.transforms = transforms
 
@@ -89,13 +91,16 @@ class GTSRB(data.Dataset):
     def __len__(self):
         return len(self.images)
 
+    def labels(self):
+        return np.asarray(self.targets, dtype=np.int64)
+
     def __getitem__(self, index):
         image = Image.open(self.images[index])
         image = self.transforms(image)
-        label = self.labels[index]
+        label = self.targets[index]
         return image, label
 
-class ImageNet(data.Dataset):
+class ImageNet(LabeledDataset, data.Dataset):
     def __init__(self, args, train=True, transform=None):
         super(ImageNet, self).__init__()
         self.args = args
@@ -103,7 +108,7 @@ class ImageNet(data.Dataset):
         
         if train:
             self.data_folder = os.path.join(dataset_dir, 'train')
-            self.data = datasets.ImageFolder(self.data_folder, transform=transform)
+            self.data = image_folder(self.data_folder, transform, getattr(args, 'shard_dir', None))
         else:
             # self.data_folder = os.path.join(dataset_dir, 'val')
             # self.data = datasets.ImageFolder(self.data_folder, transform=transform)
@@ -111,8 +116,8 @@ class ImageNet(data.Dataset):
             from torch.utils.data import ConcatDataset
             test_folder = os.path.join(dataset_dir, 'test')
             val_folder = os.path.join(dataset_dir, 'val')
-            test_data = datasets.ImageFolder(test_folder, transform=transform)
-            val_data = datasets.ImageFolder(val_folder, transform=transform)
+            test_data = image_folder(test_folder, transform, getattr(args, 'shard_dir', None))
+            val_data = image_folder(val_folder, transform, getattr(args, 'shard_dir', None))
             self.data = ConcatDataset([test_data, val_data])
 
         self.transform = transform
@@ -120,24 +125,30 @@ class ImageNet(data.Dataset):
     def __len__(self):
         return len(self.data)
 
+    def labels(self):
+        return dataset_labels(self.data)
+
     def __getitem__(self, index):
         image, label = self.data[index]
         return image, label
     
-class PubFig(data.Dataset):
+class PubFig(LabeledDataset, data.Dataset):
     def __init__(self, args, train=True, transform=None):
         super(PubFig, self).__init__()
         self.args = args
         dataset_dir = os.path.join(args.data_root, args.dataset)
 
         self.data_folder = dataset_dir
-        self.data = datasets.ImageFolder(self.data_folder, transform=transform)
+        self.data = image_folder(self.data_folder, transform, getattr(args, 'shard_dir', None))
         
         self.transform = transform
 
     def __len__(self):
         return len(self.data)
 
+    def labels(self):
+        return dataset_labels(self.data)
+
     def __getitem__(self, index):
         image, label = self.data[index]
         return image, label
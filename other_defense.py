@@ -1,6 +1,6 @@
 import torch
 import argparse, config, os, sys
-from utils import supervisor, tools, default_args
+from utils import supervisor, tools, default_args, eval_cache
 import time
 
 parser = argparse.ArgumentParser()
@@ -39,6 +39,59 @@ parser.add_argument('-num_neighbors', type=int, required=False,
                     default=default_args.parser_default.get('num_neighbors', 1))
 parser.add_argument('-class_ratio', type=float, required=False,
                     default=default_args.parser_default.get('class_ratio', 0))
+parser.add_argument('-shard_dir', type=str, required=False, default=None,
+                    help='read ImageFolder / ImageNet splits from the pre-resized shards built by build_image_shards.py')
+parser.add_argument('-loader_backend', type=str, required=False, default='torch', choices=['torch', 'ffcv'],
+                    help='ffcv: CPU FFCV loaders for generate_dataloader / unpack_poisoned_train_set')
+parser.add_argument('-eval_cache_mb', type=float, required=False, default=None,
+                    help='keep evaluation splits up to this size in memory (default config.eval_cache_mb; 0 disables)')
+# TED / TEDPLUS options
+parser.add_argument('-ted_storage', type=str, required=False, default='device',
+                    choices=['device', 'cpu', 'disk'])
+parser.add_argument('-ted_reduction', type=str, required=False, default='none',
+                    choices=['none', 'avgpool', 'gaussian', 'sparse', 'pca'])
+parser.add_argument('-ted_reduction_dim', type=int, required=False, default=None)
+parser.add_argument('-ted_index', type=str, required=False, default='exact',
+                    choices=['exact', 'class', 'ivf'])
+parser.add_argument('-ted_nlist', type=int, required=False, default=64)
+parser.add_argument('-ted_nprobe', type=int, required=False, default=8)
+parser.add_argument('-ted_artifact', type=str, required=False, default=None,
+                    help="fitted TEDPLUS detector to load (fitted and saved there first if missing); 'auto' for the default path")
+parser.add_argument('-ted_score_chunk', type=int, required=False, default=256)
+parser.add_argument('-ted_generation_batch', type=int, required=False, default=256)
+parser.add_argument('-ted_cascade_order', type=str, required=False, default=None,
+                    help="enable early-exit layer cascade: 'deep', 'shallow' or comma-separated layer names")
+parser.add_argument('-ted_cascade_margin', type=float, required=False, default=1.0)
+parser.add_argument('-ted_cascade_tolerance', type=float, required=False, default=0.01)
+parser.add_argument('-ted_layer_budget_mflops', type=float, required=False, default=None,
+                    help='select TED hook layers under this rank + capture cost per sample (MFLOPs)')
+parser.add_argument('-ted_layer_budget_mb', type=float, required=False, default=None,
+                    help='select TED hook layers under this defense activation memory (MB)')
+parser.add_argument('-ted_precision', type=str, required=False, default='float32',
+                    choices=['float32', 'float16', 'bfloat16', 'int8'],
+                    help='storage precision of the TED activation matrices (distances stay float32)')
+parser.add_argument('-ted_precision_granularity', type=str, required=False, default='layer',
+                    choices=['layer', 'channel'], help='int8 scale per TED layer or per activation channel')
+parser.add_argument('-ted_cache_dir', type=str, required=False, default=None,
+                    help='shared on-disk cache of TED activations (off when not given)')
+parser.add_argument('-ted_cache_mb', type=float, required=False, default=None,
+                    help='size bound of -ted_cache_dir, least recently used entries are evicted')
+parser.add_argument('-ted_workers', type=int, required=False, default=1,
+                    help='processes the TEDPLUS layers are ranked in (CPU runs only)')
+parser.add_argument('-ted_profile_trace', type=str, required=False, default=None,
+                    help='run the TEDPLUS stages starting with this name (e.g. rank/ or capture/poison) '
+                         'under torch.profiler and save a Chrome trace')
+parser.add_argument('-ted_headless', action='store_true', default=False,
+                    help='TED/TEDPLUS: no progress output, images or figures; print the result as one JSON line')
+parser.add_argument('-ted_bootstrap', type=int, required=False, default=0,
+                    help='TEDPLUS: mean and CI over this many defense/test resamples of one cached pool')
+parser.add_argument('-ted_bootstrap_mode', type=str, required=False, default='subsample',
+                    choices=['subsample', 'bootstrap'], help='draw the test samples without / with replacement')
+parser.add_argument('-ted_bootstrap_pool', type=int, required=False, default=None,
+                    help='Poison / Clean samples in the bootstrap pool (default 4 x num_test_samples)')
+parser.add_argument('-ted_bootstrap_ci', type=float, required=False, default=0.95)
+parser.add_argument('-ted_truncate', action='store_true', default=False,
+                    help='stop the TED activation forward pass after the deepest hooked layer')
 args = parser.parse_args()
 
 if args.dataset in ["cifar10", "gtsrb"]:
@@ -88,6 +141,11 @@ print(args.poison_type)
 args.data_root = "./data/"
 args.bs = 50
 args.num_workers = 2
+if args.shard_dir is not None:
+    config.shard_dir = args.shard_dir
+config.loader_backend = args.loader_backend
+if args.eval_cache_mb is not None:
+    config.eval_cache_mb = args.eval_cache_mb
 
 if args.poison_type != 'SSDT' and args.trigger is None:
     args.trigger = config.trigger_default[args.dataset][args.poison_type]
@@ -305,5 +363,6 @@ else:
 
 end_time = time.perf_counter()
 print("Elapsed time: {:.2f}s".format(end_time - start_time))
+eval_cache.report()
 
 
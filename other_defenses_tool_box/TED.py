@@ -3,38 +3,36 @@
 
 from torchvision.utils import save_image
 import os
+import json
 import random
-from collections import Counter, defaultdict
+from collections import Counter
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 import pickle
 from sklearn import metrics
 from sklearn.decomposition import PCA as sklearn_PCA
 from sklearn.metrics import confusion_matrix
 from sklearn.model_selection import train_test_split
 from pyod.models.pca import PCA
-from umap import UMAP
 from numpy.random import choice
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.data as data
-from torchmetrics.functional import pairwise_euclidean_distance
-import plotly.express as px
 import config
 from utils import supervisor, tools
+from utils.activation_cache import ActivationCache, dataset_signature
 from utils.resnet import ResNet18, ResNet34
 from utils.supervisor import get_transforms
 from other_defenses_tool_box.tools import generate_dataloader
 from other_defenses_tool_box.backdoor_defense import BackdoorDefense
+from other_defenses_tool_box.TED_utils import first_same_label_rank, allocate_activation_buffer, ActivationReducer, \
+    build_rank_index, TopologicalRepresentation, ActivationQuantizer, state_sha256
 from networks.models import Generator, NetC_MNIST
 from defense_dataloader import get_dataset, get_dataloader
-import seaborn as sns
-from matplotlib.lines import Line2D
 from scipy.spatial.distance import squareform, pdist
-import matplotlib.font_manager as fm
+import time
 
 # ------------------------------
 # Seed settings for reproducibility
@@ -57,16 +55,17 @@ class TED(BackdoorDefense):
     def __init__(self, args):
         super().__init__(args)  # Call the constructor of the parent class, BackdoorDefense
         self.args = args
+        self.headless = getattr(args, 'ted_headless', False)
 
         # 1) Model configuration
         self.model.eval()
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.model.to(self.device)
-        print(self.poison_type)
+        self.log(self.poison_type)
 
         # 2) Define the backdoor target class
         self.target = self.target_class
-        print(f"Target Class: {self.target}")
+        self.log(f"Target Class: {self.target}")
 
         # 3) Load the full test set
         if self.poison_type == 'SSDT':
@@ -85,7 +84,7 @@ class TED(BackdoorDefense):
             )
             self.testset = self.test_loader.dataset
 
-        print(f"Number of samples in full test set: {len(self.testset)}")
+        self.log(f"Number of samples in full test set: {len(self.testset)}")
 
         # 4) Split the full test set into 10% (defense/validation) and 90% (final test)
         all_indices = np.arange(len(self.testset))
@@ -99,17 +98,15 @@ class TED(BackdoorDefense):
         self.defense_loader = data.DataLoader(self.defense_subset, batch_size=50, shuffle=True, num_workers=0)
         self.test_loader = data.DataLoader(self.testset, batch_size=50, shuffle=False, num_workers=0)
 
-        print(f"Number of samples in defense set (90% of test): {len(self.defense_subset)}")
-        print(f"Number of samples in final test set (10% of test): {len(self.testset)}")
+        self.log(f"Number of samples in defense set (90% of test): {len(self.defense_subset)}")
+        self.log(f"Number of samples in final test set (10% of test): {len(self.testset)}")
 
-        # 5) Determine unique classes by scanning the defense set
-        all_labels = []
-        for _, labels in self.defense_loader:
-            all_labels.extend(labels.tolist())
-        unique_classes = set(all_labels)
+        # 5) Determine unique classes from the labels of the defense set (no image is decoded)
+        class_positions = tools.indices_by_class(self.defense_subset)
+        unique_classes = set(class_positions)
         num_classes = len(unique_classes)
-        print(f"Number of unique classes (from defense set): {num_classes}")
-        print(f"Expected number of classes from args: {self.num_classes}")
+        self.log(f"Number of unique classes (from defense set): {num_classes}")
+        self.log(f"Expected number of classes from args: {self.num_classes}")
 
         # 6) Set defense training parameters
         self.SAMPLES_PER_CLASS = args.validation_per_class
@@ -123,50 +120,30 @@ class TED(BackdoorDefense):
         defense_set = self.defense_subset  # Alias for clarity
         if isinstance(defense_set, data.Subset):
             underlying_dataset = defense_set.dataset
-            subset_indices = defense_set.indices
+            subset_indices = np.asarray(defense_set.indices)
         else:
             underlying_dataset = defense_set
             subset_indices = np.arange(len(defense_set))
 
-        from collections import defaultdict
-        label_to_indices = defaultdict(list)
-        for idx in subset_indices:
-            try:
-                _, label = underlying_dataset[idx]
-                label_to_indices[label].append(idx)
-            except FileNotFoundError:
-                print(f"Warning: File {idx}.png does not exist.")
-
-        # Dictionary to store correctly predicted indices per class
-        correct_indices_per_class = defaultdict(list)
         # Create a DataLoader for the defense set without shuffling to maintain index order
         defense_loader_no_shuffle = data.DataLoader(defense_set, batch_size=50, num_workers=0, shuffle=False)
-        current_idx = 0
 
-        # Evaluate the defense set to collect correctly predicted samples
+        # Evaluate the defense set to find the correctly predicted samples, in index order
+        correct_mask = []
         with torch.no_grad():
             for inputs, labels in tqdm(defense_loader_no_shuffle,
-                                       desc="Evaluating defense set for correct predictions"):
+                                       desc="Evaluating defense set for correct predictions",
+                                       disable=self.headless):
                 inputs, labels = inputs.to(self.device), labels.to(self.device)
-                outputs = self.model(inputs)
-                preds = torch.argmax(outputs, dim=1)
-                correct_mask = preds == labels
-
-                # Loop over batch and record correct sample indices
-                for i in range(len(labels)):
-                    if correct_mask[i].item():
-                        if isinstance(defense_set, data.Subset):
-                            sample_idx = subset_indices[current_idx]
-                        else:
-                            sample_idx = current_idx
-                        label = labels[i].item()
-                        correct_indices_per_class[label].append(sample_idx)
-                    current_idx += 1
+                preds = torch.argmax(self.model(inputs), dim=1)
+                correct_mask.append((preds == labels).cpu())
+        correct_mask = torch.cat(correct_mask).numpy()
 
         # For each class, sample SAMPLES_PER_CLASS correctly predicted samples
         defense_indices_final = []
         for label in unique_classes:
-            correct_indices = correct_indices_per_class[label]
+            positions = class_positions[label]
+            correct_indices = list(subset_indices[positions[correct_mask[positions]]])
             num_correct = len(correct_indices)
             if num_correct >= self.SAMPLES_PER_CLASS:
                 sampled = np.random.choice(correct_indices, self.SAMPLES_PER_CLASS, replace=False)
@@ -219,26 +196,48 @@ class TED(BackdoorDefense):
         # 11) Set up hooks for activation extraction
         self.hook_handles = []
         self.activations = {}
+        self.activation_storage = getattr(args, 'ted_storage', 'device')
+        self.activation_reducer = ActivationReducer(method=getattr(args, 'ted_reduction', 'none'),
+                                                    dim=getattr(args, 'ted_reduction_dim', None),
+                                                    seed=getattr(args, 'seed', 0))
+        self.activation_quantizer = ActivationQuantizer(
+            precision=getattr(args, 'ted_precision', 'float32'),
+            granularity=getattr(args, 'ted_precision_granularity', 'layer'))
         self.register_hooks()
 
         # 12) Additional intermediate variables and directory for saving visualizations
         self.Test_C = self.num_classes + 2
-        self.topological_representation = {}
-        self.candidate_ = {}
+        self.topological_representation = None
+        self.rank_indices = {}
+        self.rank_index_kind = getattr(args, 'ted_index', 'exact')
+        self.rank_index_kwargs = {'nlist': getattr(args, 'ted_nlist', 64), 'nprobe': getattr(args, 'ted_nprobe', 8),
+                                  'seed': getattr(args, 'seed', 0)}
         self.save_dir = f"TED/{self.dataset}/{self.poison_type}"
         os.makedirs(self.save_dir, exist_ok=True)
+        self.model_sha256 = None
+        self.activation_cache = ActivationCache(args.ted_cache_dir, max_mb=getattr(args, 'ted_cache_mb', None)) \
+            if getattr(args, 'ted_cache_dir', None) else None
 
     # ==============================
     #     HELPER FUNCTIONS
     # ==============================
+    def log(self, *args, **kwargs):
+        """
+        print(), silenced in headless mode (-ted_headless) where a run only emits its JSON result record.
+        """
+        if not self.headless:
+            print(*args, **kwargs)
+
     def register_hooks(self):
         """
         Register forward hooks for layers to extract activations.
         """
 
         def get_activation(name):
+            self.hooked_layers.append(name)
+
             def hook(model, input, output):
-                self.activations[name] = output.detach()
+                self.activations[name] = self.activation_reducer(name, output.detach())
 
             return hook
 
@@ -246,6 +245,7 @@ class TED(BackdoorDefense):
         for handle in self.hook_handles:
             handle.remove()
         self.hook_handles = []
+        self.hooked_layers = []
 
         net_children = self.model.modules()
         index = 0
@@ -289,7 +289,7 @@ class TED(BackdoorDefense):
     # ==============================
     def generate_poison_clean_sets(self):
         if self.poison_type == 'TaCT' or self.poison_type == 'SSDT':
-            print(self.poison_type)
+            self.log(self.poison_type)
 
             while self.poison_count < self.NUM_SAMPLES or self.clean_count < self.NUM_SAMPLES:
                 for batch_idx, (inputs, labels) in enumerate(self.test_loader):
@@ -410,7 +410,7 @@ class TED(BackdoorDefense):
 
                 self.poison_count += labels.size(0)
 
-        print(
+        self.log(
             f"Finished generate_poison_clean_sets. Clean_count = {self.clean_count}, Poison_count = {self.poison_count}"
         )
 
@@ -446,12 +446,12 @@ class TED(BackdoorDefense):
         # Create poison_loader
         poison_set = CustomDataset(bd_inputs_set, bd_labels_set)
         self.poison_loader = data.DataLoader(poison_set, batch_size=50, num_workers=0, shuffle=True)
-        print("Poison set size:", len(self.poison_loader))
+        self.log("Poison set size:", len(self.poison_loader))
 
         # Create clean_loader
         clean_set = CustomDataset(clean_inputs_set, clean_labels_set)
         self.clean_loader = data.DataLoader(clean_set, batch_size=50, num_workers=0, shuffle=True)
-        print("Clean set size:", len(self.clean_loader))
+        self.log("Clean set size:", len(self.clean_loader))
 
         # Remove temporary variables
         del bd_inputs_set, bd_labels_set, bd_pred_set
@@ -460,50 +460,154 @@ class TED(BackdoorDefense):
     # ==============================
     #       HOOK & MAIN TEST
     # ==============================
-    def fetch_activation(self, loader):
-        print("Starting fetch_activation")
-        self.model.eval()
+    def fit_activation_reducer(self, loader):
+        """
+        Stream `loader` through the hooks once to fit the PCA sketch of every hooked layer.
+        """
+        self.activation_reducer.start_fit()
+        with torch.no_grad():
+            for images, _ in loader:
+                self.model(images.to(self.device))
+                self.activations.clear()
+        self.activation_reducer.finish_fit()
 
-        all_h_label, pred_set = [], []
+    def fetch_activation(self, loader, tag='activations'):
+        """
+        Run `loader` through the hooked model once, writing every batch straight into per-layer buffers
+        preallocated from the shapes seen on the first batch (see `allocate_activation_buffer`).
+        """
+        self.log("Starting fetch_activation")
+        self.model.eval()
+        start_time = time.perf_counter()
+
+        cache_components = self.activation_cache_components(loader)
+        if cache_components is not None:
+            cached = self.activation_cache.load(cache_components)
+            if cached is not None:
+                return self.cached_activation(cached)
+        if any(self.activation_quantizer.needs_calibration(key) for key in self.hooked_layers):
+            # int8 scales come from the first (defense) activations of the layer
+            self.calibrate_quantizer(loader, self.model)
+
+        num_samples = len(loader.dataset)
+        all_h_label, pred_set = None, None
         activation_container = {}
+        offset = 0
 
-        for images, labels in loader:
-            print("Running the first batch to init hooks")
-            _ = self.model(images.to(self.device))
-            break
-        for key in self.activations:
-            activation_container[key] = []
-        self.activations.clear()
-
-        for batch_idx, (images, labels) in enumerate(loader, start=1):
-            print(f"Running batch {batch_idx} - Images shape: {images.shape}, Labels shape: {labels.shape}")
-            try:
-                output = self.model(images.to(self.device))
-            except Exception as e:
-                print(f"Error running model on batch {batch_idx}: {e}")
-                break
-            pred_set.append(torch.argmax(output, -1).to(self.device))
-
-            for key in self.activations:
-                h_batch = self.activations[key].view(images.shape[0], -1)
-                for h in h_batch:
-                    activation_container[key].append(h.to(self.device))
-
-            for label in labels:
-                all_h_label.append(label.to(self.device))
-            self.activations.clear()
-
-            if batch_idx % 10 == 0:
-                print(f"Processed {batch_idx} batches")
-
-        for key in activation_container:
-            activation_container[key] = torch.stack(activation_container[key])
-        all_h_label = torch.stack(all_h_label)
-        pred_set = torch.cat(pred_set)
-
-        print("Finished fetch_activation")
+        with torch.no_grad():
+            for batch_idx, (images, labels) in enumerate(loader, start=1):
+                try:
+                    output = self.model(images.to(self.device))
+                except Exception as e:
+                    print(f"Error running model on batch {batch_idx}: {e}")
+                    break
+                preds = torch.argmax(output, -1)
+
+                batch_size = images.shape[0]
+                if not activation_container:
+                    for key in self.activations:
+                        activation_container[key] = allocate_activation_buffer(
+                            num_samples, self.activations[key][0].numel(), storage=self.activation_storage,
+                            device=self.device, path=os.path.join(self.save_dir, 'activations', f'{tag}_{key}.npy'),
+                            dtype=self.activation_quantizer.buffer_dtype(key)
+                        )
+                    all_h_label = torch.empty(num_samples, dtype=torch.long, device=self.device)
+                    pred_set = torch.empty(num_samples, dtype=torch.long, device=self.device)
+
+                for key in self.activations:
+                    activation_container[key][offset:offset + batch_size].copy_(
+                        self.activation_quantizer(key, self.activations[key].reshape(batch_size, -1)),
+                        non_blocking=True
+                    )
+                all_h_label[offset:offset + batch_size] = torch.as_tensor(labels).to(self.device)
+                pred_set[offset:offset + batch_size] = preds
+                offset += batch_size
+                self.activations.clear()
+
+                if batch_idx % 10 == 0:
+                    self.log(f"Processed {batch_idx} batches")
+
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()  # wait for the non-blocking copies into pinned host buffers
+        if offset < num_samples:
+            for key in activation_container:
+                activation_container[key] = activation_container[key][:offset]
+            all_h_label, pred_set = all_h_label[:offset], pred_set[:offset]
+
+        size_mb = sum(h.numel() * h.element_size() for h in activation_container.values()) / 2 ** 20
+        self.log(f"Finished fetch_activation: {offset} samples, {len(activation_container)} layers, "
+              f"{size_mb:.1f} MB ({self.activation_storage}, {self.activation_quantizer.precision}) "
+              f"in {time.perf_counter() - start_time:.2f}s")
+        if cache_components is not None and offset > 0:
+            self.store_cached_activation(cache_components, all_h_label, activation_container, pred_set)
         return all_h_label, activation_container, pred_set
 
+    def calibrate_quantizer(self, loader, forward):
+        """
+        int8 scales of the hooked layers from a streaming max |x| pass over the first
+        ActivationQuantizer.calibration_samples samples of `loader` (the defense set). Nothing is stored, so
+        fetch_activation then quantizes every batch straight into int8 buffers.
+        """
+        seen = 0
+        with torch.no_grad():
+            for images, _ in loader:
+                forward(images.to(self.device))
+                for key, h in self.activations.items():
+                    self.activation_quantizer.observe(key, h.reshape(images.shape[0], -1))
+                self.activations.clear()
+                seen += images.shape[0]
+                if seen >= self.activation_quantizer.calibration_samples:
+                    break
+        self.activation_quantizer.finish_calibration()
+
+    def checkpoint_sha256(self):
+        if self.model_sha256 is None:
+            self.model_sha256 = state_sha256(self.model)
+        return self.model_sha256
+
+    def activation_cache_components(self, loader):
+        """
+        Key components of the activations of `loader` in the shared activation cache (-ted_cache_dir),
+        None when the cache is off.
+        """
+        if self.activation_cache is None:
+            return None
+        sketches = self.activation_reducer.sketches
+        scales = self.activation_quantizer.scales
+        return {
+            'checkpoint_sha256': self.checkpoint_sha256(),
+            'dataset': self.dataset,
+            'samples': dataset_signature(loader.dataset),
+            'layers': list(self.hooked_layers),
+            'reduction': [self.activation_reducer.method, self.activation_reducer.dim, self.activation_reducer.seed,
+                          state_sha256(sketches) if sketches else None],
+            'precision': [self.activation_quantizer.precision, self.activation_quantizer.granularity,
+                          state_sha256(scales) if scales else None],
+        }
+
+    def store_cached_activation(self, components, labels, activations, preds):
+        arrays = {'labels': labels, 'preds': preds}
+        arrays.update({'layer.' + key: h for key, h in activations.items()})
+        arrays.update({'scale.' + key: scale for key, scale in self.activation_quantizer.scales.items()
+                       if key in activations})
+        self.activation_cache.store(components, arrays)
+
+    def cached_activation(self, cached):
+        """
+        (labels, activations, preds) from a cache entry, restoring the int8 scales calibrated with it.
+        Activations stay memory-mapped unless they are kept on the device.
+        """
+        activations = {}
+        for name, array in cached.items():
+            if name.startswith('scale.') and self.activation_quantizer.needs_calibration(name[len('scale.'):]):
+                self.activation_quantizer.scales[name[len('scale.'):]] = array.clone()
+            elif name.startswith('layer.'):
+                activations[name[len('layer.'):]] = \
+                    array.to(self.device) if self.activation_storage == 'device' else array
+        activations = {key: activations[key] for key in self.hooked_layers if key in activations}
+        self.log(f"Loaded {len(activations)} layers of {cached['labels'].shape[0]} samples from the activation cache")
+        return cached['labels'].to(self.device), activations, cached['preds'].to(self.device)
+
     def calculate_accuracy(self, ori_labels, preds):
         """
         Compute classification accuracy given original labels and predictions.
@@ -519,6 +623,7 @@ class TED(BackdoorDefense):
         """
         Display a small grid of images with their predictions. Saves the figure to self.save_dir.
         """
+        import matplotlib.pyplot as plt
         num_images = len(images)
         if num_images == 0:
             return
@@ -544,50 +649,25 @@ class TED(BackdoorDefense):
         plt.savefig(save_path, dpi=300)
         plt.show()
 
-    def gather_activation_into_class(self, target, h):
-        """
-        Group activations by class index and store them for further analysis.
-        """
-        h_c_c = [0 for _ in range(self.Test_C)]
-        for c in range(self.Test_C):
-            idxs = (target == c).nonzero(as_tuple=True)[0]
-            if len(idxs) == 0:
-                continue
-            h_c = h[idxs, :]
-            h_c_c[c] = h_c
-        return h_c_c
-
-    def get_dis_sort(self, item, destinations):
-        """
-        Sort distances between a single item and all destinations, returning sorted indices.
-        """
-        item_ = item.reshape(1, item.shape[0])
-        dev = self.device
-        new_dis = pairwise_euclidean_distance(item_.to(dev), destinations.to(dev))
-        _, indices_individual = torch.sort(new_dis)
-        return indices_individual.to("cpu")
-
     def getDefenseRegion(self, final_prediction, h_defense_activation, processing_label, layer,
                          layer_test_region_individual):
         """
-        For each sample in the specified label, compute the region by distance ranking with defense samples.
+        For each sample in the specified label, compute the region by distance ranking with defense samples
+        and write it into group `processing_label` of the TopologicalRepresentation.
         """
-        if layer not in layer_test_region_individual:
-            layer_test_region_individual[layer] = {}
-        layer_test_region_individual[layer][processing_label] = []
-
-        self.candidate_[layer] = self.gather_activation_into_class(final_prediction, h_defense_activation)
-
-        if np.ndim(self.candidate_[layer][processing_label]) == 0:
-            print("No sample in this class for label =", processing_label)
-        else:
-            for index, item in enumerate(self.candidate_[layer][processing_label]):
-                ranking_array = self.get_dis_sort(item, h_defense_activation)[0]
-                ranking_array = ranking_array[1:]
-                r_ = [final_prediction[i] for i in ranking_array]
-                if processing_label in r_:
-                    itemindex = r_.index(processing_label)
-                    layer_test_region_individual[layer][processing_label].append(itemindex)
+        candidate_indices = torch.where(final_prediction == processing_label)[0]
+        if candidate_indices.numel() == 0:
+            self.log("No sample in this class for label =", processing_label)
+
+        # Each defense sample is excluded from its own ranking by index
+        h_defense_activation = self.activation_quantizer.distance_view(layer, h_defense_activation)
+        _, rank, nn_index = first_same_label_rank(
+            h_defense_activation[candidate_indices], final_prediction[candidate_indices],
+            h_defense_activation, final_prediction,
+            self_indices=candidate_indices, device=self.device
+        )
+        found = nn_index >= 0
+        layer_test_region_individual.write(processing_label, layer, rank[found], candidate_indices.cpu()[found])
 
         return layer_test_region_individual
 
@@ -595,22 +675,21 @@ class TED(BackdoorDefense):
                                h_defense_prediction, h_defense_activation,
                                layer, layer_test_region_individual):
         """
-        Compute the distance-based region for a new label, comparing to the defense activations.
+        Compute the distance-based region for a new label, comparing to the defense activations,
+        and write it into group `new_temp_label` of the TopologicalRepresentation.
         """
-        if layer not in layer_test_region_individual:
-            layer_test_region_individual[layer] = {}
-        layer_test_region_individual[layer][new_temp_label] = []
-
-        candidate__ = self.gather_activation_into_class(new_prediction, new_activation)
-        labels = torch.unique(new_prediction)
-
-        for processing_label in labels:
-            for index, item in enumerate(candidate__[processing_label]):
-                ranking_array = self.get_dis_sort(item, h_defense_activation)[0]
-                r_ = [h_defense_prediction[i] for i in ranking_array]
-                if processing_label in r_:
-                    itemindex = r_.index(processing_label)
-                    layer_test_region_individual[layer][new_temp_label].append(itemindex)
+        # Keep the label-grouped order of the original per-label loop
+        if layer not in self.rank_indices:
+            self.rank_indices[layer] = build_rank_index(self.rank_index_kind,
+                                                        self.activation_quantizer.distance_view(layer,
+                                                                                                h_defense_activation),
+                                                        h_defense_prediction, device=self.device,
+                                                        **self.rank_index_kwargs)
+        order = torch.sort(new_prediction, stable=True)[1]
+        _, rank, nn_index = self.rank_indices[layer].query(
+            self.activation_quantizer.distance_view(layer, new_activation[order]), new_prediction[order])
+        found = nn_index >= 0
+        layer_test_region_individual.write(new_temp_label, layer, rank[found], order.cpu()[found])
 
         return layer_test_region_individual
 
@@ -623,13 +702,13 @@ class TED(BackdoorDefense):
           4) Compute topological representations.
           5) (Optional) Visualization and outlier detection steps.
         """
-        print('STEP 1')
+        self.log('STEP 1')
         self.generate_poison_clean_sets()
 
-        print('STEP 2')
+        self.log('STEP 2')
         self.create_poison_clean_dataloaders()
 
-        print('STEP 3')
+        self.log('STEP 3')
         images_to_display = []
         predictions_to_display = []
 
@@ -637,6 +716,8 @@ class TED(BackdoorDefense):
             (self.poison_loader, 3, "Poison Image"),
             (self.clean_loader, 9, "Clean Image")
         ]
+        if self.headless:
+            pairs = []
         for loader, limit, prefix in pairs:
             count = 0
             for inputs, labels in loader:
@@ -656,15 +737,17 @@ class TED(BackdoorDefense):
             predictions_to_display.clear()
 
 
-        print('STEP 4')
+        self.log('STEP 4')
 
+        if self.activation_reducer.method == 'pca':
+            self.fit_activation_reducer(self.defense_loader)
         self.h_defense_ori_labels, self.h_defense_activations, self.h_defense_preds = self.fetch_activation(
-            self.defense_loader)
+            self.defense_loader, tag='defense')
         self.h_poison_ori_labels, self.h_poison_activations, self.h_poison_preds = self.fetch_activation(
-            self.poison_loader)
-        self.h_clean_ori_labels, self.h_clean_activations, self.h_clean_preds = self.fetch_activation(self.clean_loader)
+            self.poison_loader, tag='poison')
+        self.h_clean_ori_labels, self.h_clean_activations, self.h_clean_preds = self.fetch_activation(self.clean_loader, tag='clean')
 
-        print('STEP 5')
+        self.log('STEP 5')
         accuracy_defense = self.calculate_accuracy(self.h_defense_ori_labels, self.h_defense_preds)
 
         poison_GT = torch.ones_like(self.h_poison_preds) * self.target
@@ -672,10 +755,13 @@ class TED(BackdoorDefense):
         total_poison = len(self.h_poison_preds)
         accuracy_poison = (correct_poison / total_poison) * 100
 
-        print(f"\nAccuracy on defense_loader (Clean): {accuracy_defense:.2f}%")
-        print(f"Accuracy on poison_loader (Poison) : {accuracy_poison:.2f}%")
+        self.log(f"\nAccuracy on defense_loader (Clean): {accuracy_defense:.2f}%")
+        self.log(f"Accuracy on poison_loader (Poison) : {accuracy_poison:.2f}%")
 
-        print('STEP 7')
+        self.log('STEP 7')
+        self.topological_representation = TopologicalRepresentation(
+            self.h_defense_activations.keys(), len(self.h_defense_preds),
+            capacity=len(self.h_defense_preds) + len(self.h_poison_preds) + len(self.h_clean_preds))
         class_names = np.unique(self.h_defense_ori_labels.cpu().numpy())
         for index, label in enumerate(class_names):
             for layer in self.h_defense_activations:
@@ -686,9 +772,9 @@ class TED(BackdoorDefense):
                     layer=layer,
                     layer_test_region_individual=self.topological_representation
                 )
-                topo_rep_array = np.array(self.topological_representation[layer][label])
-                print(f"Topological Representation Label [{label}] & layer [{layer}]: {topo_rep_array}")
-                print(f"Mean: {np.mean(topo_rep_array)}\n")
+                topo_rep_array = self.topological_representation.column(label, layer)
+                self.log(f"Topological Representation Label [{label}] & layer [{layer}]: {topo_rep_array}")
+                self.log(f"Mean: {np.mean(topo_rep_array)}\n")
 
         for layer_ in self.h_poison_activations:
             self.topological_representation = self.getLayerRegionDistance(
@@ -700,10 +786,10 @@ class TED(BackdoorDefense):
                 layer=layer_,
                 layer_test_region_individual=self.topological_representation
             )
-            topo_rep_array_poison = np.array(self.topological_representation[layer_][self.POISON_TEMP_LABEL])
-            print(
+            topo_rep_array_poison = self.topological_representation.column(self.POISON_TEMP_LABEL, layer_)
+            self.log(
                 f"Topological Representation Label [{self.POISON_TEMP_LABEL}] & layer [{layer_}]: {topo_rep_array_poison}")
-            print(f"Mean: {np.mean(topo_rep_array_poison)}\n")
+            self.log(f"Mean: {np.mean(topo_rep_array_poison)}\n")
 
         for layer_ in self.h_clean_activations:
             self.topological_representation = self.getLayerRegionDistance(
@@ -715,62 +801,37 @@ class TED(BackdoorDefense):
                 layer=layer_,
                 layer_test_region_individual=self.topological_representation
             )
-            topo_rep_array_clean = np.array(self.topological_representation[layer_][self.CLEAN_TEMP_LABEL])
-            print(
+            topo_rep_array_clean = self.topological_representation.column(self.CLEAN_TEMP_LABEL, layer_)
+            self.log(
                 f"Topological Representation Label [{self.CLEAN_TEMP_LABEL}] - layer [{layer_}]: {topo_rep_array_clean}")
-            print(f"Mean: {np.mean(topo_rep_array_clean)}\n")
-
-        print('STEP 8')
-
-        def aggregate_by_all_layers(output_label):
-            inputs_container = []
-            first_key = list(self.topological_representation.keys())[0]
-            labels_container = np.repeat(output_label,
-                                         len(self.topological_representation[first_key][output_label]))
-            for l in self.topological_representation.keys():
-                temp = []
-                for j in range(len(self.topological_representation[l][output_label])):
-                    temp.append(self.topological_representation[l][output_label][j])
-                if temp:
-                    inputs_container.append(np.array(temp))
-            return np.array(inputs_container).T, np.array(labels_container)
-
-        inputs_all_benign = []
-        labels_all_benign = []
-        inputs_all_unknown = []
-        labels_all_unknown = []
-
-        first_key = list(self.topological_representation.keys())[0]
-        class_name = list(self.topological_representation[first_key])
-
-        for inx in class_name:
-            inputs, labels = aggregate_by_all_layers(output_label=inx)
-            if inx != self.POISON_TEMP_LABEL and inx != self.CLEAN_TEMP_LABEL:
-                inputs_all_benign.append(np.array(inputs))
-                labels_all_benign.append(np.array(labels))
-            else:
-                inputs_all_unknown.append(np.array(inputs))
-                labels_all_unknown.append(np.array(labels))
+            self.log(f"Mean: {np.mean(topo_rep_array_clean)}\n")
 
-        inputs_all_benign = np.concatenate(inputs_all_benign)
-        labels_all_benign = np.concatenate(labels_all_benign)
+        self.log('STEP 8')
 
-        inputs_all_unknown = np.concatenate(inputs_all_unknown)
-        labels_all_unknown = np.concatenate(labels_all_unknown)
+        # Benign groups were allocated first, one label after the other, so this is a view of the rank matrix
+        unknown_groups = [self.POISON_TEMP_LABEL, self.CLEAN_TEMP_LABEL]
+        benign_groups = [group for group in self.topological_representation.groups if group not in unknown_groups]
+        inputs_all_benign = self.topological_representation.matrix(benign_groups)
+        labels_all_benign = self.topological_representation.group_labels(benign_groups)
+        inputs_all_unknown = self.topological_representation.matrix(unknown_groups)
+        labels_all_unknown = self.topological_representation.group_labels(unknown_groups)
+        self.topological_representation.save(os.path.join(self.save_dir, 'topological_representation'))
 
-        print('STEP 9')
-        pca_t = sklearn_PCA(n_components=2)
-        pca_fit = pca_t.fit(inputs_all_benign)
+        self.log('STEP 9')
+        if not self.headless:
+            import plotly.express as px
+            pca_t = sklearn_PCA(n_components=2)
+            pca_fit = pca_t.fit(inputs_all_benign)
 
-        benign_trajectories = pca_fit.transform(inputs_all_benign)
-        trajectories = pca_fit.transform(np.concatenate((inputs_all_unknown, inputs_all_benign), axis=0))
+            benign_trajectories = pca_fit.transform(inputs_all_benign)
+            trajectories = pca_fit.transform(np.concatenate((inputs_all_unknown, inputs_all_benign), axis=0))
 
-        df_classes = pd.DataFrame(np.concatenate((labels_all_unknown, labels_all_benign), axis=0))
+            df_classes = pd.DataFrame(np.concatenate((labels_all_unknown, labels_all_benign), axis=0))
 
-        fig_ = px.scatter(
-            trajectories, x=0, y=1, color=df_classes[0].astype(str), labels={'color': 'digit'},
-            color_discrete_sequence=px.colors.qualitative.Dark24,
-        )
+            fig_ = px.scatter(
+                trajectories, x=0, y=1, color=df_classes[0].astype(str), labels={'color': 'digit'},
+                color_discrete_sequence=px.colors.qualitative.Dark24,
+            )
 
         pca = PCA(contamination=0.1, n_components=2)
         pca.fit(inputs_all_benign)
@@ -782,9 +843,9 @@ class TED(BackdoorDefense):
         prediction_labels = labels_all_unknown[prediction_mask]
         label_counts = Counter(prediction_labels)
 
-        print("\n----------- DETECTION RESULTS -----------")
+        self.log("\n----------- DETECTION RESULTS -----------")
         for label, count in label_counts.items():
-            print(f'Label {label}: {count}')
+            self.log(f'Label {label}: {count}')
 
         is_poison_mask = (labels_all_unknown == self.POISON_TEMP_LABEL).astype(int)
         fpr, tpr, thresholds = metrics.roc_curve(is_poison_mask, y_test_scores, pos_label=1)
@@ -795,22 +856,29 @@ class TED(BackdoorDefense):
         FPR = fp / (fp + tn) if (fp + tn) > 0 else 0
         f1 = metrics.f1_score(is_poison_mask, y_test_pred)
 
-        print("TPR: {:.2f}%".format(TPR * 100))
-        print("FPR: {:.2f}%".format(FPR * 100))
-        print("AUC: {:.4f}".format(auc_val))
-        print(f"F1 score: {f1:.4f}")
-        print("True Positives (TP):", tp)
-        print("False Positives (FP):", fp)
-        print("True Negatives (TN):", tn)
-        print("False Negatives (FN):", fn)
-
-        print("\n[INFO] TED run completed.")
+        self.log("TPR: {:.2f}%".format(TPR * 100))
+        self.log("FPR: {:.2f}%".format(FPR * 100))
+        self.log("AUC: {:.4f}".format(auc_val))
+        self.log(f"F1 score: {f1:.4f}")
+        self.log("True Positives (TP):", tp)
+        self.log("False Positives (FP):", fp)
+        self.log("True Negatives (TN):", tn)
+        self.log("False Negatives (FN):", fn)
+
+        self.log("\n[INFO] TED run completed.")
+        results = {
+            'TPR': float(TPR), 'FPR': float(FPR), 'AUC': float(auc_val), 'F1': float(f1),
+            'TP': int(tp), 'FP': int(fp), 'TN': int(tn), 'FN': int(fn),
+        }
+        if self.headless:
+            print(json.dumps({'dataset': self.dataset, 'poison_type': self.poison_type, **results}))
+        return results
 
     def detect(self):
         """
         Entry point for the detection procedure.
         """
-        self.test()
+        return self.test()
 
     def __del__(self):
         for h in self.hook_handles:
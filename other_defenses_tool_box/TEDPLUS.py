@@ -3,42 +3,40 @@
 
 from torchvision.utils import save_image
 import os
+import json
 import random
 from collections import Counter, defaultdict
 from tqdm import tqdm
 import numpy as np
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 import pickle
 from sklearn import metrics
 from sklearn.decomposition import PCA as sklearn_PCA
 from sklearn.metrics import confusion_matrix
 from sklearn.model_selection import train_test_split
 from pyod.models.pca import PCA
-from umap import UMAP
 from numpy.random import choice
 import torch
 torch.cuda.empty_cache()
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.data as data
-from torchmetrics.functional import pairwise_euclidean_distance
-import plotly.express as px
 import config
 from utils import supervisor, tools
+from utils.activation_cache import ActivationCache, dataset_signature
 from utils.resnet import ResNet18, ResNet34
 from utils.supervisor import get_transforms
 from other_defenses_tool_box.tools import generate_dataloader
 from other_defenses_tool_box.backdoor_defense import BackdoorDefense
+from other_defenses_tool_box.TED_utils import DefenseGeometry, allocate_activation_buffer, ActivationReducer, \
+    TopologicalRepresentation, LayerCascade, RankThreshold, select_layers, state_sha256, truncate_after, \
+    forward_flops, ActivationQuantizer, defense_group_ranks, query_group_ranks, rank_layers, defense_layer, \
+    query_layer, StageProfiler, distance_matrix, RankResampler
 from networks.models import Generator, NetC_MNIST
 from defense_dataloader import get_dataset, get_dataloader
-import seaborn as sns
 import math
-import seaborn as sns
-from matplotlib.lines import Line2D
 import time
-import matplotlib.font_manager as fm
 
 # ------------------------------
 # Seed settings for reproducibility
@@ -57,20 +55,28 @@ if torch.cuda.is_available():
 
 # ------------------------------
 
+# Stages whose time is reported as the detection (inference) time
+INFERENCE_STAGES = ['capture/poison', 'capture/clean', 'rank/query/', 'outlier/']
+
+# Bump whenever the layout of the artifacts written by TEDPLUS.save() changes
+TED_ARTIFACT_VERSION = 3
+
+
 class TEDPLUS(BackdoorDefense):
     def __init__(self, args):
         super().__init__(args)  # Call the constructor of the parent class, BackdoorDefense
         self.args = args
+        self.headless = getattr(args, 'ted_headless', False)
 
         # 1) Model configuration
         self.model.eval()
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.model.to(self.device)
-        print(self.poison_type)
+        self.log(self.poison_type)
 
         # 2) Define the backdoor target class
         self.target = self.target_class
-        print(f"Target Class: {self.target}")
+        self.log(f"Target Class: {self.target}")
 
         # 3) Load the full test set
         if self.poison_type == 'SSDT':
@@ -89,7 +95,7 @@ class TEDPLUS(BackdoorDefense):
             )
             self.testset = self.test_loader.dataset
 
-        print(f"Number of samples in full test set: {len(self.testset)}")
+        self.log(f"Number of samples in full test set: {len(self.testset)}")
 
         # 4) Split the full test set into 10% (defense/validation) and 90% (final test)
         all_indices = np.arange(len(self.testset))
@@ -103,17 +109,8 @@ class TEDPLUS(BackdoorDefense):
         self.defense_loader = data.DataLoader(self.defense_subset, batch_size=50, shuffle=True, num_workers=0)
         self.test_loader = data.DataLoader(self.testset, batch_size=50, shuffle=False, num_workers=0)
 
-        print(f"Number of samples in defense set (90% of test): {len(self.defense_subset)}")
-        print(f"Number of samples in final test set (10% of test): {len(self.testset)}")
-
-        # 5) Determine unique classes by scanning the defense set
-        all_labels = []
-        for _, labels in self.defense_loader:
-            all_labels.extend(labels.tolist())
-        unique_classes = set(all_labels)
-        num_classes = len(unique_classes)
-        print(f"Number of unique classes (from defense set): {num_classes}")
-        print(f"Expected number of classes from args: {self.num_classes}")
+        self.log(f"Number of samples in defense set (90% of test): {len(self.defense_subset)}")
+        self.log(f"Number of samples in final test set (10% of test): {len(self.testset)}")
 
         # 6) Set defense training parameters
         self.SAMPLES_PER_CLASS = args.validation_per_class
@@ -124,88 +121,9 @@ class TEDPLUS(BackdoorDefense):
         # 7) Define number of neighbors and samples for constructing poison/clean sets
         self.NUM_SAMPLES = args.num_test_samples
 
-        # 8) Create defense subset from the defense set using only correctly predicted samples
-        # Use the defense_subset (10% of test) instead of the training set
-        defense_set = self.defense_subset  # Alias for clarity
-        if isinstance(defense_set, data.Subset):
-            underlying_dataset = defense_set.dataset
-            subset_indices = defense_set.indices
-        else:
-            underlying_dataset = defense_set
-            subset_indices = np.arange(len(defense_set))
-
-        from collections import defaultdict
-        label_to_indices = defaultdict(list)
-        for idx in subset_indices:
-            try:
-                _, label = underlying_dataset[idx]
-                label_to_indices[label].append(idx)
-            except FileNotFoundError:
-                print(f"Warning: File {idx}.png does not exist.")
-
-        # Dictionary to store correctly predicted indices per class
-        correct_indices_per_class = defaultdict(list)
-        # Create a DataLoader for the defense set without shuffling to maintain index order
-        defense_loader_no_shuffle = data.DataLoader(defense_set, batch_size=50, num_workers=0, shuffle=False)
-        current_idx = 0
-
-        # Evaluate the defense set to collect correctly predicted samples
-        with torch.no_grad():
-            for inputs, labels in tqdm(defense_loader_no_shuffle,
-                                       desc="Evaluating defense set for correct predictions"):
-                inputs, labels = inputs.to(self.device), labels.to(self.device)
-                outputs = self.model(inputs)
-                preds = torch.argmax(outputs, dim=1)
-                correct_mask = preds == labels
-
-                # Loop over batch and record correct sample indices
-                for i in range(len(labels)):
-                    if correct_mask[i].item():
-                        if isinstance(defense_set, data.Subset):
-                            sample_idx = subset_indices[current_idx]
-                        else:
-                            sample_idx = current_idx
-                        label = labels[i].item()
-                        correct_indices_per_class[label].append(sample_idx)
-                    current_idx += 1
-
-        # For each class, sample SAMPLES_PER_CLASS correctly predicted samples
-        # FIX HERE (1) to remove 2 classes and CREATE self.all_classes (without 2 labels)
-        defense_indices_final = []
-        self.all_labels = []
-        for label in range(self.num_classes - self.NUM_MISSING_CLASS):
-            self.all_labels.append(label)
-            correct_indices = correct_indices_per_class[label]
-            num_correct = len(correct_indices)
-            if num_correct >= self.SAMPLES_PER_CLASS:
-                sampled = np.random.choice(correct_indices, self.SAMPLES_PER_CLASS, replace=False)
-            else:
-                sampled = np.random.choice(correct_indices, self.SAMPLES_PER_CLASS, replace=True)
-                print(f"Warning: Not enough correctly predicted samples for class {label}. Sampling with replacement.")
-            defense_indices_final.extend(sampled)
-
-        # Create a new defense subset using the sampled indices and update the defense_loader
-        final_defense_subset = data.Subset(underlying_dataset, defense_indices_final)
-        self.defense_loader = data.DataLoader(final_defense_subset, batch_size=50, shuffle=True, num_workers=0)
-
-        # 9) Optionally, filter the defense set further to retain only correctly predicted samples
-        h_benign_preds = []
-        h_benign_ori_labels = []
-        with torch.no_grad():
-            for inputs, labels in self.defense_loader:
-                inputs, labels = inputs.to(self.device), labels.to(self.device)
-                outputs = self.model(inputs)
-                preds = torch.argmax(outputs, dim=1)
-                h_benign_preds.extend(preds.cpu().numpy())
-                h_benign_ori_labels.extend(labels.cpu().numpy())
-        h_benign_preds = np.array(h_benign_preds)
-        h_benign_ori_labels = np.array(h_benign_ori_labels)
-        benign_mask = h_benign_ori_labels == h_benign_preds
-        benign_indices = np.array(defense_indices_final)[benign_mask]
-        if len(benign_indices) > self.DEFENSE_TRAIN_SIZE:
-            benign_indices = np.random.choice(benign_indices, self.DEFENSE_TRAIN_SIZE, replace=False)
-        final_defense_subset = data.Subset(underlying_dataset, benign_indices)
-        self.defense_loader = data.DataLoader(final_defense_subset, batch_size=50, shuffle=True, num_workers=0)
+        # 8-9) The defense set itself is built lazily by build_defense_set(), so that a detector restored
+        # with load() never touches the defense data
+        self.defense_built = False
 
         # 10) Define temporary labels for Poison and Clean samples
         self.POISON_TEMP_LABEL = "Poison"
@@ -227,54 +145,183 @@ class TEDPLUS(BackdoorDefense):
 
         # 11) Set up hooks for activation extraction
         self.hook_handles = []
+        self.hooked_layers = []
         self.activations = {}
+        self.activation_storage = getattr(args, 'ted_storage', 'device')
+        self.activation_reducer = ActivationReducer(method=getattr(args, 'ted_reduction', 'none'),
+                                                    dim=getattr(args, 'ted_reduction_dim', None),
+                                                    seed=getattr(args, 'seed', 0))
+        self.activation_quantizer = ActivationQuantizer(
+            precision=getattr(args, 'ted_precision', 'float32'),
+            granularity=getattr(args, 'ted_precision_granularity', 'layer'))
         self.register_hooks()
 
         # 12) Additional intermediate variables and directory for saving visualizations
         self.Test_C = self.num_classes + 2
-        self.topological_representation = {}
-        self.candidate_ = {}
+        self.topological_representation = None
+        self.defense_geometry = {}
+        self.rank_index_kind = getattr(args, 'ted_index', 'exact')
+        self.rank_index_kwargs = {'nlist': getattr(args, 'ted_nlist', 64), 'nprobe': getattr(args, 'ted_nprobe', 8),
+                                  'seed': getattr(args, 'seed', 0)}
         self.save_dir = f"TED/{self.dataset}/{self.poison_type}"
         os.makedirs(self.save_dir, exist_ok=True)
+        self.model_sha256 = None
+        self.score_chunk_size = getattr(args, 'ted_score_chunk', 256)
+        self.generation_batch_size = getattr(args, 'ted_generation_batch', 256)
+        self.cascade_order = getattr(args, 'ted_cascade_order', None)
+        self.cascade_margin = getattr(args, 'ted_cascade_margin', 1.0)
+        self.cascade_tolerance = getattr(args, 'ted_cascade_tolerance', 0.01)
+        self.cascade = None
+        self.layer_budget_mflops = getattr(args, 'ted_layer_budget_mflops', None)
+        self.layer_budget_mb = getattr(args, 'ted_layer_budget_mb', None)
+        self.layer_selection = None
+        self.truncate_forward = getattr(args, 'ted_truncate', False)
+        self.truncated_models = {}
+        self.workers = getattr(args, 'ted_workers', 1)
+        self.profiler = StageProfiler(trace=getattr(args, 'ted_profile_trace', None), trace_dir=self.save_dir)
+        self.activation_cache = ActivationCache(args.ted_cache_dir, max_mb=getattr(args, 'ted_cache_mb', None)) \
+            if getattr(args, 'ted_cache_dir', None) else None
+        self.poison_logits = self.clean_logits = None
 
     # ==============================
     #     HELPER FUNCTIONS
     # ==============================
-    def register_hooks(self):
+    def log(self, *args, **kwargs):
+        """
+        print(), silenced in headless mode (-ted_headless) where a run only emits its JSON result record.
+        """
+        if not self.headless:
+            print(*args, **kwargs)
+
+    def register_hooks(self, layers=None):
         """
         Register forward hooks for layers to extract activations.
+        Every candidate hook point is named in self.hook_points; when `layers` is given, only those are hooked.
         """
         def get_activation(name):
+            self.hooked_layers.append(name)
+
             def hook(model, input, output):
-                self.activations[name] = output.detach()
+                self.activations[name] = self.activation_reducer(name, output.detach())
 
             return hook
 
+        def hook_point(child, name):
+            self.hook_points.append(name)
+            self.hook_modules[name] = child
+            if layers is None or name in layers:
+                self.hook_handles.append(child.register_forward_hook(get_activation(name)))
+
         # Remove previous hooks if any
         for handle in self.hook_handles:
             handle.remove()
         self.hook_handles = []
+        self.hooked_layers = []
+        self.hook_points = []
+        self.hook_modules = {}
 
         net_children = self.model.modules()
         index = 0
         for child in net_children:
             # Register hooks for specific layers
             if isinstance(child, nn.Conv2d) and child.kernel_size != (1, 1):
-                self.hook_handles.append(
-                    child.register_forward_hook(get_activation("Conv2d_" + str(index)))
-                )
+                hook_point(child, "Conv2d_" + str(index))
                 index += 1
             if isinstance(child, nn.ReLU):
-                self.hook_handles.append(
-                    child.register_forward_hook(get_activation("Relu_" + str(index)))
-                )
+                hook_point(child, "Relu_" + str(index))
                 index += 1
             if isinstance(child, nn.Linear):
-                self.hook_handles.append(
-                    child.register_forward_hook(get_activation("Linear_" + str(index)))
-                )
+                hook_point(child, "Linear_" + str(index))
                 index += 1
 
+    def truncated_model(self):
+        """
+        The model cut right after the deepest hooked layer (see truncate_after), cached per set of hooked
+        layers. None when -ted_truncate is off or the model cannot be traced; callers then run the full model.
+        """
+        if not self.truncate_forward:
+            return None
+        key = tuple(self.hooked_layers)
+        if key not in self.truncated_models:
+            model = self.model.module if isinstance(self.model, nn.DataParallel) else self.model
+            self.truncated_models[key] = truncate_after(model, [self.hook_modules[name] for name in key])
+            if self.truncated_models[key] is None:
+                print("Warning: could not trace the model for a truncated forward pass, running the full model.")
+        return self.truncated_models[key]
+
+    def defense_logits(self):
+        """
+        Cached logits of the final defense set, in the order of self.defense_loader.dataset.
+        """
+        return torch.stack([self.inference_cache[int(idx)] for idx in self.defense_loader.dataset.indices])
+
+    def build_defense_set(self):
+        """
+        Sample SAMPLES_PER_CLASS correctly predicted defense samples per kept class into self.defense_loader
+        and set self.all_labels. Done once, on the first test() / fit().
+        Labels are read from the dataset's label storage and the model runs exactly once per defense sample;
+        its logits are kept in self.inference_cache, keyed by dataset index.
+        """
+        if self.defense_built:
+            return
+        start_time = time.perf_counter()
+
+        # 5) Determine unique classes from the labels of the defense set (no image is decoded)
+        defense_set = self.defense_subset
+        if isinstance(defense_set, data.Subset):
+            underlying_dataset = defense_set.dataset
+            subset_indices = np.asarray(defense_set.indices)
+        else:
+            underlying_dataset = defense_set
+            subset_indices = np.arange(len(defense_set))
+        subset_labels = tools.dataset_labels(defense_set)
+        class_positions = tools.indices_by_class(defense_set)
+        num_classes = len(class_positions)
+        self.log(f"Number of unique classes (from defense set): {num_classes}")
+        self.log(f"Expected number of classes from args: {self.num_classes}")
+
+        # 8) Create defense subset from the defense set using only correctly predicted samples
+        # One forward pass over the defense set, in index order; logits are cached by dataset index
+        defense_loader_no_shuffle = data.DataLoader(defense_set, batch_size=50, num_workers=0, shuffle=False)
+        logits = []
+        with torch.no_grad():
+            for inputs, _ in tqdm(defense_loader_no_shuffle, desc="Evaluating defense set for correct predictions",
+                                   disable=self.headless):
+                logits.append(self.model(inputs.to(self.device)).cpu())
+        logits = torch.cat(logits)
+        self.inference_cache = dict(zip(subset_indices.tolist(), logits))
+        correct_mask = logits.argmax(dim=1).numpy() == subset_labels
+
+        # For each class, sample SAMPLES_PER_CLASS correctly predicted samples
+        # FIX HERE (1) to remove 2 classes and CREATE self.all_classes (without 2 labels)
+        defense_indices_final = []
+        self.all_labels = []
+        for label in range(self.num_classes - self.NUM_MISSING_CLASS):
+            self.all_labels.append(label)
+            positions = class_positions.get(label, np.empty(0, dtype=np.int64))
+            correct_indices = list(subset_indices[positions[correct_mask[positions]]])
+            num_correct = len(correct_indices)
+            if num_correct >= self.SAMPLES_PER_CLASS:
+                sampled = np.random.choice(correct_indices, self.SAMPLES_PER_CLASS, replace=False)
+            else:
+                sampled = np.random.choice(correct_indices, self.SAMPLES_PER_CLASS, replace=True)
+                print(f"Warning: Not enough correctly predicted samples for class {label}. Sampling with replacement.")
+            defense_indices_final.extend(sampled)
+
+        # 9) Optionally, filter the defense set further to retain only correctly predicted samples
+        # (predictions come from the inference cache instead of a second forward pass)
+        label_of_index = dict(zip(subset_indices.tolist(), subset_labels.tolist()))
+        benign_mask = np.array([self.inference_cache[int(idx)].argmax().item() == label_of_index[int(idx)]
+                                for idx in defense_indices_final], dtype=bool)
+        benign_indices = np.array(defense_indices_final)[benign_mask]
+        if len(benign_indices) > self.DEFENSE_TRAIN_SIZE:
+            benign_indices = np.random.choice(benign_indices, self.DEFENSE_TRAIN_SIZE, replace=False)
+        final_defense_subset = data.Subset(underlying_dataset, benign_indices)
+        self.defense_loader = data.DataLoader(final_defense_subset, batch_size=50, shuffle=True, num_workers=0)
+        self.defense_built = True
+        self.log(f"Built defense set of {len(benign_indices)} samples in {time.perf_counter() - start_time:.2f}s "
+              f"({len(subset_indices)} images decoded, one forward pass)")
+
     def create_bd(self, inputs):
         """
         Create backdoor inputs for SSDT
@@ -296,87 +343,21 @@ class TEDPLUS(BackdoorDefense):
     #   CREATE POISON & CLEAN SETS
     # ==============================
     def generate_poison_clean_sets(self):
-        if self.poison_type == 'TaCT' or self.poison_type == 'SSDT':
-            print(self.poison_type)
-
-            while self.poison_count < self.NUM_SAMPLES or self.clean_count < self.NUM_SAMPLES:
-                for batch_idx, (inputs, labels) in enumerate(self.test_loader):
-                    inputs, labels = inputs.to(self.device), labels.to(self.device)
-
-                    if self.poison_count < self.NUM_SAMPLES:
-                        victim_indices = (labels == config.source_class)
-                        if victim_indices.sum().item() > 0:
-                            victim_inputs = inputs[victim_indices]
-                            victim_labels = labels[victim_indices]
-
-                            if self.poison_type == 'SSDT':
-                                bd_inputs = self.create_bd(victim_inputs)
-                            else:
-                                bd_inputs, _ = self.poison_transform.transform(
-                                    victim_inputs, victim_labels
-                                )
-
-                            preds_bd = torch.argmax(self.model(bd_inputs), dim=1)
-
-                            correct_pred_indices = (preds_bd == self.target)
-                            if correct_pred_indices.sum().item() > 0:
-                                final_poison = bd_inputs[correct_pred_indices]
-                                label_value = self.label_mapping[self.POISON_TEMP_LABEL]
-                                final_poison_targets = self.create_targets(
-                                    victim_labels[correct_pred_indices],
-                                    label_value
-                                )
-                                final_poison_preds = preds_bd[correct_pred_indices]
-
-                                self.temp_poison_inputs_set.append(final_poison.cpu())
-                                self.temp_poison_labels_set.append(final_poison_targets.cpu())
-                                self.temp_poison_pred_set.append(final_poison_preds.cpu())
-
-                                self.poison_count += final_poison.shape[0]
-
-                    if self.clean_count < self.NUM_SAMPLES:
-                        non_victim_indices = (labels != config.source_class)
-                        if non_victim_indices.sum().item() > 0:
-                            clean_inputs = inputs[non_victim_indices]
-                            clean_labels_ori = labels[non_victim_indices]
-                            preds_clean = torch.argmax(self.model(clean_inputs), dim=1)
-
-                            label_value = self.label_mapping[self.CLEAN_TEMP_LABEL]
-                            clean_targets = self.create_targets(
-                                clean_labels_ori, label_value
-                            )
-
-                            self.temp_clean_inputs_set.append(clean_inputs.cpu())
-                            self.temp_clean_labels_set.append(clean_targets.cpu())
-                            self.temp_clean_pred_set.append(preds_clean.cpu())
-                            self.clean_count += clean_inputs.shape[0]
-
-                    if self.poison_count >= self.NUM_SAMPLES and self.clean_count >= self.NUM_SAMPLES:
-                        break
-
-                if self.poison_count >= self.NUM_SAMPLES and self.clean_count >= self.NUM_SAMPLES:
-                    break
-
-            if self.poison_count > self.NUM_SAMPLES:
-                combined_inputs = torch.cat(self.temp_poison_inputs_set, dim=0)[:self.NUM_SAMPLES]
-                combined_labels = torch.cat(self.temp_poison_labels_set, dim=0)[:self.NUM_SAMPLES]
-                combined_preds = torch.cat(self.temp_poison_pred_set, dim=0)[:self.NUM_SAMPLES]
-                self.temp_poison_inputs_set = [combined_inputs]
-                self.temp_poison_labels_set = [combined_labels]
-                self.temp_poison_pred_set = [combined_preds]
-                self.poison_count = self.NUM_SAMPLES
-
-            if self.clean_count > self.NUM_SAMPLES:
-                combined_inputs = torch.cat(self.temp_clean_inputs_set, dim=0)[:self.NUM_SAMPLES]
-                combined_labels = torch.cat(self.temp_clean_labels_set, dim=0)[:self.NUM_SAMPLES]
-                combined_preds = torch.cat(self.temp_clean_pred_set, dim=0)[:self.NUM_SAMPLES]
-                self.temp_clean_inputs_set = [combined_inputs]
-                self.temp_clean_labels_set = [combined_labels]
-                self.temp_clean_pred_set = [combined_preds]
-                self.clean_count = self.NUM_SAMPLES
-
-            torch.cuda.empty_cache()
-
+        """
+        Build the Poison and Clean inputs in a single streaming pass, in batches of generation_batch_size.
+          - TaCT / SSDT: source-class samples are poisoned and kept when the model predicts the target,
+            the other samples are kept as Clean, until NUM_SAMPLES of each are collected. The test split is
+            swept at most once; a RuntimeError is raised if it cannot supply enough samples.
+          - Other attacks: NUM_SAMPLES random test samples are kept as Clean and, poisoned, as Poison.
+        The clean and poisoned inputs of a batch are concatenated and forwarded in chunks of
+        generation_batch_size, so peak activation memory stays that of one batch.
+        """
+        self.log(self.poison_type)
+        start_time = time.perf_counter()
+        targeted = self.poison_type == 'TaCT' or self.poison_type == 'SSDT'
+        if targeted:
+            num_poison = num_clean = self.NUM_SAMPLES
+            source_set = self.testset
         else:
             all_indices = np.arange(len(self.testset))
             if len(all_indices) < self.NUM_SAMPLES:
@@ -384,42 +365,72 @@ class TEDPLUS(BackdoorDefense):
                 chosen = all_indices
             else:
                 chosen = np.random.choice(all_indices, size=self.NUM_SAMPLES, replace=False)
+            num_poison = num_clean = len(chosen)
+            source_set = data.Subset(self.testset, chosen)
+        loader = data.DataLoader(source_set, batch_size=self.generation_batch_size, shuffle=False, num_workers=0)
 
-            clean_subset = data.Subset(self.testset, chosen)
-            clean_loader = data.DataLoader(clean_subset, batch_size=50, shuffle=False)
-
-            poison_subset = data.Subset(self.testset, chosen)
-            poison_loader = data.DataLoader(poison_subset, batch_size=50, shuffle=False)
-
-            for (inputs, labels) in clean_loader:
-                inputs, labels = inputs.to(self.device), labels.to(self.device)
-                label_value = self.label_mapping[self.CLEAN_TEMP_LABEL]
-                targets_clean = self.create_targets(labels, label_value)
-                preds = torch.argmax(self.model(inputs), dim=1)
-
-                self.temp_clean_inputs_set.append(inputs.cpu())
-                self.temp_clean_labels_set.append(targets_clean.cpu())
-                self.temp_clean_pred_set.append(preds.cpu())
-                # print(f'self.temp_clean_pred_set: {self.temp_clean_pred_set}')
-                self.clean_count += labels.size(0)
-
-            for (inputs, labels) in poison_loader:
+        self.poison_count, self.clean_count = 0, 0
+        poison_inputs = poison_logits = clean_inputs = clean_logits = None
+        with torch.no_grad():
+            for inputs, labels in loader:
                 inputs, labels = inputs.to(self.device), labels.to(self.device)
-                poisoned_inputs, poisoned_labels = self.poison_transform.transform(inputs, labels)
-                preds_bd = torch.argmax(self.model(poisoned_inputs), dim=1)
-
-                label_value = self.label_mapping[self.POISON_TEMP_LABEL]
-                targets_poison = self.create_targets(labels, label_value)
-
-                self.temp_poison_inputs_set.append(poisoned_inputs.cpu())
-                self.temp_poison_labels_set.append(targets_poison.cpu())
-                self.temp_poison_pred_set.append(preds_bd.cpu())
-
-                self.poison_count += labels.size(0)
-            torch.cuda.empty_cache()
+                if targeted:
+                    victim = labels == config.source_class
+                    batch_clean = inputs[~victim][:num_clean - self.clean_count]
+                    victim_inputs, victim_labels = (inputs[victim], labels[victim]) \
+                        if self.poison_count < num_poison else (inputs[:0], labels[:0])
+                else:
+                    batch_clean, victim_inputs, victim_labels = inputs, inputs, labels
+
+                if victim_inputs.shape[0] == 0:
+                    bd_inputs = victim_inputs
+                elif self.poison_type == 'SSDT':
+                    bd_inputs = self.create_bd(victim_inputs)
+                else:
+                    bd_inputs, _ = self.poison_transform.transform(victim_inputs, victim_labels)
+
+                combined = torch.cat([batch_clean, bd_inputs], dim=0)
+                chunks = combined.split(self.generation_batch_size) or (combined,)
+                logits = torch.cat([self.model(chunk) for chunk in chunks])
+                batch_clean_logits, bd_logits = logits[:batch_clean.shape[0]], logits[batch_clean.shape[0]:]
+                if targeted:
+                    success = torch.argmax(bd_logits, dim=1) == self.target
+                    bd_inputs = bd_inputs[success][:num_poison - self.poison_count]
+                    bd_logits = bd_logits[success][:num_poison - self.poison_count]
+
+                if poison_inputs is None:
+                    poison_inputs = torch.empty((num_poison,) + inputs.shape[1:], dtype=inputs.dtype)
+                    clean_inputs = torch.empty((num_clean,) + inputs.shape[1:], dtype=inputs.dtype)
+                    poison_logits = torch.empty((num_poison, logits.shape[1]), dtype=logits.dtype)
+                    clean_logits = torch.empty((num_clean, logits.shape[1]), dtype=logits.dtype)
+                poison_inputs[self.poison_count:self.poison_count + bd_inputs.shape[0]] = bd_inputs.cpu()
+                poison_logits[self.poison_count:self.poison_count + bd_inputs.shape[0]] = bd_logits.cpu()
+                clean_inputs[self.clean_count:self.clean_count + batch_clean.shape[0]] = batch_clean.cpu()
+                clean_logits[self.clean_count:self.clean_count + batch_clean.shape[0]] = batch_clean_logits.cpu()
+                self.poison_count += bd_inputs.shape[0]
+                self.clean_count += batch_clean.shape[0]
+
+                if self.poison_count >= num_poison and self.clean_count >= num_clean:
+                    break
 
-        print(
-            f"Finished generate_poison_clean_sets. Clean_count = {self.clean_count}, Poison_count = {self.poison_count}"
+        if self.poison_count < num_poison or self.clean_count < num_clean:
+            raise RuntimeError(
+                f"One pass over the {len(source_set)} test samples gave {self.poison_count} Poison "
+                f"(source class {config.source_class} predicted as target {self.target}) and {self.clean_count} "
+                f"Clean samples, {num_poison} of each are needed: lower -num_test_samples")
+
+        self.temp_poison_inputs_set = [poison_inputs]
+        self.temp_poison_labels_set = [torch.full((num_poison,), self.label_mapping[self.POISON_TEMP_LABEL])]
+        self.temp_poison_pred_set = [torch.argmax(poison_logits, dim=1)]
+        self.temp_clean_inputs_set = [clean_inputs]
+        self.temp_clean_labels_set = [torch.full((num_clean,), self.label_mapping[self.CLEAN_TEMP_LABEL])]
+        self.temp_clean_pred_set = [torch.argmax(clean_logits, dim=1)]
+        self.poison_logits, self.clean_logits = poison_logits, clean_logits
+        torch.cuda.empty_cache()
+
+        self.log(
+            f"Finished generate_poison_clean_sets. Clean_count = {self.clean_count}, Poison_count = {self.poison_count} "
+            f"in {time.perf_counter() - start_time:.2f}s"
         )
 
     def create_poison_clean_dataloaders(self):
@@ -454,13 +465,13 @@ class TEDPLUS(BackdoorDefense):
         # Create poison_loader
         poison_set = CustomDataset(bd_inputs_set, bd_labels_set)
         self.poison_loader = data.DataLoader(poison_set, batch_size=50, num_workers=0, shuffle=True)
-        print("Poison set size:", len(self.poison_loader))
-        print("Poison samples:", len(self.poison_loader.dataset))
+        self.log("Poison set size:", len(self.poison_loader))
+        self.log("Poison samples:", len(self.poison_loader.dataset))
         # Create clean_loader
         clean_set = CustomDataset(clean_inputs_set, clean_labels_set)
         self.clean_loader = data.DataLoader(clean_set, batch_size=50, num_workers=0, shuffle=True)
-        print("Clean set size:", len(self.clean_loader))
-        print("Clean samples:", len(self.clean_loader.dataset))
+        self.log("Clean set size:", len(self.clean_loader))
+        self.log("Clean samples:", len(self.clean_loader.dataset))
         # Remove temporary variables
         del bd_inputs_set, bd_labels_set, bd_pred_set
         del clean_inputs_set, clean_labels_set, clean_pred_set
@@ -468,58 +479,171 @@ class TEDPLUS(BackdoorDefense):
     # ==============================
     #       HOOK & MAIN TEST
     # ==============================
-    def fetch_activation(self, loader):
-        print("Starting fetch_activation")
-        self.model.eval()
+    def fit_activation_reducer(self, loader):
+        """
+        Stream `loader` through the hooks once to fit the PCA sketch of every hooked layer.
+        """
+        self.activation_reducer.start_fit()
+        with torch.no_grad():
+            for images, _ in loader:
+                self.model(images.to(self.device))
+                self.activations.clear()
+        self.activation_reducer.finish_fit()
 
-        all_h_label, pred_set = [], []
+    def fetch_activation(self, loader, tag='activations', logits=None):
+        """
+        Run `loader` through the hooked model once, writing every batch straight into per-layer buffers
+        preallocated from the shapes seen on the first batch (see `allocate_activation_buffer`).
+        With `logits` (cached, in the order of loader.dataset) and -ted_truncate, the dataset is read in order,
+        the forward pass stops after the deepest hooked layer and predictions come from `logits`.
+        """
+        self.log("Starting fetch_activation")
+        self.model.eval()
+        start_time = time.perf_counter()
+
+        cache_components = self.activation_cache_components(loader)
+        if cache_components is not None:
+            cached = self.activation_cache.load(cache_components)
+            if cached is not None:
+                return self.cached_activation(cached)
+
+        forward = self.model
+        truncated = self.truncated_model() if logits is not None else None
+        if truncated is not None:
+            forward = truncated
+            loader = data.DataLoader(loader.dataset, batch_size=loader.batch_size, shuffle=False, num_workers=0)
+        if any(self.activation_quantizer.needs_calibration(key) for key in self.hooked_layers):
+            # int8 scales come from the first (defense) activations of the layer
+            self.calibrate_quantizer(loader, forward)
+
+        num_samples = len(loader.dataset)
+        all_h_label, pred_set = None, None
         activation_container = {}
+        allowed_idx = torch.tensor(self.all_labels, device=self.device)
+        offset = 0
 
-        for images, labels in loader:
-            print("Running the first batch to init hooks")
-            _ = self.model(images.to(self.device))
-            break
-        for key in self.activations:
-            activation_container[key] = []
-        self.activations.clear()
+        with torch.no_grad():
+            for batch_idx, (images, labels) in enumerate(loader, start=1):
+                try:
+                    output = forward(images.to(self.device))
+                except Exception as e:
+                    print(f"Error running model on batch {batch_idx}: {e}")
+                    break
 
-        for batch_idx, (images, labels) in enumerate(loader, start=1):
-            print(f"Running batch {batch_idx} - Images shape: {images.shape}, Labels shape: {labels.shape}")
-            try:
-                output = self.model(images.to(self.device))
-            except Exception as e:
-                print(f"Error running model on batch {batch_idx}: {e}")
-                break
-
-            ########
-            probs = torch.softmax(output, dim=1)
-            allowed_idx = torch.tensor(self.all_labels, device=output.device)
-            allowed_probs = probs[:, allowed_idx]
-            _, idx_in_allowed = allowed_probs.max(dim=1)
-            preds = allowed_idx[idx_in_allowed]
-            pred_set.append(preds)
-            ########
-
-            for key in self.activations:
-                h_batch = self.activations[key].view(images.shape[0], -1)
-                for h in h_batch:
-                    activation_container[key].append(h.to(self.device))
-
-            for label in labels:
-                all_h_label.append(label.to(self.device))
-            self.activations.clear()
-
-            if batch_idx % 10 == 0:
-                print(f"Processed {batch_idx} batches")
-
-        for key in activation_container:
-            activation_container[key] = torch.stack(activation_container[key])
-        all_h_label = torch.stack(all_h_label)
-        pred_set = torch.cat(pred_set)
-
-        print("Finished fetch_activation")
+                batch_size = images.shape[0]
+                if truncated is not None:
+                    output = logits[offset:offset + batch_size].to(self.device)
+                preds = self.restricted_prediction(output, allowed_idx)
+                if not activation_container:
+                    for key in self.activations:
+                        activation_container[key] = allocate_activation_buffer(
+                            num_samples, self.activations[key][0].numel(), storage=self.activation_storage,
+                            device=self.device, path=os.path.join(self.save_dir, 'activations', f'{tag}_{key}.npy'),
+                            dtype=self.activation_quantizer.buffer_dtype(key)
+                        )
+                    all_h_label = torch.empty(num_samples, dtype=torch.long, device=self.device)
+                    pred_set = torch.empty(num_samples, dtype=torch.long, device=self.device)
+
+                for key in self.activations:
+                    activation_container[key][offset:offset + batch_size].copy_(
+                        self.activation_quantizer(key, self.activations[key].reshape(batch_size, -1)),
+                        non_blocking=True
+                    )
+                all_h_label[offset:offset + batch_size] = torch.as_tensor(labels).to(self.device)
+                pred_set[offset:offset + batch_size] = preds
+                offset += batch_size
+                self.activations.clear()
+
+                if batch_idx % 10 == 0:
+                    self.log(f"Processed {batch_idx} batches")
+
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()  # wait for the non-blocking copies into pinned host buffers
+        if offset < num_samples:
+            for key in activation_container:
+                activation_container[key] = activation_container[key][:offset]
+            all_h_label, pred_set = all_h_label[:offset], pred_set[:offset]
+
+        size_mb = sum(h.numel() * h.element_size() for h in activation_container.values()) / 2 ** 20
+        self.log(f"Finished fetch_activation: {offset} samples, {len(activation_container)} layers, "
+              f"{size_mb:.1f} MB ({self.activation_storage}, {self.activation_quantizer.precision}) "
+              f"in {time.perf_counter() - start_time:.2f}s"
+              + (" (truncated forward)" if truncated is not None else ""))
+        if cache_components is not None and offset > 0:
+            self.store_cached_activation(cache_components, all_h_label, activation_container, pred_set)
         return all_h_label, activation_container, pred_set
 
+    def calibrate_quantizer(self, loader, forward):
+        """
+        int8 scales of the hooked layers from a streaming max |x| pass over the first
+        ActivationQuantizer.calibration_samples samples of `loader` (the defense set). Nothing is stored, so
+        fetch_activation then quantizes every batch straight into int8 buffers.
+        """
+        seen = 0
+        with torch.no_grad():
+            for images, _ in loader:
+                forward(images.to(self.device))
+                for key, h in self.activations.items():
+                    self.activation_quantizer.observe(key, h.reshape(images.shape[0], -1))
+                self.activations.clear()
+                seen += images.shape[0]
+                if seen >= self.activation_quantizer.calibration_samples:
+                    break
+        self.activation_quantizer.finish_calibration()
+
+    def activation_cache_components(self, loader):
+        """
+        Key components of the activations of `loader` in the shared activation cache (-ted_cache_dir),
+        None when the cache is off.
+        """
+        if self.activation_cache is None:
+            return None
+        sketches = self.activation_reducer.sketches
+        scales = self.activation_quantizer.scales
+        return {
+            'checkpoint_sha256': self.checkpoint_sha256(),
+            'dataset': self.dataset,
+            'samples': dataset_signature(loader.dataset),
+            'layers': list(self.hooked_layers),
+            'reduction': [self.activation_reducer.method, self.activation_reducer.dim, self.activation_reducer.seed,
+                          state_sha256(sketches) if sketches else None],
+            'precision': [self.activation_quantizer.precision, self.activation_quantizer.granularity,
+                          state_sha256(scales) if scales else None],
+            'all_labels': [int(label) for label in self.all_labels],
+        }
+
+    def store_cached_activation(self, components, labels, activations, preds):
+        arrays = {'labels': labels, 'preds': preds}
+        arrays.update({'layer.' + key: h for key, h in activations.items()})
+        arrays.update({'scale.' + key: scale for key, scale in self.activation_quantizer.scales.items()
+                       if key in activations})
+        self.activation_cache.store(components, arrays)
+
+    def cached_activation(self, cached):
+        """
+        (labels, activations, preds) from a cache entry, restoring the int8 scales calibrated with it.
+        Activations stay memory-mapped unless they are kept on the device.
+        """
+        activations = {}
+        for name, array in cached.items():
+            if name.startswith('scale.') and self.activation_quantizer.needs_calibration(name[len('scale.'):]):
+                self.activation_quantizer.scales[name[len('scale.'):]] = array.clone()
+            elif name.startswith('layer.'):
+                activations[name[len('layer.'):]] = \
+                    array.to(self.device) if self.activation_storage == 'device' else array
+        activations = {key: activations[key] for key in self.hooked_layers if key in activations}
+        self.log(f"Loaded {len(activations)} layers of {cached['labels'].shape[0]} samples from the activation cache")
+        return cached['labels'].to(self.device), activations, cached['preds'].to(self.device)
+
+    @staticmethod
+    def restricted_prediction(output, allowed_idx):
+        """
+        Predicted class among the kept classes `allowed_idx` only.
+        """
+        probs = torch.softmax(output, dim=1)
+        _, idx_in_allowed = probs[:, allowed_idx].max(dim=1)
+        return allowed_idx[idx_in_allowed]
+
     def calculate_accuracy(self, ori_labels, preds):
         """
         Compute classification accuracy given original labels and predictions.
@@ -535,6 +659,7 @@ class TEDPLUS(BackdoorDefense):
         """
         Display a small grid of images with their predictions. Saves the figure to self.save_dir.
         """
+        import matplotlib.pyplot as plt
         num_images = len(images)
         if num_images == 0:
             return
@@ -560,92 +685,152 @@ class TEDPLUS(BackdoorDefense):
         plt.savefig(save_path, dpi=300)
         plt.show()
 
-    def gather_activation_into_class(self, target, h):
+    def get_defense_geometry(self, layer, h_defense_prediction, h_defense_activation):
         """
-        Group activations by class index and store them for further analysis.
+        Build (once per layer) the defense x defense geometry holding the per-sample ALPHA thresholds.
         """
-        h_c_c = [0 for _ in range(self.Test_C)]
-        for c in range(self.Test_C):
-            idxs = (target == c).nonzero(as_tuple=True)[0]
-            if len(idxs) == 0:
-                continue
-            h_c = h[idxs, :]
-            h_c_c[c] = h_c
-        return h_c_c
+        if layer not in self.defense_geometry:
+            self.defense_geometry[layer] = DefenseGeometry(
+                self.activation_quantizer.distance_view(layer, h_defense_activation), h_defense_prediction,
+                k=math.ceil(self.SAMPLES_PER_CLASS * self.ALPHA), device=self.device,
+                index=self.rank_index_kind, **self.rank_index_kwargs
+            )
+        return self.defense_geometry[layer]
+
+    def layer_costs(self):
+        """
+        Per-layer costs of a hooked layer, counted rather than timed so that a budget selects the same layers on
+        every run: MFLOPs per sample to rank a sample against the layer's defense activations (2 x defense samples
+        x stored activation dim) plus those of the forward pass up to the layer (capture, see forward_flops), and
+        MB of captured activations for the defense set.
+        """
+        inputs = self.defense_loader.dataset[0][0].unsqueeze(0).to(self.device)
+        capture = forward_flops(self.model, inputs,
+                                {layer: self.hook_modules[layer] for layer in self.h_defense_activations})
+        compute_costs, memory_costs = [], []
+        for layer, activations in self.h_defense_activations.items():
+            rank = 2.0 * activations.shape[0] * activations[0].numel()
+            compute_costs.append((rank + capture.get(layer, 0.0)) / 1e6)
+            memory_costs.append(activations.numel() * activations.element_size() / 2 ** 20)
+        return np.array(compute_costs), np.array(memory_costs)
+
+    def select_hook_layers(self):
+        """
+        Choose the hook layers worth keeping under -ted_layer_budget_mflops (rank + capture MFLOPs per sample) and/or
+        -ted_layer_budget_mb (defense activation memory) with select_layers(), from the benign ranks of the
+        defense set and the measured layer costs. The other layers are dropped and unhooked, and the selection
+        is kept in self.layer_selection (saved with the fitted detector).
+        """
+        layers = list(self.h_defense_activations.keys())
+        benign = TopologicalRepresentation(layers, max(self.DEFENSE_TRAIN_SIZE, len(self.h_defense_preds)),
+                                           capacity=len(self.h_defense_preds))
+        for label in np.unique(self.h_defense_ori_labels.cpu().numpy()):
+            for layer in layers:
+                benign = self.getDefenseRegion(self.h_defense_preds, self.h_defense_activations[layer], label,
+                                               layer, benign)
+        compute_costs, memory_costs = self.layer_costs()
+        selected, report = select_layers(benign.matrix(list(benign.groups)), self.DEFENSE_TRAIN_SIZE - 1,
+                                         compute_costs, memory_costs,
+                                         compute_budget=self.layer_budget_mflops, memory_budget=self.layer_budget_mb)
+        selected = [layers[column] for column in selected]
+
+        self.log("\n----------- LAYER SELECTION -----------")
+        for column, value, gain, kept in report:
+            self.log(f"{layers[column]:<14} value {value:.3f}  gain {'-' if gain is None else f'{gain:.3f}':>6}  "
+                  f"{compute_costs[column]:10.2f} MFLOPs/sample  {memory_costs[column]:8.1f} MB  "
+                  f"{'kept' if kept else ''}")
+        kept = [column for column, _, _, k in report if k]
+        self.log(f"Selected {len(selected)} of {len(layers)} layers: {compute_costs[kept].sum():.2f} MFLOPs/sample "
+              f"(of {compute_costs.sum():.2f}), {memory_costs[kept].sum():.1f} MB (of {memory_costs.sum():.1f})")
+
+        self.layer_selection = {'layers': selected, 'candidates': layers,
+                                'compute_costs': compute_costs.tolist(), 'memory_costs': memory_costs.tolist()}
+        self.h_defense_activations = {layer: self.h_defense_activations[layer] for layer in selected}
+        self.defense_geometry = {layer: self.defense_geometry[layer] for layer in selected}
+        self.register_hooks(selected)
+
+    def parallel_ranks(self):
+        """
+        Whether the per-layer ranks run in a process pool: -ted_workers > 1 on a CPU-only run.
+        """
+        if self.workers > 1 and self.device.type != 'cpu':
+            print(f"-ted_workers {self.workers} is ignored on {self.device}, layers are ranked in this process")
+        return self.workers > 1 and self.device.type == 'cpu'
 
-    def get_dis_sort(self, item, destinations):
-        item_ = item.reshape(1, item.shape[0])
-        dev = self.device
-        new_dis = pairwise_euclidean_distance(item_.to(dev), destinations.to(dev))  # shape: (1, destinations.size(0))
-        sorted_dis, indices_individual = torch.sort(new_dis.squeeze(0))  # sort theo chiều 1-D
-        return sorted_dis.to("cpu"), indices_individual.to("cpu")
+    def parallel_topological_representation(self, class_names, queries):
+        """
+        STEP 7 with the layers sharded over -ted_workers processes (see rank_layers), in two pool passes timed
+        like the serial loop: 'rank/defense/parallel' builds the DefenseGeometry (and rank index) of every layer
+        and ranks the defense groups, 'rank/query/parallel' ranks the `queries` groups
+        ({group: (activations per layer, predictions)}) against the geometries built by the first pass.
+        Activations are handed over in shared memory and the results are written back in layer order, so the
+        rank matrix matches the serial loop.
+        """
+        layers = list(self.h_defense_activations)
+        saturation = self.DEFENSE_TRAIN_SIZE - 1
+        start_time = time.perf_counter()
+        with self.profiler.stage('rank/defense/parallel'):
+            tasks = [{
+                'defense_activations': self.activation_quantizer.distance_view(layer,
+                                                                                self.h_defense_activations[layer]),
+                'defense_preds': self.h_defense_preds.cpu(),
+                'labels': list(class_names),
+                'k': math.ceil(self.SAMPLES_PER_CLASS * self.ALPHA),
+                'saturation': saturation,
+                'index': self.rank_index_kind,
+                'index_kwargs': self.rank_index_kwargs,
+                'chunk_size': 256,
+            } for layer in layers]
+            results = rank_layers(tasks, workers=self.workers, function=defense_layer)
+            for label in class_names:
+                for layer, (_, _, defense) in zip(layers, results):
+                    self.topological_representation.write(label, layer, *defense[label])
+            for layer, task, (state, rank_index, _) in zip(layers, tasks, results):
+                state['activations'] = task['defense_activations']
+                self.defense_geometry[layer] = DefenseGeometry.from_state_dict(
+                    state, device=self.device, index=self.rank_index_kind, rank_index=rank_index,
+                    **self.rank_index_kwargs)
+
+        with self.profiler.stage('rank/query/parallel'):
+            tasks = [{
+                'geometry': self.defense_geometry[layer],
+                'queries': {group: (self.activation_quantizer.distance_view(layer, activations[layer]), preds.cpu())
+                            for group, (activations, preds) in queries.items()},
+                'saturation': saturation,
+            } for layer in layers]
+            results = rank_layers(tasks, workers=self.workers, function=query_layer)
+            for group in queries:
+                for layer, query in zip(layers, results):
+                    self.topological_representation.write(group, layer, *query[group])
+        self.log(f"Ranked {len(layers)} layers with {min(self.workers, len(layers))} workers "
+              f"in {time.perf_counter() - start_time:.2f}s")
 
     def getDefenseRegion(self, final_prediction, h_defense_activation, processing_label, layer,
                          layer_test_region_individual):
+        """
+        Write the ranks of the defense samples predicted as `processing_label` in `layer` into the
+        TopologicalRepresentation `layer_test_region_individual` (group `processing_label`).
+        """
+        if not (final_prediction == processing_label).any():
+            self.log("No sample in this class for label =", processing_label)
 
-        processing_label_indices = torch.where(final_prediction == processing_label)[0]
-        processing_label_h_defense_activation = h_defense_activation[processing_label_indices]
-
-        if layer not in layer_test_region_individual:
-            layer_test_region_individual[layer] = {}
-        layer_test_region_individual[layer][processing_label] = []
-
-        self.candidate_[layer] = self.gather_activation_into_class(final_prediction, h_defense_activation)
-
-
-        if np.ndim(self.candidate_[layer][processing_label]) == 0:
-            print("No sample in this class for label =", processing_label)
-        else:
-            for index, item in enumerate(self.candidate_[layer][processing_label]):
-
-                sorted_dis, sorted_indices = self.get_dis_sort(item, h_defense_activation)
-
-                for i, idx in enumerate(sorted_indices[1:], start=1):
-                    if final_prediction[idx] == processing_label:
-                        mask = ~torch.all(processing_label_h_defense_activation == h_defense_activation[idx], dim=1)
-                        sorted_dis_validation, sorted_indices_validation = self.get_dis_sort(h_defense_activation[idx], processing_label_h_defense_activation[mask])
-                        threshold = torch.max(sorted_dis_validation[:math.ceil(self.SAMPLES_PER_CLASS * self.ALPHA)])
-                        distance_value = sorted_dis[i].item()
-
-                        if distance_value > threshold:
-                            distance_value_index = self.DEFENSE_TRAIN_SIZE - 1
-                        else:
-                            distance_value_index = i - 1
-                        layer_test_region_individual[layer][processing_label].append(distance_value_index)
-                        break
+        # Defense ranks and thresholds come straight from the cached geometry, self excluded by index
+        geometry = self.get_defense_geometry(layer, final_prediction, h_defense_activation)
+        ranks, origin = defense_group_ranks(geometry, final_prediction, processing_label, self.DEFENSE_TRAIN_SIZE - 1)
+        layer_test_region_individual.write(processing_label, layer, ranks, origin)
         return layer_test_region_individual
 
     def getLayerRegionDistance(self, new_prediction, new_activation, new_temp_label,
                                h_defense_prediction, h_defense_activation,
                                layer, layer_test_region_individual):
-        if layer not in layer_test_region_individual:
-            layer_test_region_individual[layer] = {}
-        layer_test_region_individual[layer][new_temp_label] = []
-
-        candidate__ = self.gather_activation_into_class(new_prediction, new_activation)
-        labels = torch.unique(new_prediction)
-
-        for processing_label in labels:
-
-            processing_label_indices = torch.where(h_defense_prediction == processing_label)[0]
-            processing_label_h_defense_activation = h_defense_activation[processing_label_indices]
-            for index, item in enumerate(candidate__[processing_label]):
-
-                sorted_dis, sorted_indices = self.get_dis_sort(item, h_defense_activation)
-
-                for i, idx in enumerate(sorted_indices):
-                    if h_defense_prediction[idx] == processing_label:
-                        mask = ~torch.all(processing_label_h_defense_activation == h_defense_activation[idx], dim=1)
-                        sorted_dis_validation, sorted_indices_validation = self.get_dis_sort(h_defense_activation[idx], processing_label_h_defense_activation[mask])
-                        threshold = torch.max(sorted_dis_validation[:math.ceil(self.SAMPLES_PER_CLASS * self.ALPHA)])
-                        distance_value = sorted_dis[i].item()
-
-                        if distance_value > threshold:
-                            distance_value_index = self.DEFENSE_TRAIN_SIZE - 1
-                        else:
-                            distance_value_index = i
-                        layer_test_region_individual[layer][new_temp_label].append(distance_value_index)
-                        break
+        """
+        Write the ranks of new samples in `layer` into group `new_temp_label` of the TopologicalRepresentation.
+        """
+        # Keep the label-grouped order of the original per-label loop
+        geometry = self.get_defense_geometry(layer, h_defense_prediction, h_defense_activation)
+        ranks, origin = query_group_ranks(geometry, self.activation_quantizer.distance_view(layer, new_activation),
+                                          new_prediction, self.DEFENSE_TRAIN_SIZE - 1)
+        layer_test_region_individual.write(new_temp_label, layer, ranks, origin)
 
         return layer_test_region_individual
 
@@ -658,48 +843,54 @@ class TEDPLUS(BackdoorDefense):
           4) Compute topological representations.
           5) (Optional) Visualization and outlier detection steps.
         """
-        print('STEP 1')
-        self.generate_poison_clean_sets()
-
-        print('STEP 2')
-        self.create_poison_clean_dataloaders()
-
-        print('STEP 4')
-
-        self.h_defense_ori_labels, self.h_defense_activations, self.h_defense_preds = self.fetch_activation(
-            self.defense_loader)
-        torch.cuda.synchronize()
-        begin1 = time.time()
-        self.h_poison_ori_labels, self.h_poison_activations, self.h_poison_preds = self.fetch_activation(
-            self.poison_loader)
-        self.h_clean_ori_labels, self.h_clean_activations, self.h_clean_preds = self.fetch_activation(
-            self.clean_loader)
-
-        print(self.h_defense_preds.size())
-        print(self.h_poison_preds.size())
-        print(self.h_clean_preds.size())
+        with self.profiler.stage('defense_set'):
+            self.build_defense_set()
+
+        self.log('STEP 1')
+        with self.profiler.stage('generation'):
+            self.generate_poison_clean_sets()
+
+            self.log('STEP 2')
+            self.create_poison_clean_dataloaders()
+
+        self.log('STEP 4')
+
+        if self.activation_reducer.method == 'pca':
+            with self.profiler.stage('reduction_fit'):
+                self.fit_activation_reducer(self.defense_loader)
+        with self.profiler.stage('capture/defense'):
+            self.h_defense_ori_labels, self.h_defense_activations, self.h_defense_preds = self.fetch_activation(
+                self.defense_loader, tag='defense', logits=self.defense_logits())
+        if self.layer_budget_mflops is not None or self.layer_budget_mb is not None:
+            with self.profiler.stage('layer_selection'):
+                self.select_hook_layers()
+        with self.profiler.stage('capture/poison'):
+            self.h_poison_ori_labels, self.h_poison_activations, self.h_poison_preds = self.fetch_activation(
+                self.poison_loader, tag='poison', logits=self.poison_logits)
+        with self.profiler.stage('capture/clean'):
+            self.h_clean_ori_labels, self.h_clean_activations, self.h_clean_preds = self.fetch_activation(
+                self.clean_loader, tag='clean', logits=self.clean_logits)
+
+        self.log(self.h_defense_preds.size())
+        self.log(self.h_poison_preds.size())
+        self.log(self.h_clean_preds.size())
 
         unique_defense = []
         unique_poison = []
         unique_clean = []
         for label in self.h_defense_preds:
             unique_defense.append(label.item())
-        print(set(unique_defense))
+        self.log(set(unique_defense))
 
         for label in self.h_poison_preds:
             unique_poison.append(label.item())
-        print(set(unique_poison))
+        self.log(set(unique_poison))
 
         for label in self.h_clean_preds:
             unique_clean.append(label.item())
-        print(set(unique_clean))
-
-        torch.cuda.synchronize()
-        end1 = time.time()
+        self.log(set(unique_clean))
 
-        time1 = end1 - begin1
-
-        print('STEP 5')
+        self.log('STEP 5')
         accuracy_defense = self.calculate_accuracy(self.h_defense_ori_labels, self.h_defense_preds)
 
         poison_GT = torch.ones_like(self.h_poison_preds) * self.target
@@ -707,125 +898,169 @@ class TEDPLUS(BackdoorDefense):
         total_poison = len(self.h_poison_preds)
         accuracy_poison = (correct_poison / total_poison) * 100
 
-        print(f"\nAccuracy on defense_loader (Clean): {accuracy_defense:.2f}%")
-        print(f"Accuracy on poison_loader (Poison) : {accuracy_poison:.2f}%")
+        self.log(f"\nAccuracy on defense_loader (Clean): {accuracy_defense:.2f}%")
+        self.log(f"Accuracy on poison_loader (Poison) : {accuracy_poison:.2f}%")
 
-        print('STEP 7')
+        self.log('STEP 7')
+        self.topological_representation = TopologicalRepresentation(
+            self.h_defense_activations.keys(), max(self.DEFENSE_TRAIN_SIZE, len(self.h_defense_preds)),
+            capacity=len(self.h_defense_preds) + len(self.h_poison_preds) + len(self.h_clean_preds))
         class_names = np.unique(self.h_defense_ori_labels.cpu().numpy())
-        for index, label in enumerate(class_names):
-            for layer in self.h_defense_activations:
-                self.topological_representation = self.getDefenseRegion(
-                    final_prediction=self.h_defense_preds,
-                    h_defense_activation=self.h_defense_activations[layer],
-                    processing_label=label,
-                    layer=layer,
-                    layer_test_region_individual=self.topological_representation
+        if self.parallel_ranks():
+            self.parallel_topological_representation(class_names, {
+                self.POISON_TEMP_LABEL: (self.h_poison_activations, self.h_poison_preds),
+                self.CLEAN_TEMP_LABEL: (self.h_clean_activations, self.h_clean_preds),
+            })
+            for group in self.topological_representation.groups:
+                means = self.topological_representation.group(group).mean(axis=0)
+                self.log(f"Topological Representation Label [{group}], mean per layer: {np.round(means, 2).tolist()}")
+        else:
+            for index, label in enumerate(class_names):
+                for layer in self.h_defense_activations:
+                    with self.profiler.stage(f'rank/defense/{layer}'):
+                        self.topological_representation = self.getDefenseRegion(
+                            final_prediction=self.h_defense_preds,
+                            h_defense_activation=self.h_defense_activations[layer],
+                            processing_label=label,
+                            layer=layer,
+                            layer_test_region_individual=self.topological_representation
+                        )
+                    topo_rep_array = self.topological_representation.column(label, layer)
+                    self.log(f"Topological Representation Label [{label}] & layer [{layer}]: {topo_rep_array}")
+                    self.log(f"Mean: {np.mean(topo_rep_array)}\n")
+            for layer_ in self.h_poison_activations:
+                with self.profiler.stage(f'rank/query/{layer_}'):
+                    self.topological_representation = self.getLayerRegionDistance(
+                        new_prediction=self.h_poison_preds,
+                        new_activation=self.h_poison_activations[layer_],
+                        new_temp_label=self.POISON_TEMP_LABEL,
+                        h_defense_prediction=self.h_defense_preds,
+                        h_defense_activation=self.h_defense_activations[layer_],
+                        layer=layer_,
+                        layer_test_region_individual=self.topological_representation,
+                    )
+                topo_rep_array_poison = self.topological_representation.column(self.POISON_TEMP_LABEL, layer_)
+                self.log(
+                    f"Topological Representation Label [{self.POISON_TEMP_LABEL}] & layer [{layer_}]: {topo_rep_array_poison}")
+                self.log(f"Mean: {np.mean(topo_rep_array_poison)}\n")
+
+            for layer_ in self.h_clean_activations:
+                with self.profiler.stage(f'rank/query/{layer_}'):
+                    self.topological_representation = self.getLayerRegionDistance(
+                        new_prediction=self.h_clean_preds,
+                        new_activation=self.h_clean_activations[layer_],
+                        new_temp_label=self.CLEAN_TEMP_LABEL,
+                        h_defense_prediction=self.h_defense_preds,
+                        h_defense_activation=self.h_defense_activations[layer_],
+                        layer=layer_,
+                        layer_test_region_individual=self.topological_representation,
+                    )
+                topo_rep_array_clean = self.topological_representation.column(self.CLEAN_TEMP_LABEL, layer_)
+                self.log(
+                    f"Topological Representation Label [{self.CLEAN_TEMP_LABEL}] - layer [{layer_}]: {topo_rep_array_clean}")
+                self.log(f"Mean: {np.mean(topo_rep_array_clean)}\n")
+        self.log('STEP 8')
+        # Benign groups were allocated first, one label after the other, so this is a view of the rank matrix
+        unknown_groups = [self.POISON_TEMP_LABEL, self.CLEAN_TEMP_LABEL]
+        benign_groups = [group for group in self.topological_representation.groups if group not in unknown_groups]
+        inputs_all_benign = self.topological_representation.matrix(benign_groups)
+        labels_all_benign = self.topological_representation.group_labels(benign_groups)
+        inputs_all_unknown = self.topological_representation.matrix(unknown_groups)
+        labels_all_unknown = self.topological_representation.group_labels(unknown_groups)
+        self.topological_representation.save(os.path.join(self.save_dir, 'topological_representation'))
+
+        self.log('STEP 9')
+        if not self.headless:
+            with self.profiler.stage('outlier/visualization'):
+                import plotly.express as px
+                pca_t = sklearn_PCA(n_components=2)
+                pca_fit = pca_t.fit(inputs_all_benign)
+
+                benign_trajectories = pca_fit.transform(inputs_all_benign)
+                trajectories = pca_fit.transform(np.concatenate((inputs_all_unknown, inputs_all_benign), axis=0))
+
+                df_classes = pd.DataFrame(np.concatenate((labels_all_unknown, labels_all_benign), axis=0))
+
+                fig_ = px.scatter(
+                    trajectories, x=0, y=1, color=df_classes[0].astype(str), labels={'color': 'digit'},
+                    color_discrete_sequence=px.colors.qualitative.Dark24,
                 )
-                topo_rep_array = np.array(self.topological_representation[layer][label])
-                print(f"Topological Representation Label [{label}] & layer [{layer}]: {topo_rep_array}")
-                print(f"Mean: {np.mean(topo_rep_array)}\n")
-        torch.cuda.synchronize()
-        begin2 = time.time()
-        for layer_ in self.h_poison_activations:
-            self.topological_representation = self.getLayerRegionDistance(
-                new_prediction=self.h_poison_preds,
-                new_activation=self.h_poison_activations[layer_],
-                new_temp_label=self.POISON_TEMP_LABEL,
-                h_defense_prediction=self.h_defense_preds,
-                h_defense_activation=self.h_defense_activations[layer_],
-                layer=layer_,
-                layer_test_region_individual=self.topological_representation,
-            )
-            topo_rep_array_poison = np.array(self.topological_representation[layer_][self.POISON_TEMP_LABEL])
-            print(
-                f"Topological Representation Label [{self.POISON_TEMP_LABEL}] & layer [{layer_}]: {topo_rep_array_poison}")
-            print(f"Mean: {np.mean(topo_rep_array_poison)}\n")
-
-        for layer_ in self.h_clean_activations:
-            self.topological_representation = self.getLayerRegionDistance(
-                new_prediction=self.h_clean_preds,
-                new_activation=self.h_clean_activations[layer_],
-                new_temp_label=self.CLEAN_TEMP_LABEL,
-                h_defense_prediction=self.h_defense_preds,
-                h_defense_activation=self.h_defense_activations[layer_],
-                layer=layer_,
-                layer_test_region_individual=self.topological_representation,
-            )
-            topo_rep_array_clean = np.array(self.topological_representation[layer_][self.CLEAN_TEMP_LABEL])
-            print(
-                f"Topological Representation Label [{self.CLEAN_TEMP_LABEL}] - layer [{layer_}]: {topo_rep_array_clean}")
-            print(f"Mean: {np.mean(topo_rep_array_clean)}\n")
-        torch.cuda.synchronize()
-        end2 = time.time()
-        time2 = end2 - begin2
-        print('STEP 8')
-
-        def aggregate_by_all_layers(output_label):
-            inputs_container = []
-            first_key = list(self.topological_representation.keys())[0]
-            labels_container = np.repeat(output_label,
-                                         len(self.topological_representation[first_key][output_label]))
-            for l in self.topological_representation.keys():
-                temp = []
-                for j in range(len(self.topological_representation[l][output_label])):
-                    temp.append(self.topological_representation[l][output_label][j])
-                if temp:
-                    inputs_container.append(np.array(temp))
-            return np.array(inputs_container).T, np.array(labels_container)
-
-        inputs_all_benign = []
-        labels_all_benign = []
-        inputs_all_unknown = []
-        labels_all_unknown = []
-
-        first_key = list(self.topological_representation.keys())[0]
-        class_name = list(self.topological_representation[first_key])
-
-        for inx in class_name:
-            inputs, labels = aggregate_by_all_layers(output_label=inx)
-            if inx != self.POISON_TEMP_LABEL and inx != self.CLEAN_TEMP_LABEL:
-                inputs_all_benign.append(np.array(inputs))
-                labels_all_benign.append(np.array(labels))
-            else:
-                inputs_all_unknown.append(np.array(inputs))
-                labels_all_unknown.append(np.array(labels))
 
-        inputs_all_benign = np.concatenate(inputs_all_benign)
-        labels_all_benign = np.concatenate(labels_all_benign)
-
-        inputs_all_unknown = np.concatenate(inputs_all_unknown)
-        labels_all_unknown = np.concatenate(labels_all_unknown)
-
-        print('STEP 9')
-        torch.cuda.synchronize()
-        begin3 = time.time()
-        pca_t = sklearn_PCA(n_components=2)
-        pca_fit = pca_t.fit(inputs_all_benign)
-
-        benign_trajectories = pca_fit.transform(inputs_all_benign)
-        trajectories = pca_fit.transform(np.concatenate((inputs_all_unknown, inputs_all_benign), axis=0))
-
-        df_classes = pd.DataFrame(np.concatenate((labels_all_unknown, labels_all_benign), axis=0))
-
-        fig_ = px.scatter(
-            trajectories, x=0, y=1, color=df_classes[0].astype(str), labels={'color': 'digit'},
-            color_discrete_sequence=px.colors.qualitative.Dark24,
-        )
+        with self.profiler.stage('outlier/fit'):
+            pca = PCA(contamination=0.1, n_components=2)
+            pca.fit(inputs_all_benign)
+
+        with self.profiler.stage('outlier/score'):
+            y_train_scores = pca.decision_function(inputs_all_benign)
+            y_test_scores = pca.decision_function(inputs_all_unknown)
+            y_test_pred = pca.predict(inputs_all_unknown)
+
+        self.layers = self.topological_representation.layers
+        self.benign_ranks = inputs_all_benign
+        self.outlier_model = pca
+        results = self.report_detection(labels_all_unknown, y_test_scores, y_test_pred,
+                                        self.profiler.total(INFERENCE_STAGES))
+        if self.cascade_order is not None:
+            with self.profiler.stage('cascade'):
+                self.build_cascade()
+                self.log(f"\n--------- CASCADE ({self.cascade_order}, tolerance {self.cascade_tolerance}) ---------")
+                margin = self.select_cascade_margin()
+                results.update(self.evaluate_cascade(inputs_all_unknown, labels_all_unknown, y_test_pred, margin))
+        self.save_profile()
+        self.emit_record(results)
+        return results
+
+    def emit_record(self, results):
+        """
+        In headless mode, print the run as one JSON line: its configuration, the detection results and the
+        per-stage wall times.
+        """
+        if self.headless:
+            record = {'dataset': self.dataset, 'poison_type': self.poison_type, 'layers': len(self.layers)}
+            record.update(results)
+            record['stages'] = {name: stage['wall_s'] for name, stage in self.profiler.stages.items()}
+            print(json.dumps(record))
 
-        pca = PCA(contamination=0.1, n_components=2)
-        pca.fit(inputs_all_benign)
+    def save_profile(self):
+        """
+        Print the per-stage profile and write it as JSON next to the TED results (save_dir/profile.json).
+        """
+        self.log("\n----------- STAGE PROFILE -----------")
+        self.log(self.profiler.summary())
+        path = self.profiler.save(os.path.join(self.save_dir, 'profile.json'))
+        self.log(f"Saved stage profile to {path}")
 
-        y_train_scores = pca.decision_function(inputs_all_benign)
-        y_test_scores = pca.decision_function(inputs_all_unknown)
-        y_test_pred = pca.predict(inputs_all_unknown)
+    def report_detection(self, labels_all_unknown, y_test_scores, y_test_pred, inference_time):
+        """
+        Print and return the detection metrics of the outlier model on the Poison/Clean samples.
+        """
         prediction_mask = (y_test_pred == 1)
         prediction_labels = labels_all_unknown[prediction_mask]
         label_counts = Counter(prediction_labels)
 
-        print("\n----------- DETECTION RESULTS -----------")
+        self.log("\n----------- DETECTION RESULTS -----------")
         for label, count in label_counts.items():
-            print(f'Label {label}: {count}')
-
+            self.log(f'Label {label}: {count}')
+
+        results = self.detection_metrics(labels_all_unknown, y_test_scores, y_test_pred)
+        results['inference_time'] = inference_time
+        self.log(f"Inference time: {inference_time}")
+        self.log("TPR: {:.2f}%".format(results['TPR'] * 100))
+        self.log("FPR: {:.2f}%".format(results['FPR'] * 100))
+        self.log("AUC: {:.4f}".format(results['AUC']))
+        self.log(f"F1 score: {results['F1']:.4f}")
+        self.log("True Positives (TP):", results['TP'])
+        self.log("False Positives (FP):", results['FP'])
+        self.log("True Negatives (TN):", results['TN'])
+        self.log("False Negatives (FN):", results['FN'])
+
+        self.log("\n[INFO] TED run completed.")
+        return results
+
+    def detection_metrics(self, labels_all_unknown, y_test_scores, y_test_pred):
+        """
+        TPR / FPR / AUC / F1 and the confusion counts of outlier predictions on the Poison/Clean samples.
+        """
         is_poison_mask = (labels_all_unknown == self.POISON_TEMP_LABEL).astype(int)
         fpr, tpr, thresholds = metrics.roc_curve(is_poison_mask, y_test_scores, pos_label=1)
         auc_val = metrics.auc(fpr, tpr)
@@ -834,26 +1069,504 @@ class TEDPLUS(BackdoorDefense):
         TPR = tp / (tp + fn) if (tp + fn) > 0 else 0
         FPR = fp / (fp + tn) if (fp + tn) > 0 else 0
         f1 = metrics.f1_score(is_poison_mask, y_test_pred)
-        torch.cuda.synchronize()
-        end3 = time.time()
-        time3 = end3 - begin3
-        print(f"Inference time: {time1 + time2 + time3}")
-        print("TPR: {:.2f}%".format(TPR * 100))
-        print("FPR: {:.2f}%".format(FPR * 100))
-        print("AUC: {:.4f}".format(auc_val))
-        print(f"F1 score: {f1:.4f}")
-        print("True Positives (TP):", tp)
-        print("False Positives (FP):", fp)
-        print("True Negatives (TN):", tn)
-        print("False Negatives (FN):", fn)
-
-        print("\n[INFO] TED run completed.")
+        return {
+            'TPR': float(TPR), 'FPR': float(FPR), 'AUC': float(auc_val), 'F1': float(f1),
+            'TP': int(tp), 'FP': int(fp), 'TN': int(tn), 'FN': int(fn),
+        }
+
+    # ==============================
+    #   FIT ONCE, SCORE MANY
+    # ==============================
+    def artifact_config(self):
+        """
+        Everything the fitted state depends on besides the model weights: the hooked layers and their
+        reduction, and the defense-set parameters.
+        """
+        return {
+            'layers': list(self.hook_points),
+            'layer_budget_mflops': self.layer_budget_mflops,
+            'layer_budget_mb': self.layer_budget_mb,
+            'reduction': self.activation_reducer.method,
+            'reduction_dim': self.activation_reducer.dim,
+            'reduction_seed': self.activation_reducer.seed,
+            'precision': self.activation_quantizer.precision,
+            'precision_granularity': self.activation_quantizer.granularity,
+            'samples_per_class': self.SAMPLES_PER_CLASS,
+            'class_ratio': self.CLASS_RATIO,
+            'alpha': self.ALPHA,
+        }
+
+    def checkpoint_sha256(self):
+        if self.model_sha256 is None:
+            self.model_sha256 = state_sha256(self.model)
+        return self.model_sha256
+
+    def default_artifact_path(self):
+        """
+        save_dir/artifacts/ted_<checkpoint sha256>_<config sha256>.pt (both truncated to 12 characters).
+        """
+        name = f"ted_{self.checkpoint_sha256()[:12]}_{state_sha256(self.artifact_config())[:12]}.pt"
+        return os.path.join(self.save_dir, 'artifacts', name)
+
+    def fit(self, path=None):
+        """
+        Fit the detector on the defense set alone (defense activations, per-sample ALPHA thresholds,
+        benign rank vectors and the pyod PCA outlier model) and save it with save().
+        """
+        with self.profiler.stage('defense_set'):
+            self.build_defense_set()
+        if self.activation_reducer.method == 'pca':
+            with self.profiler.stage('reduction_fit'):
+                self.fit_activation_reducer(self.defense_loader)
+        with self.profiler.stage('capture/defense'):
+            self.h_defense_ori_labels, self.h_defense_activations, self.h_defense_preds = self.fetch_activation(
+                self.defense_loader, tag='defense', logits=self.defense_logits())
+        if self.layer_budget_mflops is not None or self.layer_budget_mb is not None:
+            with self.profiler.stage('layer_selection'):
+                self.select_hook_layers()
+        self.layers = list(self.h_defense_activations.keys())
+
+        self.topological_representation = TopologicalRepresentation(
+            self.layers, max(self.DEFENSE_TRAIN_SIZE, len(self.h_defense_preds)), capacity=len(self.h_defense_preds))
+        for label in np.unique(self.h_defense_ori_labels.cpu().numpy()):
+            for layer in self.layers:
+                with self.profiler.stage(f'rank/defense/{layer}'):
+                    self.topological_representation = self.getDefenseRegion(
+                        final_prediction=self.h_defense_preds,
+                        h_defense_activation=self.h_defense_activations[layer],
+                        processing_label=label,
+                        layer=layer,
+                        layer_test_region_individual=self.topological_representation
+                    )
+        self.benign_ranks = self.topological_representation.matrix(list(self.topological_representation.groups))
+
+        with self.profiler.stage('outlier/fit'):
+            self.outlier_model = PCA(contamination=0.1, n_components=2)
+            self.outlier_model.fit(self.benign_ranks)
+        if self.cascade_order is not None:
+            with self.profiler.stage('cascade'):
+                self.build_cascade()
+        return self.save(path)
+
+    def save(self, path=None):
+        """
+        Serialize the fitted state to a versioned artifact keyed by the model checkpoint hash and the
+        hook configuration. Returns the artifact path.
+        """
+        if path is None:
+            path = self.default_artifact_path()
+        artifact = {
+            'version': TED_ARTIFACT_VERSION,
+            'checkpoint_sha256': self.checkpoint_sha256(),
+            'config': self.artifact_config(),
+            'all_labels': [int(label) for label in self.all_labels],
+            'layers': self.layers,
+            'layer_selection': self.layer_selection,
+            'reducer': self.activation_reducer.state_dict(),
+            'quantizer': self.activation_quantizer.state_dict(),
+            'geometry': {
+                layer: self.get_defense_geometry(layer, self.h_defense_preds,
+                                                 self.h_defense_activations[layer]).state_dict()
+                for layer in self.layers
+            },
+            'benign_ranks': self.benign_ranks,
+            'outlier_model': self.outlier_model,
+        }
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        torch.save(artifact, path)
+        self.log(f"Saved TED artifact to {path}")
+        return path
+
+    def load(self, path=None):
+        """
+        Restore a detector saved with save(). Refuses artifacts fitted on another checkpoint or with
+        another hook configuration. No defense data is read.
+        """
+        if path is None:
+            path = self.default_artifact_path()
+        start_time = time.perf_counter()
+        artifact = torch.load(path, map_location='cpu', weights_only=False)
+        if artifact['version'] != TED_ARTIFACT_VERSION:
+            raise ValueError(f"TED artifact {path} has version {artifact['version']}, "
+                             f"expected {TED_ARTIFACT_VERSION}")
+        if artifact['checkpoint_sha256'] != self.checkpoint_sha256():
+            raise ValueError(f"TED artifact {path} was fitted on a different model checkpoint")
+        if artifact['config'] != self.artifact_config():
+            raise ValueError(f"TED artifact {path} was fitted with a different hook configuration: "
+                             f"{artifact['config']}")
+
+        self.all_labels = artifact['all_labels']
+        self.layers = artifact['layers']
+        self.layer_selection = artifact['layer_selection']
+        self.register_hooks(self.layers)
+        self.activation_reducer.load_state_dict(artifact['reducer'])
+        self.activation_quantizer.load_state_dict(artifact['quantizer'])
+        self.defense_geometry = {}
+        for layer, state in artifact['geometry'].items():
+            if self.activation_storage == 'device':
+                state['activations'] = state['activations'].to(self.device)
+            self.defense_geometry[layer] = DefenseGeometry.from_state_dict(
+                state, device=self.device, index=self.rank_index_kind, **self.rank_index_kwargs)
+        self.benign_ranks = artifact['benign_ranks']
+        self.outlier_model = artifact['outlier_model']
+        if self.cascade_order is not None:
+            self.build_cascade()
+        self.log(f"Loaded TED artifact {path} ({len(self.layers)} layers, {len(self.benign_ranks)} defense samples) "
+              f"in {time.perf_counter() - start_time:.2f}s")
+        return self
+
+    def add_defense_samples(self, inputs, labels, refit=True):
+        """
+        Grow the defense set of the fitted (or loaded) detector by trusted samples without rebuilding it:
+        one hooked forward pass, DefenseGeometry.add per layer (the new distances and the neighbours they
+        change), the benign rank vectors regenerated from the updated geometry and, with `refit`, the outlier
+        model (and cascade) refit. Samples the model misclassifies are skipped, as in build_defense_set().
+        Call save() to persist the grown detector. Returns the number of samples added.
+        """
+        start_time = time.perf_counter()
+        labels = torch.as_tensor(labels)
+        preds, activations = self.hooked_forward(inputs)
+        rows = torch.where(preds.cpu() == labels.cpu())[0]
+        if len(rows) < len(labels):
+            self.log(f"Skipping {len(labels) - len(rows)} of {len(labels)} new defense samples predicted wrongly")
+        if len(rows) == 0:
+            return 0
+
+        changed = 0
+        for layer in self.layers:
+            h = activations[layer][rows.to(activations[layer].device)]
+            h = self.activation_quantizer.distance_view(layer, self.activation_quantizer(layer, h))
+            changed += len(self.defense_geometry[layer].add(h, preds[rows.to(preds.device)]))
+        self.benign_ranks = self.benign_rank_matrix()
+        if refit:
+            self.outlier_model = PCA(contamination=0.1, n_components=2)
+            self.outlier_model.fit(self.benign_ranks)
+            if self.cascade_order is not None:
+                self.build_cascade()
+        self.log(f"Added {len(rows)} defense samples ({len(self.benign_ranks)} in total, {changed} neighbours changed "
+                 f"over {len(self.layers)} layers) in {time.perf_counter() - start_time:.2f}s")
+        return len(rows)
+
+    def benign_rank_matrix(self):
+        """
+        The benign rank vectors (defense samples x layers) from the defense geometry alone, grouped by label as
+        in fit().
+        """
+        geometries = [self.defense_geometry[layer] for layer in self.layers]
+        labels = geometries[0].labels
+        representation = TopologicalRepresentation(self.layers, max(self.DEFENSE_TRAIN_SIZE, len(labels)),
+                                                   capacity=len(labels))
+        for label in torch.unique(labels).tolist():
+            for layer, geometry in zip(self.layers, geometries):
+                ranks, origin = defense_group_ranks(geometry, geometry.labels, label, self.DEFENSE_TRAIN_SIZE - 1)
+                representation.write(label, layer, ranks, origin)
+        return representation.matrix(list(representation.groups))
+
+    def hooked_forward(self, inputs):
+        """
+        One hooked forward pass: the predictions restricted to the kept classes and the flattened
+        activations of every fitted layer.
+        """
+        allowed_idx = torch.tensor(self.all_labels, device=self.device)
+        self.model.eval()
+        with torch.no_grad():
+            preds = self.restricted_prediction(self.model(inputs.to(self.device)), allowed_idx)
+        activations = {layer: self.activations[layer].reshape(inputs.shape[0], -1) for layer in self.layers}
+        self.activations.clear()
+        return preds, activations
+
+    def layer_ranks(self, layer, activations, preds):
+        """
+        Saturated first-same-label ranks of `activations` in `layer`. Samples whose predicted class has no
+        defense sample get the saturated rank.
+        """
+        saturation = self.DEFENSE_TRAIN_SIZE - 1
+        geometry = self.defense_geometry[layer]
+        with torch.no_grad():
+            activations = self.activation_quantizer.distance_view(layer, self.activation_quantizer(layer, activations))
+            nn_dist, rank, nn_index = geometry.query(activations, preds)
+        ranks = torch.full((activations.shape[0],), saturation, dtype=torch.long)
+        ranks[nn_index >= 0] = geometry.saturate(nn_dist, rank, nn_index, saturation)
+        return ranks
+
+    def rank_vectors(self, inputs):
+        """
+        One hooked forward pass over `inputs`, then the saturated rank of every sample in every fitted layer.
+        """
+        preds, activations = self.hooked_forward(inputs)
+        return torch.stack([self.layer_ranks(layer, activations[layer], preds) for layer in self.layers],
+                           dim=1).numpy()
+
+    def score_batch(self, inputs):
+        """
+        Online scoring of a batch against the fitted (or loaded) detector: one hooked forward pass, the
+        per-layer ranks against the defense state and the outlier model, with no dataset I/O and no printing.
+        Batches are processed in chunks of at most score_chunk_size samples, which bounds memory and the
+        latency of each step.
+        Returns (scores, is_poison): the pyod decision_function scores (higher is more anomalous) and the
+        binary predictions, thresholded as pyod's predict() would without scoring twice.
+        """
+        scores = []
+        for start in range(0, inputs.shape[0], self.score_chunk_size):
+            rank_vectors = self.rank_vectors(inputs[start:start + self.score_chunk_size])
+            scores.append(self.outlier_model.decision_function(rank_vectors))
+        scores = np.concatenate(scores)
+        return scores, (scores > self.outlier_model.threshold_).astype(int)
+
+    def cascade_columns(self):
+        """
+        Layer columns in cascade order: 'deep' (last hooked layer first), 'shallow' or comma-separated names.
+        """
+        if self.cascade_order == 'deep':
+            return list(range(len(self.layers)))[::-1]
+        if self.cascade_order == 'shallow':
+            return list(range(len(self.layers)))
+        return [self.layers.index(name) for name in self.cascade_order.split(',')]
+
+    def build_cascade(self):
+        """
+        Fit one outlier model per prefix of the cascade order on the benign rank vectors: a rank quantile
+        threshold for the first (single-layer) stage, PCA for the longer prefixes.
+        """
+        self.cascade = LayerCascade(self.benign_ranks, self.cascade_columns(), make_model=self.cascade_stage_model)
+
+    @staticmethod
+    def cascade_stage_model(stage):
+        return RankThreshold(contamination=0.1) if stage == 1 else PCA(contamination=0.1, n_components=2)
+
+    def cascade_score_batch(self, inputs):
+        """
+        score_batch with early exits: layers are ranked in cascade order, only for the samples the previous
+        prefixes left undecided. Returns the cascade scores (centered on the threshold, in benign-std units),
+        the binary predictions and the number of layers evaluated per sample.
+        """
+        preds, activations = self.hooked_forward(inputs)
+
+        def layer_ranks(column, rows):
+            rows = torch.as_tensor(rows)
+            layer = self.layers[column]
+            return self.layer_ranks(layer, activations[layer][rows.to(activations[layer].device)],
+                                    preds[rows.to(preds.device)]).numpy()
+
+        return self.cascade.run(layer_ranks, inputs.shape[0], self.cascade_margin)
+
+    def select_cascade_margin(self, holdout=0.2, seed=0):
+        """
+        Smallest exit margin of the grid whose predictions disagree with the no-exit cascade on at most
+        cascade_tolerance of a held-out slice of the benign defense ranks, the cascade being refit on the
+        rest (inf, i.e. no early exit, if none does). No Poison/Clean sample is involved.
+        """
+        num_benign = len(self.benign_ranks)
+        permutation = np.random.default_rng(seed).permutation(num_benign)
+        num_holdout = int(num_benign * holdout)
+        if num_holdout == 0 or num_holdout == num_benign:
+            return float('inf')
+        held, kept = permutation[:num_holdout], permutation[num_holdout:]
+        cascade = LayerCascade(self.benign_ranks[kept], self.cascade.order, make_model=self.cascade_stage_model)
+
+        def layer_ranks(column, rows):
+            return self.benign_ranks[held[rows], column]
+
+        _, reference, _ = cascade.run(layer_ranks, num_holdout, float('inf'))
+        for margin in sorted({self.cascade_margin, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0}):
+            _, predictions, layers_used = cascade.run(layer_ranks, num_holdout, margin)
+            disagreement = float((predictions != reference).mean())
+            self.log(f"margin {margin:5.2f}: {layers_used.mean():6.2f} / {len(cascade.order)} layers per sample, "
+                     f"{disagreement * 100:6.2f}% of held-out benign samples decided differently")
+            if disagreement <= self.cascade_tolerance:
+                return margin
+        return float('inf')
+
+    def evaluate_cascade(self, rank_vectors, labels, full_predictions, margin):
+        """
+        Replay the cascade with exit margin `margin` (see select_cascade_margin) on precomputed rank vectors
+        and compare its TPR / FPR with the full evaluation.
+        """
+        is_poison = labels == self.POISON_TEMP_LABEL
+
+        def rates(predictions):
+            tpr = predictions[is_poison].mean() if is_poison.any() else 0.0
+            fpr = predictions[~is_poison].mean() if (~is_poison).any() else 0.0
+            return float(tpr), float(fpr)
+
+        full_tpr, full_fpr = rates(full_predictions)
+        num_layers = len(self.cascade.order)
+        _, predictions, layers_used = self.cascade.run(lambda column, rows: rank_vectors[rows, column],
+                                                       len(rank_vectors), margin)
+        tpr, fpr = rates(predictions)
+        mean_layers = float(layers_used.mean())
+        self.log(f"Cascade margin {margin}: {mean_layers:.2f} of {num_layers} layers evaluated per sample "
+              f"({(1 - mean_layers / num_layers) * 100:.1f}% fewer), TPR {tpr * 100:.2f}% / FPR {fpr * 100:.2f}% "
+              f"vs. full {full_tpr * 100:.2f}% / {full_fpr * 100:.2f}%")
+        return {'cascade_margin': margin, 'cascade_mean_layers': mean_layers,
+                'cascade_TPR': tpr, 'cascade_FPR': fpr}
+
+    def evaluate(self):
+        """
+        Detection metrics of the fitted (or loaded) detector on freshly generated Poison/Clean sets,
+        scored batch by batch with score_batch().
+        """
+        with self.profiler.stage('generation'):
+            self.generate_poison_clean_sets()
+            self.create_poison_clean_dataloaders()
+
+        all_scores, all_preds, all_labels, all_layers_used = [], [], [], []
+        for loader, temp_label in [(self.poison_loader, self.POISON_TEMP_LABEL),
+                                   (self.clean_loader, self.CLEAN_TEMP_LABEL)]:
+            with self.profiler.stage(f'score/{temp_label.lower()}'):
+                for inputs, _ in loader:
+                    if self.cascade is not None:
+                        scores, preds, layers_used = self.cascade_score_batch(inputs)
+                        all_layers_used.append(layers_used)
+                    else:
+                        scores, preds = self.score_batch(inputs)
+                    all_scores.append(scores)
+                    all_preds.append(preds)
+                    all_labels.append(np.repeat(temp_label, len(scores)))
+        results = self.report_detection(np.concatenate(all_labels), np.concatenate(all_scores),
+                                        np.concatenate(all_preds), self.profiler.total(['score/']))
+        if all_layers_used:
+            results['cascade_mean_layers'] = float(np.concatenate(all_layers_used).mean())
+            self.log(f"Cascade: {results['cascade_mean_layers']:.2f} of {len(self.cascade.order)} layers per sample")
+        self.save_profile()
+        self.emit_record(results)
+        return results
+
+    # ==============================
+    #   RESAMPLED EVALUATION
+    # ==============================
+    def capture_bootstrap_pool(self, pool_size):
+        """
+        Capture, once, the activations every bootstrap replicate draws from: all correctly predicted
+        defense-split samples of the kept classes (self.defense_loader is replaced by this pool) and
+        `pool_size` Poison and Clean samples.
+        """
+        self.build_defense_set()
+        subset_indices = np.asarray(self.defense_subset.indices)
+        subset_labels = tools.dataset_labels(self.defense_subset)
+        pool_preds = torch.stack([self.inference_cache[int(index)] for index in subset_indices]).argmax(dim=1).numpy()
+        keep = (pool_preds == subset_labels) & np.isin(subset_labels, self.all_labels)
+        self.defense_loader = data.DataLoader(data.Subset(self.defense_subset.dataset, subset_indices[keep]),
+                                              batch_size=50, shuffle=False, num_workers=0)
+
+        num_samples, self.NUM_SAMPLES = self.NUM_SAMPLES, pool_size
+        try:
+            self.generate_poison_clean_sets()
+        finally:
+            self.NUM_SAMPLES = num_samples
+        self.create_poison_clean_dataloaders()
+
+        if self.activation_reducer.method == 'pca':
+            self.fit_activation_reducer(self.defense_loader)
+        self.h_defense_ori_labels, self.h_defense_activations, self.h_defense_preds = self.fetch_activation(
+            self.defense_loader, tag='defense', logits=self.defense_logits())
+        if self.layer_budget_mflops is not None or self.layer_budget_mb is not None:
+            self.select_hook_layers()
+        self.h_poison_ori_labels, self.h_poison_activations, self.h_poison_preds = self.fetch_activation(
+            self.poison_loader, tag='poison', logits=self.poison_logits)
+        self.h_clean_ori_labels, self.h_clean_activations, self.h_clean_preds = self.fetch_activation(
+            self.clean_loader, tag='clean', logits=self.clean_logits)
+        self.log(f"Bootstrap pool: {len(self.h_defense_preds)} defense, {len(self.h_poison_preds)} Poison and "
+                 f"{len(self.h_clean_preds)} Clean samples")
+
+    def bootstrap(self):
+        """
+        Mean and percentile confidence interval of TPR / FPR / AUC / F1 over -ted_bootstrap replicates of the
+        defense / test split, instead of rerunning test() with other seeds.
+        The model only runs on the pool of capture_bootstrap_pool() and the distances of every layer are
+        computed once. Each replicate draws SAMPLES_PER_CLASS defense samples per kept class (as
+        build_defense_set does) and NUM_SAMPLES Poison and Clean samples, without replacement
+        (-ted_bootstrap_mode subsample) or with replacement (bootstrap), ranks them with RankResampler
+        and refits the outlier model.
+        """
+        replicates = self.args.ted_bootstrap
+        mode = getattr(self.args, 'ted_bootstrap_mode', 'subsample')
+        pool_size = getattr(self.args, 'ted_bootstrap_pool', None) or 4 * self.NUM_SAMPLES
+        confidence = getattr(self.args, 'ted_bootstrap_ci', 0.95)
+
+        with self.profiler.stage('bootstrap/pool'):
+            self.capture_bootstrap_pool(pool_size)
+        with self.profiler.stage('bootstrap/distances'):
+            defense_distances, query_distances = {}, {}
+            for layer in self.h_defense_activations:
+                references = self.activation_quantizer.distance_view(layer, self.h_defense_activations[layer])
+                defense_distances[layer] = distance_matrix(references, references, device=self.device)
+                query_distances[layer] = torch.cat([
+                    distance_matrix(self.activation_quantizer.distance_view(layer, activations[layer]), references,
+                                    device=self.device)
+                    for activations in [self.h_poison_activations, self.h_clean_activations]])
+            resampler = RankResampler(defense_distances, query_distances, self.h_defense_preds.cpu(),
+                                      torch.cat([self.h_poison_preds, self.h_clean_preds]).cpu(),
+                                      k=math.ceil(self.SAMPLES_PER_CLASS * self.ALPHA),
+                                      saturation=self.DEFENSE_TRAIN_SIZE - 1)
+
+        rng = np.random.RandomState(getattr(self.args, 'seed', 0))
+        defense_preds = self.h_defense_preds.cpu().numpy()
+        num_poison, num_clean = len(self.h_poison_preds), len(self.h_clean_preds)
+        replace = mode == 'bootstrap'
+        size = self.NUM_SAMPLES if replace else min(self.NUM_SAMPLES, num_poison, num_clean)
+        records = []
+        with self.profiler.stage('bootstrap/replicates'):
+            for _ in tqdm(range(replicates), desc="Bootstrap replicates", disable=self.headless):
+                defense_rows = []
+                for label in self.all_labels:
+                    rows = np.where(defense_preds == label)[0]
+                    if len(rows) > 0:
+                        defense_rows.extend(rng.choice(rows, self.SAMPLES_PER_CLASS,
+                                                       replace=len(rows) < self.SAMPLES_PER_CLASS))
+                query_rows = np.concatenate([rng.choice(num_poison, size, replace=replace),
+                                             num_poison + rng.choice(num_clean, size, replace=replace)])
+                inputs_all_benign, inputs_all_unknown, kept = resampler.ranks(defense_rows, query_rows)
+                labels_all_unknown = np.where(query_rows < num_poison, self.POISON_TEMP_LABEL,
+                                              self.CLEAN_TEMP_LABEL)[kept]
+                pca = PCA(contamination=0.1, n_components=2)
+                pca.fit(inputs_all_benign)
+                records.append(self.detection_metrics(labels_all_unknown, pca.decision_function(inputs_all_unknown),
+                                                      pca.predict(inputs_all_unknown)))
+
+        self.log(f"\n----------- BOOTSTRAP ({replicates} {mode} replicates, {confidence * 100:.0f}% CI) -----------")
+        tail = (1 - confidence) / 2 * 100
+        results = {'replicates': replicates, 'mode': mode, 'confidence': confidence,
+                   'wall_time': self.profiler.total(['bootstrap/'])}
+        for metric in ['TPR', 'FPR', 'AUC', 'F1']:
+            values = np.array([record[metric] for record in records])
+            low, high = np.percentile(values, [tail, 100 - tail])
+            results[metric] = {'mean': float(values.mean()),
+                               'std': float(values.std(ddof=1)) if replicates > 1 else 0.0,
+                               'ci_low': float(low), 'ci_high': float(high)}
+            self.log(f"{metric}: {values.mean():.4f} [{low:.4f}, {high:.4f}]")
+        with open(os.path.join(self.save_dir, 'bootstrap.json'), 'w') as f:
+            json.dump({'results': results, 'replicates': records}, f, indent=1)
+        self.log(f"Saved bootstrap replicates to {os.path.join(self.save_dir, 'bootstrap.json')}")
+
+        self.layers = resampler.layers
+        self.save_profile()
+        self.emit_record(results)
+        return results
 
     def detect(self):
         """
         Entry point for the detection procedure.
+        With -ted_bootstrap it is the resampled evaluation of bootstrap().
+        Without -ted_artifact this is the original end-to-end test(). With it, the detector is loaded from
+        the artifact (fitted and saved first if the file does not exist yet; 'auto' picks
+        default_artifact_path()) and evaluated through score_batch().
         """
-        self.test()
+        if getattr(self.args, 'ted_bootstrap', 0) > 0:
+            return self.bootstrap()
+        path = getattr(self.args, 'ted_artifact', None)
+        if path is None:
+            return self.test()
+        if path == 'auto':
+            path = self.default_artifact_path()
+
+        start_time = time.perf_counter()
+        if os.path.exists(path):
+            self.load(path)
+        else:
+            self.fit(path)
+        self.log(f"Detector ready in {time.perf_counter() - start_time:.2f}s")
+        return self.evaluate()
 
     def __del__(self):
         for h in self.hook_handles:
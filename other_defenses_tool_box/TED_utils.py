@@ -0,0 +1,1404 @@
+"""
+Helper functions shared by the TED and TEDPLUS defenses.
+    - pairwise_distance: Gram-form euclidean distances with optional cached squared norms.
+    - first_same_label_rank: batched, sort-free rank of the nearest same-label defense sample.
+    - RankIndex / ClassRankIndex / IVFRankIndex: per-layer indices answering first-same-label rank queries.
+    - DefenseGeometry: per-layer defense x defense geometry with per-sample ALPHA thresholds.
+    - allocate_activation_buffer: preallocated activation storage on device, pinned CPU memory or disk.
+    - ActivationReducer: per-layer reduction (pooling / random projection / PCA sketch) applied in the hooks.
+    - ActivationQuantizer: fp16 / bf16 / symmetric int8 storage of the activation matrices.
+    - defense_group_ranks / query_group_ranks / rank_layers: saturated ranks of one layer, and of many layers
+      sharded over a process pool.
+    - distance_matrix / RankResampler: distances of a sample pool computed once, and the saturated ranks of
+      resampled defense / test splits gathered from them (bootstrap evaluation).
+    - TopologicalRepresentation: array-backed rank vectors (samples x layers) grouped by label / Poison / Clean.
+    - LayerCascade: early-exit scoring of rank vectors layer by layer with per-prefix outlier models.
+    - RankThreshold: benign rank quantile threshold, the outlier model of single-layer cascade stages.
+    - select_layers: deterministic greedy choice of hook layers by benign rank value per unit of cost.
+    - forward_flops: Conv2d / Linear FLOPs per sample of the forward pass up to each hooked module.
+    - truncate_after: torch.fx copy of a model that stops after the last call of the given (hooked) modules.
+    - StageProfiler: device-agnostic wall time / CPU time / peak memory per pipeline stage, with a JSON report.
+    - state_sha256: content hash of a model state dict or of a JSON-serializable config, used to key artifacts.
+"""
+import os
+import json
+import time
+import hashlib
+import inspect
+import resource
+import zlib
+from contextlib import contextmanager
+import numpy as np
+import torch
+import torch.multiprocessing
+import torch.nn.functional as F
+from utils.activation_cache import fingerprint
+
+
+def pairwise_distance(x, y, y_sq_norms=None):
+    """
+    Euclidean distances between the rows of `x` and `y` in Gram-matrix form, accumulated in float32.
+    `y_sq_norms` can be passed to reuse the squared norms of a fixed reference matrix.
+    """
+    x = x.float()
+    y = y.float()
+    if y_sq_norms is None:
+        y_sq_norms = (y * y).sum(dim=1)
+    x_sq_norms = (x * x).sum(dim=1)
+    dis = x_sq_norms.unsqueeze(1) + y_sq_norms.unsqueeze(0) - 2 * x.mm(y.t())
+    return dis.clamp_(min=0).sqrt_()
+
+
+def state_sha256(obj):
+    """
+    sha256 hex digest of a model / state dict (parameter names, dtypes, shapes and bytes) or of a
+    JSON-serializable config (utils.activation_cache.fingerprint).
+    """
+    if isinstance(obj, torch.nn.Module):
+        obj = obj.state_dict()
+    if not (isinstance(obj, dict) and all(torch.is_tensor(v) for v in obj.values())):
+        return fingerprint(obj)
+    digest = hashlib.sha256()
+    for name in sorted(obj):
+        tensor = obj[name].detach().cpu().contiguous()
+        digest.update(f'{name}:{tensor.dtype}:{tuple(tensor.shape)}'.encode())
+        digest.update(tensor.view(-1).view(torch.uint8).numpy().tobytes() if tensor.numel() else b'')
+    return digest.hexdigest()
+
+
+def allocate_activation_buffer(num_samples, dim, storage='device', device=None, path=None, dtype=torch.float32):
+    """
+    Preallocate a (num_samples, dim) matrix of `dtype` that activation batches are written into.
+
+    Args:
+        storage: 'device' keeps the matrix on `device` (the original behavior), 'cpu' in host memory
+            (pinned when CUDA is available, so batch copies can be asynchronous) and 'disk' in a
+            memory-mapped .npy file at `path` (bfloat16 is stored as its int16 bit pattern).
+    """
+    if storage == 'device':
+        return torch.empty((num_samples, dim), dtype=dtype, device=device)
+    elif storage == 'cpu':
+        return torch.empty((num_samples, dim), dtype=dtype, pin_memory=torch.cuda.is_available())
+    elif storage == 'disk':
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np_dtype = np.int16 if dtype == torch.bfloat16 else torch.empty(0, dtype=dtype).numpy().dtype
+        buffer = np.lib.format.open_memmap(path, mode='w+', dtype=np_dtype, shape=(num_samples, dim))
+        return torch.from_numpy(buffer).view(dtype)
+    else:
+        raise NotImplementedError('Activation storage %s is not supported' % storage)
+
+
+def first_same_label_rank(queries, query_labels, references, reference_labels,
+                          self_indices=None, chunk_size=256, device=None, reference_sq_norms=None):
+    """
+    Score a whole query matrix against the reference (defense) matrix in one pass.
+
+    For every query this returns the distance to the nearest reference sharing its label and the
+    number of references strictly closer than that neighbour, which is exactly the position the
+    neighbour would take in `torch.sort` of the distance row. No full sort is performed.
+
+    Args:
+        queries: (M, D) activations to rank.
+        query_labels: (M,) labels used to pick the same-label neighbour.
+        references: (N, D) defense activations.
+        reference_labels: (N,) labels of the defense activations.
+        self_indices: optional (M,) indices into `references` to exclude from each query row
+            (used when the queries are defense samples themselves), -1 for no exclusion.
+        chunk_size: number of queries scored at once, bounds memory to chunk_size x N distances.
+        device: device used for the distance computation.
+        reference_sq_norms: optional cached (N,) squared norms of `references`.
+    Returns:
+        nn_dist (M,) float, rank (M,) long and nn_index (M,) long, all on CPU.
+        Queries without any same-label reference get nn_dist = inf and nn_index = -1.
+    """
+    if device is None:
+        device = references.device
+    references = references.to(device)
+    reference_labels = reference_labels.to(device)
+    if reference_sq_norms is None:
+        reference_sq_norms = (references.float() ** 2).sum(dim=1)
+    reference_sq_norms = reference_sq_norms.to(device)
+    query_labels = query_labels.to(device)
+    if self_indices is not None:
+        self_indices = torch.as_tensor(self_indices, dtype=torch.long).to(device)
+
+    num_queries = queries.shape[0]
+    nn_dist = torch.empty(num_queries, dtype=torch.float32)
+    rank = torch.empty(num_queries, dtype=torch.long)
+    nn_index = torch.empty(num_queries, dtype=torch.long)
+
+    for start in range(0, num_queries, chunk_size):
+        end = min(start + chunk_size, num_queries)
+        dis = pairwise_distance(queries[start:end].to(device), references, reference_sq_norms)
+        rows = torch.arange(end - start, device=device)
+
+        if self_indices is not None:
+            chunk_self = self_indices[start:end]
+            valid = chunk_self >= 0
+            dis[rows[valid], chunk_self[valid]] = float('inf')
+
+        same_label = query_labels[start:end].unsqueeze(1) == reference_labels.unsqueeze(0)
+        masked = dis.masked_fill(~same_label, float('inf'))
+        chunk_nn_dist, chunk_nn_index = masked.min(dim=1)
+        chunk_rank = (dis < chunk_nn_dist.unsqueeze(1)).sum(dim=1)
+        chunk_nn_index[torch.isinf(chunk_nn_dist)] = -1
+
+        nn_dist[start:end] = chunk_nn_dist.cpu()
+        rank[start:end] = chunk_rank.cpu()
+        nn_index[start:end] = chunk_nn_index.cpu()
+
+    return nn_dist, rank, nn_index
+
+
+class RankIndex:
+    """
+    Exact brute-force index over one layer of defense activations (the original TED behavior).
+    Every index answers `query(queries, query_labels) -> (nn_dist, rank, nn_index)` with the semantics
+    of `first_same_label_rank`.
+    """
+    kind = 'exact'
+
+    def __init__(self, activations, labels, chunk_size=256, device=None):
+        if device is None:
+            device = activations.device
+        self.device = device
+        self.activations = activations
+        self.labels = labels.to(device)
+        self.chunk_size = chunk_size
+        self.sq_norms = (activations.to(device).float() ** 2).sum(dim=1)
+
+    def query(self, queries, query_labels, self_indices=None):
+        return first_same_label_rank(queries, query_labels, self.activations, self.labels,
+                                     self_indices=self_indices, chunk_size=self.chunk_size,
+                                     device=self.device, reference_sq_norms=self.sq_norms)
+
+
+class PartitionedRankIndex(RankIndex):
+    """
+    Defense activations grouped into partitions, each summarised by its centroid and radius.
+
+    Counting the defense samples closer than the nearest same-label neighbour uses the triangle
+    inequality per (query, partition) pair: a partition entirely inside that distance adds its size,
+    one entirely outside adds nothing, and only straddling partitions are scanned. Subclasses decide
+    which straddling partitions are scanned (`scan`) and how the neighbour itself is found.
+
+    Self exclusion works on member positions (`self_positions`, -1 for none): the excluded member is
+    skipped by the neighbour search, masked in scanned partitions and removed from the size of its
+    partition when that partition is counted whole or estimated.
+    """
+    # slack on the pruning bounds so that float rounding never flips an exact decision
+    rel_eps = 1e-5
+
+    def __init__(self, activations, labels, assignment, chunk_size=256, device=None):
+        super().__init__(activations, labels, chunk_size=chunk_size, device=device)
+        assignment = assignment.to(self.device)
+        self.num_partitions = int(assignment.max().item()) + 1 if assignment.numel() > 0 else 0
+
+        order = torch.argsort(assignment, stable=True)
+        self.member_index = order
+        self.member_position = torch.empty_like(order)
+        self.member_position[order] = torch.arange(order.numel(), device=self.device)
+        self.member_partition = assignment[order]
+        self.member_activations = activations.to(self.device)[order].float()
+        self.member_sq_norms = self.sq_norms[order]
+        self.member_labels = self.labels[order]
+        sizes = torch.bincount(assignment, minlength=self.num_partitions)
+        self.sizes = sizes.float()
+        self.offsets = torch.cat([torch.zeros(1, dtype=torch.long, device=self.device), sizes.cumsum(0)]).tolist()
+
+        dim = self.member_activations.shape[1]
+        self.centroids = torch.zeros(self.num_partitions, dim, device=self.device)
+        self.centroids.index_add_(0, assignment[order], self.member_activations)
+        self.centroids /= self.sizes.clamp(min=1).unsqueeze(1)
+        self.radii = torch.zeros(self.num_partitions, device=self.device)
+        for p in range(self.num_partitions):
+            members = self.partition(p)[0]
+            if members.shape[0] > 0:
+                self.radii[p] = pairwise_distance(self.centroids[p:p + 1], members).max()
+
+    def partition(self, p):
+        start, end = self.offsets[p], self.offsets[p + 1]
+        return self.member_activations[start:end], self.member_sq_norms[start:end], start, end
+
+    def scan(self, queries, query_labels, centroid_dist):
+        """(B, P) mask of the straddling (query, partition) pairs that are counted exactly."""
+        raise NotImplementedError
+
+    def nearest_same_label(self, queries, query_labels, centroid_dist, self_positions):
+        raise NotImplementedError
+
+    def count_closer(self, queries, nn_dist, centroid_dist, scan, self_positions):
+        bound = nn_dist.unsqueeze(1)
+        lower = centroid_dist - self.radii.unsqueeze(0)
+        upper = centroid_dist + self.radii.unsqueeze(0)
+        inside = upper < bound * (1 - self.rel_eps)
+        outside = lower >= bound * (1 + self.rel_eps)
+        straddle = ~inside & ~outside
+
+        sizes = self.sizes.unsqueeze(0).repeat(queries.shape[0], 1)
+        excluded = torch.where(self_positions >= 0)[0]
+        sizes[excluded, self.member_partition[self_positions[excluded]]] -= 1
+
+        counts = (inside.float() * sizes).sum(dim=1)
+        # straddling partitions that are not scanned get a linear estimate of their closer fraction
+        estimated = straddle & ~scan
+        if estimated.any():
+            fraction = ((bound - lower) / (upper - lower).clamp(min=1e-12)).clamp(0, 1)
+            counts += (estimated.float() * fraction * sizes).sum(dim=1)
+
+        scanned = straddle & scan
+        for p in torch.where(scanned.any(dim=0))[0].tolist():
+            rows = torch.where(scanned[:, p])[0]
+            members, member_sq_norms, start, end = self.partition(p)
+            dis = pairwise_distance(queries[rows], members, member_sq_norms)
+            self.mask_self(dis, self_positions[rows], start, end)
+            counts[rows] += (dis < bound[rows]).sum(dim=1).float()
+        return counts.round().long()
+
+    @staticmethod
+    def mask_self(dis, self_positions, start, end):
+        """Set the distance of every row to its excluded member to inf when it lies in [start, end)."""
+        rows = torch.where((self_positions >= start) & (self_positions < end))[0]
+        dis[rows, self_positions[rows] - start] = float('inf')
+
+    def query(self, queries, query_labels, self_indices=None):
+        num_queries = queries.shape[0]
+        nn_dist = torch.empty(num_queries, dtype=torch.float32)
+        rank = torch.empty(num_queries, dtype=torch.long)
+        nn_index = torch.empty(num_queries, dtype=torch.long)
+        query_labels = query_labels.to(self.device)
+        if self_indices is None:
+            self_positions = torch.full((num_queries,), -1, dtype=torch.long, device=self.device)
+        else:
+            self_indices = torch.as_tensor(self_indices, dtype=torch.long).to(self.device)
+            self_positions = torch.where(self_indices >= 0, self.member_position[self_indices.clamp(min=0)],
+                                         self_indices.new_tensor(-1))
+
+        for start in range(0, num_queries, self.chunk_size):
+            end = min(start + self.chunk_size, num_queries)
+            chunk = queries[start:end].to(self.device).float()
+            chunk_labels = query_labels[start:end]
+            chunk_self = self_positions[start:end]
+            centroid_dist = pairwise_distance(chunk, self.centroids)
+            chunk_nn_dist, chunk_nn_index = self.nearest_same_label(chunk, chunk_labels, centroid_dist, chunk_self)
+            scan = self.scan(chunk, chunk_labels, centroid_dist)
+            chunk_rank = self.count_closer(chunk, chunk_nn_dist, centroid_dist, scan, chunk_self)
+
+            nn_dist[start:end] = chunk_nn_dist.cpu()
+            rank[start:end] = chunk_rank.cpu()
+            nn_index[start:end] = chunk_nn_index.cpu()
+        return nn_dist, rank, nn_index
+
+    def nearest_in_members(self, queries, query_labels, start, end, nn_dist, nn_index, rows, self_positions):
+        """Update `nn_dist` / `nn_index` of `rows` with their nearest same-label member in [start, end)."""
+        dis = pairwise_distance(queries[rows], self.member_activations[start:end], self.member_sq_norms[start:end])
+        self.mask_self(dis, self_positions[rows], start, end)
+        same_label = query_labels[rows].unsqueeze(1) == self.member_labels[start:end].unsqueeze(0)
+        dis = dis.masked_fill(~same_label, float('inf'))
+        best_dist, best = dis.min(dim=1)
+        better = best_dist < nn_dist[rows]
+        nn_dist[rows[better]] = best_dist[better]
+        nn_index[rows[better]] = self.member_index[start + best[better]]
+
+
+class ClassRankIndex(PartitionedRankIndex):
+    """
+    Exact index partitioned by predicted label: the neighbour is searched in the query's own class only
+    and every straddling partition is scanned, so ranks match the brute-force index.
+    """
+    kind = 'class'
+
+    def __init__(self, activations, labels, chunk_size=256, device=None):
+        device = activations.device if device is None else device
+        self.partition_labels, assignment = torch.unique(labels.to(device), return_inverse=True)
+        super().__init__(activations, labels, assignment, chunk_size=chunk_size, device=device)
+
+    def scan(self, queries, query_labels, centroid_dist):
+        return torch.ones_like(centroid_dist, dtype=torch.bool)
+
+    def nearest_same_label(self, queries, query_labels, centroid_dist, self_positions):
+        nn_dist = torch.full((queries.shape[0],), float('inf'), device=self.device)
+        nn_index = torch.full((queries.shape[0],), -1, dtype=torch.long, device=self.device)
+        for p, label in enumerate(self.partition_labels.tolist()):
+            rows = torch.where(query_labels == label)[0]
+            if rows.numel() > 0:
+                self.nearest_in_members(queries, query_labels, self.offsets[p], self.offsets[p + 1],
+                                        nn_dist, nn_index, rows, self_positions)
+        return nn_dist, nn_index
+
+
+def kmeans(x, num_clusters, iters=10, seed=0, chunk_size=1024):
+    """Plain seeded Lloyd k-means, returning the cluster assignment of every row of `x`."""
+    x = x.float()
+    generator = torch.Generator().manual_seed(seed)
+    num_clusters = min(num_clusters, x.shape[0])
+    centroids = x[torch.randperm(x.shape[0], generator=generator)[:num_clusters].to(x.device)].clone()
+    assignment = torch.empty(x.shape[0], dtype=torch.long, device=x.device)
+    for _ in range(iters):
+        for start in range(0, x.shape[0], chunk_size):
+            assignment[start:start + chunk_size] = pairwise_distance(x[start:start + chunk_size], centroids).argmin(dim=1)
+        sums = torch.zeros_like(centroids).index_add_(0, assignment, x)
+        counts = torch.bincount(assignment, minlength=num_clusters)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty].unsqueeze(1).float()
+    # drop empty clusters so that partitions are contiguous
+    _, assignment = torch.unique(assignment, return_inverse=True)
+    return assignment
+
+
+class IVFRankIndex(PartitionedRankIndex):
+    """
+    Approximate IVF-flat index: a k-means coarse quantizer with `nlist` inverted lists, of which the
+    `nprobe` closest to each query are scanned exactly. The neighbour is the nearest same-label member
+    of the probed lists (falling back to an exact search of the query's class when none is probed), and
+    closer members of unprobed straddling lists are estimated from the list's centroid and radius.
+    """
+    kind = 'ivf'
+
+    def __init__(self, activations, labels, nlist=64, nprobe=8, chunk_size=256, device=None, seed=0):
+        device = activations.device if device is None else device
+        assignment = kmeans(activations.to(device), nlist, seed=seed)
+        super().__init__(activations, labels, assignment, chunk_size=chunk_size, device=device)
+        self.nprobe = min(nprobe, self.num_partitions)
+        self.class_index = {}
+        member_labels = self.member_labels
+        for label in torch.unique(member_labels).tolist():
+            self.class_index[label] = torch.where(member_labels == label)[0]
+
+    def scan(self, queries, query_labels, centroid_dist):
+        probed = torch.zeros_like(centroid_dist, dtype=torch.bool)
+        probed.scatter_(1, centroid_dist.topk(self.nprobe, dim=1, largest=False)[1], True)
+        return probed
+
+    def nearest_same_label(self, queries, query_labels, centroid_dist, self_positions):
+        nn_dist = torch.full((queries.shape[0],), float('inf'), device=self.device)
+        nn_index = torch.full((queries.shape[0],), -1, dtype=torch.long, device=self.device)
+        probed = self.scan(queries, query_labels, centroid_dist)
+        for p in torch.where(probed.any(dim=0))[0].tolist():
+            rows = torch.where(probed[:, p])[0]
+            self.nearest_in_members(queries, query_labels, self.offsets[p], self.offsets[p + 1],
+                                    nn_dist, nn_index, rows, self_positions)
+
+        for row in torch.where(nn_index < 0)[0].tolist():
+            members = self.class_index.get(int(query_labels[row]))
+            if members is None:
+                continue
+            members = members[members != self_positions[row]]
+            if members.numel() == 0:
+                continue
+            dis = pairwise_distance(queries[row:row + 1], self.member_activations[members],
+                                    self.member_sq_norms[members]).squeeze(0)
+            best = dis.argmin()
+            nn_dist[row] = dis[best]
+            nn_index[row] = self.member_index[members[best]]
+        return nn_dist, nn_index
+
+
+rank_indices = {'exact': RankIndex, 'class': ClassRankIndex, 'ivf': IVFRankIndex}
+
+
+def build_rank_index(kind, activations, labels, chunk_size=256, device=None, **kwargs):
+    """
+    Build the `kind` ('exact', 'class' or 'ivf') first-same-label rank index over one layer.
+    Extra keyword arguments (`nlist`, `nprobe`, `seed`) only apply to the IVF index.
+    """
+    if kind not in rank_indices:
+        raise NotImplementedError('Rank index %s is not supported' % kind)
+    if kind != 'ivf':
+        kwargs = {}
+    return rank_indices[kind](activations, labels, chunk_size=chunk_size, device=device, **kwargs)
+
+
+class DefenseGeometry:
+    """
+    Precomputed geometry of one layer of defense activations.
+
+    A single blockwise pass over the defense x defense distance matrix (chunked Gram form with cached
+    squared norms, so memory stays at chunk_size x N) yields, for every defense sample,
+        - its `k` nearest same-label distances, self excluded by index (`knn_dist`),
+        - its ALPHA threshold, i.e. the k-th of those distances (`thresholds`),
+        - its own first-same-label rank against the rest of the defense set (`nn_dist`, `rank`, `nn_index`).
+    Queries are then ranked with `query` (through a `RankIndex` of kind `index`) and saturated with
+    `saturate` by looking thresholds up by index. `add` appends defense samples in place.
+    """
+
+    def __init__(self, activations, labels, k, chunk_size=256, device=None, index='exact', **index_kwargs):
+        if device is None:
+            device = activations.device
+        self.device = device
+        self.activations = activations
+        self.labels = labels.to(device)
+        self.k = k
+        self.chunk_size = chunk_size
+        self.index_kind, self.index_kwargs = index, index_kwargs
+        self.index = build_rank_index(index, activations, labels, chunk_size=chunk_size, device=device,
+                                      **index_kwargs)
+        self.sq_norms = self.index.sq_norms
+
+        num_defense = activations.shape[0]
+        kk = max(1, min(k, num_defense))
+        self.knn_dist = torch.empty(num_defense, kk, dtype=torch.float32)
+        self.nn_dist = torch.empty(num_defense, dtype=torch.float32)
+        self.rank = torch.empty(num_defense, dtype=torch.long)
+        self.nn_index = torch.empty(num_defense, dtype=torch.long)
+
+        references = activations.to(device)
+        for start in range(0, num_defense, chunk_size):
+            end = min(start + chunk_size, num_defense)
+            rows = torch.arange(end - start, device=device)
+            dis = pairwise_distance(references[start:end], references, self.sq_norms)
+            dis[rows, rows + start] = float('inf')
+
+            same_label = self.labels[start:end].unsqueeze(1) == self.labels.unsqueeze(0)
+            masked = dis.masked_fill(~same_label, float('inf'))
+            knn_dist, knn_index = torch.topk(masked, kk, dim=1, largest=False)
+            chunk_nn_dist = knn_dist[:, 0]
+            chunk_nn_index = knn_index[:, 0]
+            chunk_nn_index[torch.isinf(chunk_nn_dist)] = -1
+
+            self.knn_dist[start:end] = knn_dist.cpu()
+            self.nn_dist[start:end] = chunk_nn_dist.cpu()
+            self.rank[start:end] = (dis < chunk_nn_dist.unsqueeze(1)).sum(dim=1).cpu()
+            self.nn_index[start:end] = chunk_nn_index.cpu()
+
+        self.thresholds = self.compute_thresholds(self.knn_dist)
+
+    def state_dict(self):
+        """
+        Everything needed to score against this layer without redoing the defense x defense pass.
+        """
+        return {
+            'activations': self.activations.cpu(), 'labels': self.labels.cpu(), 'k': self.k,
+            'knn_dist': self.knn_dist, 'nn_dist': self.nn_dist, 'rank': self.rank, 'nn_index': self.nn_index,
+            'thresholds': self.thresholds,
+        }
+
+    @classmethod
+    def from_state_dict(cls, state, chunk_size=256, device=None, index='exact', rank_index=None, **index_kwargs):
+        """
+        Restore a geometry saved with `state_dict`; only the rank index is rebuilt, unless an index already
+        built over the same activations is passed as `rank_index`.
+        """
+        geometry = cls.__new__(cls)
+        geometry.device = device if device is not None else state['activations'].device
+        geometry.activations = state['activations']
+        geometry.labels = state['labels'].to(geometry.device)
+        geometry.k = state['k']
+        geometry.chunk_size = chunk_size
+        geometry.index_kind, geometry.index_kwargs = index, index_kwargs
+        if rank_index is None:
+            rank_index = build_rank_index(index, geometry.activations, geometry.labels, chunk_size=chunk_size,
+                                          device=geometry.device, **index_kwargs)
+        geometry.index = rank_index
+        geometry.sq_norms = geometry.index.sq_norms
+        for key in ['knn_dist', 'nn_dist', 'rank', 'nn_index', 'thresholds']:
+            setattr(geometry, key, state[key])
+        return geometry
+
+    def add(self, activations, labels):
+        """
+        Append defense samples and update the geometry in place, computing only what they can change:
+            - the new rows, against the whole (old + new) set,
+            - for every old sample, its k nearest same-label distances merged with its distances to the new
+              samples of its label, and its rank increased by the new samples closer than its neighbour;
+              only the old samples whose neighbour becomes a new sample are recounted against the whole set,
+            - the thresholds (from the merged distances) and the rank index.
+        That is O(k N) distances plus one row per changed neighbour instead of the O(N^2) rebuild, with the
+        same result as a DefenseGeometry built on the concatenated samples.
+        Returns the indices of the old samples whose neighbour changed.
+        """
+        device = self.device
+        num_old, num_new = self.activations.shape[0], activations.shape[0]
+        num_defense = num_old + num_new
+        kk = max(1, min(self.k, num_defense))
+        new_labels = labels.to(device)
+        all_labels = torch.cat([self.labels, new_labels])
+        references = torch.cat([self.activations, activations.to(self.activations.device, self.activations.dtype)])
+        device_references = references.to(device)
+        sq_norms = torch.cat([self.sq_norms, (device_references[num_old:].float() ** 2).sum(dim=1)])
+
+        knn_dist = torch.empty(num_new, kk, dtype=torch.float32)
+        nn_dist = torch.empty(num_new, dtype=torch.float32)
+        rank = torch.empty(num_new, dtype=torch.long)
+        nn_index = torch.empty(num_new, dtype=torch.long)
+        cross = torch.empty(num_new, num_old, device=device)
+        for start in range(0, num_new, self.chunk_size):
+            end = min(start + self.chunk_size, num_new)
+            rows = torch.arange(end - start, device=device)
+            dis = pairwise_distance(device_references[num_old + start:num_old + end], device_references, sq_norms)
+            dis[rows, rows + num_old + start] = float('inf')
+            cross[start:end] = dis[:, :num_old]
+
+            masked = dis.masked_fill(new_labels[start:end].unsqueeze(1) != all_labels.unsqueeze(0), float('inf'))
+            chunk_knn_dist, chunk_knn_index = torch.topk(masked, kk, dim=1, largest=False)
+            chunk_nn_dist = chunk_knn_dist[:, 0]
+            chunk_nn_index = chunk_knn_index[:, 0]
+            chunk_nn_index[torch.isinf(chunk_nn_dist)] = -1
+
+            knn_dist[start:end] = chunk_knn_dist.cpu()
+            nn_dist[start:end] = chunk_nn_dist.cpu()
+            rank[start:end] = (dis < chunk_nn_dist.unsqueeze(1)).sum(dim=1).cpu()
+            nn_index[start:end] = chunk_nn_index.cpu()
+
+        # old rows: only their distances to the new samples are new
+        cross = cross.t()
+        masked = cross.masked_fill(self.labels.unsqueeze(1) != new_labels.unsqueeze(0), float('inf'))
+        old_knn_dist = self.knn_dist.to(device)
+        if old_knn_dist.shape[1] < kk:
+            old_knn_dist = F.pad(old_knn_dist, (0, kk - old_knn_dist.shape[1]), value=float('inf'))
+        old_knn_dist = torch.topk(torch.cat([old_knn_dist, masked], dim=1), kk, dim=1, largest=False)[0]
+        closest_new_dist, closest_new = masked.min(dim=1)
+        old_nn_dist = self.nn_dist.to(device)
+        changed = torch.where(closest_new_dist < old_nn_dist)[0]
+        old_rank = self.rank.to(device) + (cross < old_nn_dist.unsqueeze(1)).sum(dim=1)
+        old_nn_index = self.nn_index.to(device)
+        old_nn_dist[changed] = closest_new_dist[changed]
+        old_nn_index[changed] = closest_new[changed] + num_old
+        for start in range(0, len(changed), self.chunk_size):
+            rows = changed[start:start + self.chunk_size]
+            dis = pairwise_distance(device_references[rows], device_references, sq_norms)
+            dis[torch.arange(len(rows), device=device), rows] = float('inf')
+            old_rank[rows] = (dis < old_nn_dist[rows].unsqueeze(1)).sum(dim=1)
+
+        self.activations = references
+        self.labels = all_labels
+        self.knn_dist = torch.cat([old_knn_dist.cpu(), knn_dist])
+        self.nn_dist = torch.cat([old_nn_dist.cpu(), nn_dist])
+        self.rank = torch.cat([old_rank.cpu(), rank])
+        self.nn_index = torch.cat([old_nn_index.cpu(), nn_index])
+        self.thresholds = self.compute_thresholds(self.knn_dist)
+        self.index = build_rank_index(self.index_kind, references, all_labels, chunk_size=self.chunk_size,
+                                      device=device, **self.index_kwargs)
+        self.sq_norms = self.index.sq_norms
+        return changed.cpu()
+
+    @staticmethod
+    def compute_thresholds(knn_dist):
+        """
+        The k-th nearest same-label distance, or the farthest one available for small classes
+        (inf when a sample is alone in its class).
+        """
+        num_finite = torch.isfinite(knn_dist).sum(dim=1)
+        last = (num_finite - 1).clamp(min=0).unsqueeze(1)
+        thresholds = knn_dist.gather(1, last).squeeze(1)
+        thresholds[num_finite == 0] = float('inf')
+        return thresholds
+
+    def query(self, queries, query_labels, self_indices=None):
+        """
+        First-same-label rank of `queries` against the defense set, answered by the layer's rank index.
+        """
+        return self.index.query(queries, query_labels, self_indices=self_indices)
+
+    def saturate(self, nn_dist, rank, nn_index, saturation):
+        """
+        Replace ranks whose neighbour lies outside that neighbour's ALPHA region with `saturation`.
+        Returns a LongTensor holding only the queries that found a same-label neighbour.
+        """
+        found = nn_index >= 0
+        nn_dist, rank, nn_index = nn_dist[found], rank[found], nn_index[found]
+        outside = nn_dist > self.thresholds[nn_index]
+        return torch.where(outside, torch.full_like(rank, saturation), rank)
+
+
+def defense_group_ranks(geometry, preds, label, saturation):
+    """
+    Saturated ranks of the defense samples predicted as `label`, straight from the cached geometry (self
+    excluded by index), with their indices in the defense set. Samples without a same-label neighbour are dropped.
+    """
+    candidate_indices = torch.where(preds == label)[0].cpu()
+    nn_index = geometry.nn_index[candidate_indices]
+    ranks = geometry.saturate(geometry.nn_dist[candidate_indices], geometry.rank[candidate_indices], nn_index,
+                              saturation)
+    return ranks, candidate_indices[nn_index >= 0]
+
+
+def query_group_ranks(geometry, activations, preds, saturation):
+    """
+    Saturated ranks of new samples against the defense set, in the label-grouped order of the original
+    per-label loop, with their indices in `activations`.
+    """
+    order = torch.sort(preds, stable=True)[1]
+    nn_dist, rank, nn_index = geometry.query(activations[order], preds[order])
+    return geometry.saturate(nn_dist, rank, nn_index, saturation), order.cpu()[nn_index >= 0]
+
+
+def layer_geometry(task):
+    """The DefenseGeometry of one layer from a rank_layer / defense_layer task, on the CPU."""
+    return DefenseGeometry(task['defense_activations'], task['defense_preds'], task['k'],
+                           chunk_size=task['chunk_size'], device=torch.device('cpu'), index=task['index'],
+                           **task['index_kwargs'])
+
+
+def rank_layer(task):
+    """
+    All the ranks of one layer: its DefenseGeometry, the defense groups and the query groups of `task`
+    (a dict built by the caller). Returns the geometry state without its activations, {label: (ranks, origin)}
+    and {group: (ranks, origin)}.
+    """
+    geometry = layer_geometry(task)
+    defense = {label: defense_group_ranks(geometry, task['defense_preds'], label, task['saturation'])
+               for label in task['labels']}
+    queries = {group: query_group_ranks(geometry, activations, preds, task['saturation'])
+               for group, (activations, preds) in task['queries'].items()}
+    state = geometry.state_dict()
+    state['activations'] = None
+    return state, defense, queries
+
+
+def defense_layer(task):
+    """
+    The defense side of `rank_layer`: the DefenseGeometry of one layer and the ranks of its defense groups.
+    Returns the geometry state without its activations, the geometry's rank index (so that the caller does not
+    build it again) and {label: (ranks, origin)}.
+    """
+    geometry = layer_geometry(task)
+    defense = {label: defense_group_ranks(geometry, task['defense_preds'], label, task['saturation'])
+               for label in task['labels']}
+    state = geometry.state_dict()
+    state['activations'] = None
+    return state, geometry.index, defense
+
+
+def query_layer(task):
+    """The query side of `rank_layer`: {group: (ranks, origin)} of the query groups against task['geometry']."""
+    return {group: query_group_ranks(task['geometry'], activations, preds, task['saturation'])
+            for group, (activations, preds) in task['queries'].items()}
+
+
+def shared_tensor(h):
+    """`h` on the CPU in shared memory, so that worker processes receive a handle instead of a pickled copy."""
+    h = h.cpu()
+    if h.is_shared():
+        return h
+    try:
+        return h.share_memory_()
+    except RuntimeError:
+        # e.g. tensors over a numpy memory map
+        return h.clone().share_memory_()
+
+
+def share_tensors(obj):
+    """`obj` with every tensor in it (through dicts and tuples) moved to shared memory."""
+    if torch.is_tensor(obj):
+        return shared_tensor(obj)
+    if isinstance(obj, dict):
+        return {key: share_tensors(value) for key, value in obj.items()}
+    if isinstance(obj, tuple):
+        return tuple(share_tensors(value) for value in obj)
+    return obj
+
+
+def rank_layers(tasks, workers=1, function=rank_layer):
+    """
+    `function` (rank_layer, defense_layer or query_layer) over every task (one per layer), sharded over a pool
+    of `workers` processes. Tensors are moved to shared memory (the tasks keep the shared copies) and results
+    come back in task order, so the output does not depend on `workers`. Workers are started by a fork server
+    (spawned where there is none) rather than forked from this process, whose intra-op thread pool may
+    already be running.
+    """
+    if workers <= 1 or len(tasks) <= 1:
+        return [function(task) for task in tasks]
+    for task in tasks:
+        task.update(share_tensors(task))
+    workers = min(workers, len(tasks))
+    method = 'forkserver' if 'forkserver' in torch.multiprocessing.get_all_start_methods() else 'spawn'
+    with torch.multiprocessing.get_context(method).Pool(workers, initializer=torch.set_num_threads,
+                                                        initargs=(max(1, (os.cpu_count() or 1) // workers),)) as pool:
+        return pool.map(function, tasks, chunksize=1)
+
+
+def distance_matrix(queries, references, chunk_size=256, device=None):
+    """
+    (M, N) float32 euclidean distances between `queries` and `references`, computed chunk_size queries at
+    a time on `device` and returned on the CPU.
+    """
+    if device is None:
+        device = references.device
+    references = references.to(device)
+    sq_norms = (references.float() ** 2).sum(dim=1)
+    dis = torch.empty(queries.shape[0], references.shape[0], dtype=torch.float32)
+    for start in range(0, queries.shape[0], chunk_size):
+        end = min(start + chunk_size, queries.shape[0])
+        dis[start:end] = pairwise_distance(queries[start:end].to(device), references, sq_norms).cpu()
+    return dis
+
+
+class RankResampler:
+    """
+    Saturated TED ranks of resampled defense / test splits, from the distances of a sample pool computed once.
+
+    `defense_distances[layer]` is the (N, N) distance matrix of the pooled defense samples and
+    `query_distances[layer]` the (M, N) distances of the pooled Poison / Clean samples to them. `ranks` takes
+    the pool rows of one replicate's defense set and test samples and gives what DefenseGeometry,
+    defense_group_ranks and query_group_ranks compute on those samples (self excluded by position, ALPHA
+    thresholds from the k nearest same-label defense samples), by gathering sub-matrices instead of running
+    the model and the distance passes again.
+    """
+
+    def __init__(self, defense_distances, query_distances, defense_labels, query_labels, k, saturation):
+        self.layers = list(defense_distances)
+        self.defense_distances = defense_distances
+        self.query_distances = query_distances
+        self.defense_labels = torch.as_tensor(defense_labels).cpu()
+        self.query_labels = torch.as_tensor(query_labels).cpu()
+        self.k = k
+        self.saturation = saturation
+
+    def layer_ranks(self, layer, defense_rows, query_rows):
+        """
+        (rank, nn_index) of the defense rows against each other and of the query rows against the defense rows
+        in `layer`, ranks already saturated. nn_index is -1 where no same-label defense sample exists.
+        """
+        labels = self.defense_labels[defense_rows]
+        dis = self.defense_distances[layer][defense_rows][:, defense_rows].clone()
+        positions = torch.arange(len(defense_rows))
+        dis[positions, positions] = float('inf')
+        masked = dis.masked_fill(labels.unsqueeze(1) != labels.unsqueeze(0), float('inf'))
+        knn_dist, knn_index = torch.topk(masked, max(1, min(self.k, len(defense_rows))), dim=1, largest=False)
+        thresholds = DefenseGeometry.compute_thresholds(knn_dist)
+
+        def saturate(dis, nn_dist, nn_index):
+            rank = (dis < nn_dist.unsqueeze(1)).sum(dim=1)
+            nn_index[torch.isinf(nn_dist)] = -1
+            outside = nn_dist > thresholds[nn_index.clamp(min=0)]
+            return torch.where(outside, torch.full_like(rank, self.saturation), rank), nn_index
+
+        defense = saturate(dis, knn_dist[:, 0], knn_index[:, 0])
+        dis = self.query_distances[layer][query_rows][:, defense_rows]
+        nn_dist, nn_index = dis.masked_fill(self.query_labels[query_rows].unsqueeze(1) != labels.unsqueeze(0),
+                                            float('inf')).min(dim=1)
+        return defense, saturate(dis, nn_dist, nn_index)
+
+    def ranks(self, defense_rows, query_rows):
+        """
+        Rank matrices (samples x layers) of one replicate: the benign defense rows and the query rows, without
+        the samples that have no same-label defense sample (as in TopologicalRepresentation), and the kept
+        position mask of the query rows.
+        """
+        defense_rows = torch.as_tensor(defense_rows, dtype=torch.long)
+        query_rows = torch.as_tensor(query_rows, dtype=torch.long)
+        benign, unknown = [], []
+        for layer in self.layers:
+            (defense_rank, defense_nn), (query_rank, query_nn) = self.layer_ranks(layer, defense_rows, query_rows)
+            benign.append(defense_rank[defense_nn >= 0])
+            unknown.append(query_rank[query_nn >= 0])
+        # whether a same-label defense sample exists does not depend on the layer
+        return torch.stack(benign, dim=1).numpy(), torch.stack(unknown, dim=1).numpy(), (query_nn >= 0).numpy()
+
+
+class TopologicalRepresentation:
+    """
+    TED rank vectors grouped by defense label or by 'Poison' / 'Clean'.
+
+    All groups live in one preallocated (capacity, num_layers) integer matrix, int16 when `max_rank` fits
+    and int32 otherwise. A group is the contiguous block of rows allocated on its first `write`, and
+    `origin` holds, for every row, the index of its sample in the activation set it was ranked from.
+    `matrix` returns a view (no copy) when the requested groups were allocated one after the other.
+    """
+
+    def __init__(self, layers, max_rank, capacity):
+        self.layers = list(layers)
+        self.columns = {layer: column for column, layer in enumerate(self.layers)}
+        self.dtype = np.int16 if max_rank <= np.iinfo(np.int16).max else np.int32
+        self.ranks = np.zeros((capacity, len(self.layers)), dtype=self.dtype)
+        self.origin = np.full(capacity, -1, dtype=np.int64)
+        self.groups = {}
+        self.size = 0
+
+    def write(self, group, layer, ranks, origin):
+        """
+        Store the ranks of `group` in `layer`; the group's rows are allocated from `origin` on its first write.
+        """
+        ranks = ranks.cpu().numpy() if torch.is_tensor(ranks) else np.asarray(ranks)
+        if group not in self.groups:
+            origin = origin.cpu().numpy() if torch.is_tensor(origin) else np.asarray(origin)
+            end = self.size + len(origin)
+            if end > len(self.ranks):
+                raise ValueError('TopologicalRepresentation capacity %d exceeded by group %s' % (len(self.ranks), group))
+            self.groups[group] = (self.size, end)
+            self.origin[self.size:end] = origin
+            self.size = end
+        start, end = self.groups[group]
+        if len(ranks) != end - start:
+            raise ValueError('Group %s has %d rows, got %d ranks for layer %s' % (group, end - start, len(ranks), layer))
+        self.ranks[start:end, self.columns[layer]] = ranks
+
+    def group(self, group):
+        start, end = self.groups[group]
+        return self.ranks[start:end]
+
+    def column(self, group, layer):
+        return self.group(group)[:, self.columns[layer]]
+
+    def matrix(self, groups):
+        """
+        (num_rows, num_layers) rank matrix of `groups`, in the given order.
+        """
+        spans = [self.groups[group] for group in groups]
+        if not spans:
+            return self.ranks[:0]
+        if all(spans[i][1] == spans[i + 1][0] for i in range(len(spans) - 1)):
+            return self.ranks[spans[0][0]:spans[-1][1]]
+        return np.concatenate([self.ranks[start:end] for start, end in spans])
+
+    def group_labels(self, groups):
+        """
+        The group name of every row of `matrix(groups)`.
+        """
+        if not groups:
+            return np.array([])
+        return np.concatenate([np.repeat(group, self.groups[group][1] - self.groups[group][0]) for group in groups])
+
+    def save(self, directory):
+        """
+        ranks.npy and origin.npy (used rows only) plus groups.json with the layer names and group row spans.
+        """
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'ranks.npy'), self.ranks[:self.size])
+        np.save(os.path.join(directory, 'origin.npy'), self.origin[:self.size])
+        groups = [[group if isinstance(group, str) else int(group), start, end]
+                  for group, (start, end) in self.groups.items()]
+        with open(os.path.join(directory, 'groups.json'), 'w') as f:
+            json.dump({'layers': self.layers, 'groups': groups}, f)
+
+    @classmethod
+    def load(cls, directory, mmap_mode=None):
+        """
+        Reload a representation written by `save`; `mmap_mode='r'` maps the matrices instead of reading them.
+        """
+        with open(os.path.join(directory, 'groups.json')) as f:
+            meta = json.load(f)
+        representation = cls.__new__(cls)
+        representation.layers = meta['layers']
+        representation.columns = {layer: column for column, layer in enumerate(representation.layers)}
+        representation.ranks = np.load(os.path.join(directory, 'ranks.npy'), mmap_mode=mmap_mode)
+        representation.origin = np.load(os.path.join(directory, 'origin.npy'), mmap_mode=mmap_mode)
+        representation.dtype = representation.ranks.dtype
+        representation.groups = {group: (start, end) for group, start, end in meta['groups']}
+        representation.size = len(representation.ranks)
+        return representation
+
+
+class RankThreshold:
+    """
+    Outlier model of a single rank column with the pyod interface used by LayerCascade: the score is the
+    rank itself (poisoned samples rank far from their predicted class) and the threshold is its benign
+    (1 - contamination) quantile, as pyod thresholds its decision scores. A PCA on one column has no
+    residual subspace to score.
+    """
+
+    def __init__(self, contamination=0.1):
+        self.contamination = contamination
+
+    def fit(self, ranks):
+        self.decision_scores_ = self.decision_function(ranks)
+        self.threshold_ = np.percentile(self.decision_scores_, 100 * (1 - self.contamination))
+        return self
+
+    def decision_function(self, ranks):
+        return np.asarray(ranks, dtype=np.float64).reshape(len(ranks), -1)[:, 0]
+
+
+class LayerCascade:
+    """
+    Early-exit scoring of rank vectors, one layer column at a time in `order`.
+
+    Stage s scores the ranks of the first s layers of `order` with its own outlier model, built by
+    `make_model(s)` and fitted on the same prefix of the benign rank vectors. Stage scores are centered on
+    the model's threshold and divided by the std of its benign training scores, so `margin` is in benign-std
+    units at every stage: a sample exits at stage s once its score is below -margin (benign) or above
+    +margin (poison). The last stage decides all remaining samples, with the score sign as prediction.
+    """
+
+    def __init__(self, benign_ranks, order, make_model):
+        self.order = list(order)
+        self.models = []
+        self.scales = []
+        for stage in range(1, len(self.order) + 1):
+            model = make_model(stage)
+            model.fit(benign_ranks[:, self.order[:stage]])
+            self.models.append(model)
+            self.scales.append(max(float(np.std(model.decision_scores_)), 1e-12))
+
+    def stage_scores(self, stage, ranks):
+        model = self.models[stage]
+        return (model.decision_function(ranks[:, self.order[:stage + 1]]) - model.threshold_) / self.scales[stage]
+
+    def run(self, layer_ranks, num_samples, margin):
+        """
+        Args:
+            layer_ranks: callable (column, rows) -> ranks of the samples `rows` in layer `column`; it is only
+                called for the samples still undecided at that stage.
+            margin: exit margin in benign-std units (inf disables early exits).
+        Returns:
+            scores, binary predictions and the number of layers evaluated, per sample.
+        """
+        ranks = np.zeros((num_samples, max(self.order) + 1), dtype=np.int64)
+        scores = np.empty(num_samples)
+        layers_used = np.zeros(num_samples, dtype=np.int64)
+        active = np.arange(num_samples)
+        for stage, column in enumerate(self.order):
+            ranks[active, column] = np.asarray(layer_ranks(column, active))
+            stage_scores = self.stage_scores(stage, ranks[active])
+            if stage == len(self.order) - 1:
+                decided = np.ones(len(active), dtype=bool)
+            else:
+                decided = np.abs(stage_scores) > margin
+            scores[active[decided]] = stage_scores[decided]
+            layers_used[active[decided]] = stage + 1
+            active = active[~decided]
+            if len(active) == 0:
+                break
+        return scores, (scores > 0).astype(int), layers_used
+
+
+def select_layers(benign_ranks, saturation, compute_costs, memory_costs, compute_budget=None, memory_budget=None):
+    """
+    Greedy, deterministic choice of the layer columns of `benign_ranks` worth hooking under a budget.
+
+    The value of a layer is how tight the benign classes are in it, 1 - mean(rank) / saturation: a layer
+    where benign samples already rank far from their own class leaves no room for a trigger to stand out.
+    The marginal gain of a layer is its value times (1 - its largest absolute rank correlation with the
+    layers already selected), so near-duplicate hook points such as a Conv2d and the ReLU right after it
+    are not selected together. Layers are taken by best gain per unit cost (compute cost, or memory cost when
+    only a memory budget is set; ties go to the earlier layer), skipping those that would exceed a budget.
+    At least one layer is always selected. The costs must be deterministic (e.g. FLOPs, not measured time)
+    for the choice to be.
+
+    Returns:
+        selected: sorted column indices.
+        report: one (column, value, gain at selection or None, selected) tuple per column.
+    """
+    benign_ranks = np.asarray(benign_ranks, dtype=np.float64)
+    num_layers = benign_ranks.shape[1]
+    values = 1 - benign_ranks.mean(axis=0) / max(saturation, 1)
+    centered = benign_ranks - benign_ranks.mean(axis=0)
+    norms = np.sqrt((centered ** 2).sum(axis=0))
+    correlation = np.zeros((num_layers, num_layers))
+    valid = norms > 0
+    correlation[np.ix_(valid, valid)] = np.abs(centered[:, valid].T @ centered[:, valid]) / np.outer(norms[valid],
+                                                                                                    norms[valid])
+    costs = np.asarray(compute_costs if compute_budget is not None or memory_budget is None else memory_costs,
+                       dtype=np.float64)
+    costs = np.maximum(costs, 1e-12)
+
+    selected, gains = [], {}
+    used_compute, used_memory = 0.0, 0.0
+    remaining = list(range(num_layers))
+    while remaining:
+        redundancy = correlation[np.ix_(remaining, selected)].max(axis=1) if selected else np.zeros(len(remaining))
+        gain = values[remaining] * (1 - redundancy)
+        position = int(np.argmax(gain / costs[remaining]))
+        best, best_gain = remaining.pop(position), float(gain[position])
+        over_compute = compute_budget is not None and used_compute + compute_costs[best] > compute_budget
+        over_memory = memory_budget is not None and used_memory + memory_costs[best] > memory_budget
+        if selected and (over_compute or over_memory or best_gain <= 0):
+            continue
+        selected.append(best)
+        gains[best] = best_gain
+        used_compute += compute_costs[best]
+        used_memory += memory_costs[best]
+
+    report = [(column, float(values[column]), gains.get(column), column in gains) for column in range(num_layers)]
+    return sorted(selected), report
+
+
+def forward_flops(model, inputs, modules):
+    """
+    FLOPs per sample (2 x multiply-accumulates of the Conv2d and Linear layers) of the forward pass of `inputs`
+    up to the last call of every module of `modules` ({name: module}). Depends on the architecture and the
+    input size only.
+    """
+    total, reached, handles = [0.0], {}, []
+
+    def count(module, input, output):
+        if isinstance(module, torch.nn.Conv2d):
+            macs = output.numel() * module.in_channels // module.groups * int(np.prod(module.kernel_size))
+        else:
+            macs = output.numel() * module.in_features
+        total[0] += 2.0 * macs / output.shape[0]
+
+    def mark(name):
+        def hook(module, input, output):
+            reached[name] = total[0]
+        return hook
+
+    for module in model.modules():
+        if isinstance(module, (torch.nn.Conv2d, torch.nn.Linear)):
+            handles.append(module.register_forward_hook(count))
+    for name, module in modules.items():
+        handles.append(module.register_forward_hook(mark(name)))
+    try:
+        with torch.no_grad():
+            model(inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return reached
+
+
+def truncate_after(model, modules):
+    """
+    Symbolically trace `model` and cut its graph right after the last call (in execution order) of any of
+    `modules`, which becomes the output. Keyword arguments with defaults (return_hidden, ...) are fixed to
+    their defaults. The traced graph shares its submodules with `model`, so forward hooks registered on
+    `modules` still fire. Returns None when the model cannot be traced or calls none of `modules`.
+    """
+    from torch import fx
+    parameters = list(inspect.signature(model.forward).parameters.values())[1:]
+    concrete_args = {p.name: p.default for p in parameters if p.default is not inspect.Parameter.empty}
+    try:
+        traced = fx.symbolic_trace(model, concrete_args=concrete_args)
+    except Exception:
+        return None
+
+    module_names = {id(module): name for name, module in model.named_modules()}
+    targets = {module_names[id(module)] for module in modules if id(module) in module_names}
+    last = None
+    for node in traced.graph.nodes:
+        if node.op == 'call_module' and node.target in targets:
+            last = node
+    if last is None:
+        return None
+
+    graph, env = fx.Graph(), {}
+    for node in traced.graph.nodes:
+        env[node] = graph.node_copy(node, lambda n: env[n])
+        if node is last:
+            break
+    graph.output(env[last])
+    return fx.GraphModule(traced, graph)
+
+
+class ActivationReducer:
+    """
+    Per-layer reduction applied on-device inside the forward hooks, before activations are stored.
+
+    Methods (`dim` is the reduction parameter k):
+        - 'none': the flattened layer output (original TED behavior).
+        - 'avgpool': adaptive average pooling of conv feature maps to k x k cells (k=1 is global pooling).
+        - 'gaussian': seeded Gaussian random projection to k dims.
+        - 'sparse': seeded very sparse random projection (density 1/sqrt(D)) to k dims.
+        - 'pca': projection on the top-k directions of a Frequent Directions sketch, fitted by streaming
+          the defense set through the hooks between `start_fit()` and `finish_fit()`.
+    Random projections and sketches are built per layer the first time its input size is known, so the
+    same seed always gives the same projection for a given layer name. Gaussian projections are drawn in
+    blocks of `chunk_rows` input rows; those larger than `max_dense_mb` are never stored but redrawn block
+    by block from the layer's seed and applied to the matching input columns on every call.
+    Layers whose flattened size is already <= k are left untouched by the projection methods.
+    """
+    methods = ['none', 'avgpool', 'gaussian', 'sparse', 'pca']
+    chunk_rows = 4096
+    max_dense_mb = 64
+
+    def __init__(self, method='none', dim=None, seed=0):
+        if method not in self.methods:
+            raise NotImplementedError('Activation reduction %s is not supported' % method)
+        self.method = method
+        self.dim = dim if dim is not None else (1 if method == 'avgpool' else 256)
+        self.seed = seed
+        self.projections = {}
+        self.sketches = {}
+        self.fitting = False
+
+    def __call__(self, name, output):
+        if self.method == 'none':
+            return output
+        if self.method == 'avgpool':
+            if output.dim() == 4:
+                output = F.adaptive_avg_pool2d(output, self.dim)
+            return output.reshape(output.shape[0], -1)
+
+        h = output.reshape(output.shape[0], -1).float()
+        if h.shape[1] <= self.dim:
+            return h
+        if self.method == 'pca' and self.fitting:
+            self.update_sketch(name, h)
+            return h[:, :0]
+        return self.project(name, h)
+
+    def layer_generator(self, name):
+        return torch.Generator().manual_seed(self.seed + zlib.crc32(name.encode()))
+
+    def project(self, name, h):
+        key = (name, h.device)
+        if key not in self.projections:
+            if self.method == 'pca':
+                if name not in self.sketches:
+                    raise RuntimeError('PCA reduction for layer %s has not been fitted' % name)
+                self.projections[key] = self.sketch_components(name).t().contiguous().to(h.device)
+            elif self.method == 'gaussian' and h.shape[1] * self.dim * 4 > self.max_dense_mb * 2 ** 20:
+                return self.streamed_projection(name, h)
+            else:
+                self.projections[key] = self.random_projection(name, h.shape[1]).to(h.device)
+        projection = self.projections[key]
+        if projection.is_sparse:
+            return torch.sparse.mm(projection.t(), h.t()).t()
+        return h.mm(projection)
+
+    def random_projection(self, name, input_dim):
+        """
+        (input_dim, k) projection, scaled so that squared distances are preserved in expectation.
+        """
+        if self.method == 'gaussian':
+            return torch.cat([block for _, block in self.gaussian_blocks(name, input_dim)])
+
+        # nnz distinct cells, so that every non-zero entry is exactly +-1 / sqrt(density * k)
+        generator = self.layer_generator(name)
+        density = 1 / np.sqrt(input_dim)
+        nnz = max(1, int(round(density * input_dim * self.dim)))
+        cells = torch.empty(0, dtype=torch.long)
+        while cells.numel() < nnz:
+            drawn = torch.randint(input_dim * self.dim, (nnz - cells.numel(),), generator=generator)
+            cells = torch.unique(torch.cat([cells, drawn]))
+        signs = torch.randint(2, (nnz,), generator=generator).float() * 2 - 1
+        values = signs / np.sqrt(density * self.dim)
+        indices = torch.stack([cells // self.dim, cells % self.dim])
+        return torch.sparse_coo_tensor(indices, values, (input_dim, self.dim)).coalesce()
+
+    def gaussian_blocks(self, name, input_dim):
+        """(first row, block) pairs of the gaussian projection, drawn in order from the layer's generator."""
+        generator = self.layer_generator(name)
+        for start in range(0, input_dim, self.chunk_rows):
+            rows = min(self.chunk_rows, input_dim - start)
+            yield start, torch.randn(rows, self.dim, generator=generator) / np.sqrt(self.dim)
+
+    def streamed_projection(self, name, h):
+        """h @ gaussian projection without materializing it: one block of rows at a time."""
+        out = torch.zeros(h.shape[0], self.dim, device=h.device)
+        for start, block in self.gaussian_blocks(name, h.shape[1]):
+            out += h[:, start:start + block.shape[0]].mm(block.to(h.device))
+        return out
+
+    def state_dict(self):
+        return {'method': self.method, 'dim': self.dim, 'seed': self.seed,
+                'sketches': {name: sketch.cpu() for name, sketch in self.sketches.items()}}
+
+    def load_state_dict(self, state):
+        """
+        Restore a reducer saved with `state_dict`. Random projections are rebuilt from the seed,
+        PCA projections from the saved sketches.
+        """
+        self.method, self.dim, self.seed = state['method'], state['dim'], state['seed']
+        self.sketches = dict(state['sketches'])
+        self.projections = {}
+        self.fitting = False
+
+    def start_fit(self):
+        self.fitting = True
+        self.sketches = {}
+        self.projections = {}
+
+    def finish_fit(self):
+        self.fitting = False
+
+    def update_sketch(self, name, h):
+        """
+        Frequent Directions update with a 2k-row sketch: stack the batch under the sketch, then shrink
+        all squared singular values by the (2k)-th one so that only 2k directions survive.
+        """
+        ell = 2 * self.dim
+        sketch = self.sketches.get(name)
+        stacked = h if sketch is None else torch.cat([sketch.to(h.device), h], dim=0)
+        _, singular, vh = torch.linalg.svd(stacked, full_matrices=False)
+        if singular.shape[0] > ell:
+            shrunk = (singular[:ell] ** 2 - singular[ell] ** 2).clamp(min=0).sqrt()
+            stacked = shrunk.unsqueeze(1) * vh[:ell]
+        else:
+            stacked = singular.unsqueeze(1) * vh
+        self.sketches[name] = stacked
+
+    def sketch_components(self, name):
+        _, _, vh = torch.linalg.svd(self.sketches[name], full_matrices=False)
+        return vh[:self.dim]
+
+
+class ActivationQuantizer:
+    """
+    Storage precision of the captured activation matrices. Distances are always accumulated in float32
+    (`pairwise_distance` upcasts), only the stored matrices shrink.
+
+    Precisions:
+        - 'float32': unchanged (original TED behavior).
+        - 'float16' / 'bfloat16': plain casts.
+        - 'int8': symmetric int8, q = round(x / scale) clamped to [-127, 127]. The scale of each layer is
+          max |x| / 127 over the first `calibration_samples` defense activations, per layer or per channel
+          (one scale per column of the flattened activation), tracked batch by batch by `observe` and fixed
+          by `finish_calibration` before anything is stored; every later batch is quantized directly into
+          int8 with it and clamped.
+    With a per-layer scale every distance of a layer is multiplied by the same constant, which changes
+    neither ranks nor the comparisons against the ALPHA thresholds, so the int8 codes are compared as they
+    are. With per-channel scales `distance_view` dequantizes one layer at a time to float32.
+    """
+    precisions = {'float32': torch.float32, 'float16': torch.float16, 'bfloat16': torch.bfloat16,
+                  'int8': torch.int8}
+    granularities = ['layer', 'channel']
+    calibration_samples = 512
+
+    def __init__(self, precision='float32', granularity='layer'):
+        if precision not in self.precisions:
+            raise NotImplementedError('Activation precision %s is not supported' % precision)
+        if granularity not in self.granularities:
+            raise NotImplementedError('Activation quantization granularity %s is not supported' % granularity)
+        self.precision = precision
+        self.granularity = granularity
+        self.dtype = self.precisions[precision]
+        self.scales = {}
+        self.amax = {}
+
+    def state_dict(self):
+        return {'precision': self.precision, 'granularity': self.granularity,
+                'scales': {name: scale.cpu() for name, scale in self.scales.items()}}
+
+    def load_state_dict(self, state):
+        self.precision, self.granularity = state['precision'], state['granularity']
+        self.dtype = self.precisions[self.precision]
+        self.scales = dict(state['scales'])
+        self.amax = {}
+
+    def needs_calibration(self, name):
+        return self.precision == 'int8' and name not in self.scales
+
+    def buffer_dtype(self, name):
+        """
+        dtype to allocate for `name`: float32 until an int8 layer is calibrated, the storage dtype after.
+        """
+        return torch.float32 if self.needs_calibration(name) else self.dtype
+
+    def observe(self, name, h):
+        """
+        Fold a batch of flattened (float) defense activations of `name` into its running max |x|.
+        """
+        h = h.float()
+        amax = h.abs().amax(dim=0) if self.granularity == 'channel' else h.abs().max()
+        self.amax[name] = amax if name not in self.amax else torch.maximum(self.amax[name], amax)
+
+    def finish_calibration(self):
+        """
+        Fix the int8 scales of the observed layers from their running max |x|.
+        """
+        for name, amax in self.amax.items():
+            self.scales[name] = (amax / 127).clamp(min=1e-12)
+        self.amax = {}
+
+    def __call__(self, name, h):
+        """
+        Quantize a batch of flattened activations of `name` to the storage dtype.
+        Uncalibrated int8 layers are passed through in float32 (see `observe`).
+        """
+        if self.precision == 'float32' or self.needs_calibration(name):
+            return h.float()
+        if self.precision != 'int8':
+            return h.to(self.dtype)
+        scale = self.scales[name].to(h.device)
+        return torch.round(h.float() / scale).clamp_(-127, 127).to(torch.int8)
+
+    def distance_view(self, name, h):
+        """
+        `h` (stored activations of `name`) in a form whose euclidean distances order like the float32 ones.
+        """
+        if self.precision == 'int8' and self.granularity == 'channel':
+            return h.float() * self.scales[name].to(h.device)
+        return h
+
+
+class StageProfiler:
+    """
+    Wall time, CPU time and memory of named pipeline stages, on any device.
+
+    Usage:
+        profiler = StageProfiler(trace='rank/', trace_dir='TED/cifar10/badnet')
+        with profiler.stage('capture/poison'):
+            ...
+        profiler.save('TED/cifar10/badnet/profile.json')
+
+    A stage entered several times (e.g. 'rank/query/<layer>' once per group) accumulates its times and keeps
+    the highest peaks. Per stage:
+        - wall_s / cpu_s: wall-clock and process CPU time (CPU time of pool workers is not included),
+        - rss_mb / rss_delta_mb: current process RSS (/proc/self/statm) at the end of the stage and its change
+          between entry and exit (what the stage left resident, not its transient peak),
+        - cumulative_peak_rss_mb: process RSS high-water mark since start-up (ru_maxrss) at the end of the stage,
+          which includes every earlier stage,
+        - peak_cuda_mb: peak CUDA memory allocated during the stage (0 without CUDA).
+    Stages whose name starts with `trace` also run under torch.profiler and export a Chrome trace to
+    `trace_dir`.
+    """
+
+    def __init__(self, trace=None, trace_dir='.'):
+        self.trace = trace
+        self.trace_dir = trace_dir
+        self.stages = {}
+
+    @staticmethod
+    def synchronize():
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    @staticmethod
+    def cumulative_peak_rss_mb():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    @staticmethod
+    def rss_mb():
+        """Current RSS of the process; the lifetime peak where /proc is not available."""
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+        except (OSError, ValueError, IndexError):
+            return StageProfiler.cumulative_peak_rss_mb()
+
+    @contextmanager
+    def stage(self, name):
+        self.synchronize()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        rss_before = self.rss_mb()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        if self.trace is not None and name.startswith(self.trace):
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            with torch.profiler.profile(activities=activities, profile_memory=True) as profile:
+                yield
+            os.makedirs(self.trace_dir, exist_ok=True)
+            profile.export_chrome_trace(os.path.join(self.trace_dir, 'trace_%s.json' % name.replace('/', '_')))
+        else:
+            yield
+        self.synchronize()
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        rss_after = self.rss_mb()
+        peak_cuda = torch.cuda.max_memory_allocated() / 2 ** 20 if torch.cuda.is_available() else 0.0
+
+        record = self.stages.setdefault(name, {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'rss_mb': 0.0,
+                                               'rss_delta_mb': 0.0, 'cumulative_peak_rss_mb': 0.0,
+                                               'peak_cuda_mb': 0.0})
+        record['calls'] += 1
+        record['wall_s'] += wall
+        record['cpu_s'] += cpu
+        record['rss_mb'] = max(record['rss_mb'], rss_after)
+        record['rss_delta_mb'] += rss_after - rss_before
+        record['cumulative_peak_rss_mb'] = max(record['cumulative_peak_rss_mb'], self.cumulative_peak_rss_mb())
+        record['peak_cuda_mb'] = max(record['peak_cuda_mb'], peak_cuda)
+
+    def total(self, prefixes, key='wall_s'):
+        """Sum of `key` over the stages whose name starts with one of `prefixes`."""
+        return sum(record[key] for name, record in self.stages.items() if name.startswith(tuple(prefixes)))
+
+    def report(self):
+        return {'device': 'cuda' if torch.cuda.is_available() else 'cpu', 'stages': self.stages}
+
+    def summary(self):
+        lines = ['%-32s %6s %10s %10s %12s %16s %12s' % ('stage', 'calls', 'wall s', 'cpu s', 'RSS delta MB',
+                                                         'cum. peak RSS MB', 'peak CUDA MB')]
+        for name, record in self.stages.items():
+            lines.append('%-32s %6d %10.3f %10.3f %12.1f %16.1f %12.1f' % (
+                name, record['calls'], record['wall_s'], record['cpu_s'], record['rss_delta_mb'],
+                record['cumulative_peak_rss_mb'], record['peak_cuda_mb']))
+        return '\n'.join(lines)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+        return path
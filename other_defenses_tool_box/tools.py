@@ -11,6 +11,8 @@ import numpy as np
 from torchvision.utils import save_image
 from utils import supervisor
 from utils.tools import IMG_Dataset
+from utils.image_shards import image_folder, open_shards
+from utils import eval_cache
 import config
 from torch.utils import data
 import torchvision.transforms.functional as Ft
@@ -48,7 +50,36 @@ def to_numpy(x, **kwargs) -> np.ndarray:
 def tanh_func(x: torch.Tensor) -> torch.Tensor:
     return (x.tanh() + 1) * 0.5
 
-def generate_dataloader(dataset='cifar10', dataset_path='./data/', batch_size=128, split='train', shuffle=True, drop_last=False, data_transform=None, noisy_test=False):
+def generate_dataloader(dataset='cifar10', dataset_path='./data/', batch_size=128, split='train', shuffle=True, drop_last=False, data_transform=None, noisy_test=False,
+                        shard_dir=None, backend=None, cache_eval=None):
+    """
+    `shard_dir`: read the ImageFolder / imagenet splits from their pre-resized uint8 shards (utils.image_shards,
+    built by build_image_shards.py) where they are built; None falls back to config.shard_dir.
+    `backend`: 'torch' (DataLoader) or 'ffcv' (CPU FFCV Loader over a .beton written once to
+    <dataset_path>/ffcv_cache, see utils.imagenet_ffcv.get_cpu_ffcv_loader; needs ffcv installed);
+    None falls back to config.loader_backend.
+    `cache_eval`: serve the evaluation splits (utils.eval_cache.EVAL_SPLITS) of the torch backend from one
+    in-memory tensor per (dataset, split, transform), built on the first pass and shared by later loaders (see
+    utils.eval_cache.cached_loader); None enables it when config.eval_cache_mb > 0 (off by default).
+    """
+    if shard_dir is None:
+        shard_dir = config.shard_dir
+    if backend is None:
+        backend = config.loader_backend
+    if backend == 'ffcv':
+        from utils import imagenet_ffcv
+        loader = generate_dataloader(dataset, dataset_path, batch_size, split, shuffle, drop_last, data_transform,
+                                     noisy_test, shard_dir, backend='torch', cache_eval=False)
+        return imagenet_ffcv.get_cpu_ffcv_loader(loader.dataset, os.path.join(dataset_path, 'ffcv_cache'),
+                                                 '%s_%s' % (dataset, split), batch_size=loader.batch_size,
+                                                 num_workers=loader.num_workers, drop_last=loader.drop_last,
+                                                 shuffle=isinstance(loader.sampler, data.RandomSampler))
+    if cache_eval is None:
+        cache_eval = config.eval_cache_mb > 0
+    if cache_eval and split in eval_cache.EVAL_SPLITS and not noisy_test:
+        loader = generate_dataloader(dataset, dataset_path, batch_size, split, shuffle, drop_last, data_transform,
+                                     noisy_test, shard_dir, backend='torch', cache_eval=False)
+        return eval_cache.cached_loader(loader, '%s_%s' % (dataset, split), config.eval_cache_mb)
     if dataset == 'cifar10':
         if data_transform is None:
             data_transform = transforms.Compose([
@@ -182,12 +213,12 @@ def generate_dataloader(dataset='cifar10', dataset_path='./data/', batch_size=12
         dataset_path = os.path.join(dataset_path, 'imagenette2')
 
         if split == 'train':
-            train_data = datasets.ImageFolder(os.path.join(dataset_path, 'train'), data_transform)
+            train_data = image_folder(os.path.join(dataset_path, 'train'), data_transform, shard_dir)
             train_data_loader = torch.utils.data.DataLoader(dataset=train_data, batch_size=batch_size, shuffle=shuffle,
                                            drop_last=drop_last, num_workers=32, pin_memory=True)
             return train_data_loader
         elif split == 'std_test' or split == 'full_test':
-            test_data = datasets.ImageFolder(os.path.join(dataset_path, 'val'), data_transform)
+            test_data = image_folder(os.path.join(dataset_path, 'val'), data_transform, shard_dir)
             test_data_loader = torch.utils.data.DataLoader(dataset=test_data, batch_size=batch_size, shuffle=shuffle,
                                           drop_last=drop_last, num_workers=32, pin_memory=True)
             return test_data_loader
@@ -220,12 +251,12 @@ def generate_dataloader(dataset='cifar10', dataset_path='./data/', batch_size=12
         dataset_path = os.path.join(dataset_path, 'imagenet50')
 
         if split == 'train':
-            train_data = datasets.ImageFolder(os.path.join(dataset_path, 'train'), data_transform)
+            train_data = image_folder(os.path.join(dataset_path, 'train'), data_transform, shard_dir)
             train_data_loader = torch.utils.data.DataLoader(dataset=train_data, batch_size=batch_size, shuffle=shuffle,
                                            drop_last=drop_last, num_workers=32, pin_memory=True)
             return train_data_loader
         elif split == 'std_test' or split == 'full_test':
-            test_data = datasets.ImageFolder(os.path.join(dataset_path, 'val'), data_transform)
+            test_data = image_folder(os.path.join(dataset_path, 'val'), data_transform, shard_dir)
             test_data_loader = torch.utils.data.DataLoader(dataset=test_data, batch_size=batch_size, shuffle=shuffle,
                                           drop_last=drop_last, num_workers=32, pin_memory=True)
             return test_data_loader
@@ -258,12 +289,12 @@ def generate_dataloader(dataset='cifar10', dataset_path='./data/', batch_size=12
         dataset_path = os.path.join(dataset_path, 'imagenet100')
 
         if split == 'train':
-            train_data = datasets.ImageFolder(os.path.join(dataset_path, 'train'), data_transform)
+            train_data = image_folder(os.path.join(dataset_path, 'train'), data_transform, shard_dir)
             train_data_loader = torch.utils.data.DataLoader(dataset=train_data, batch_size=batch_size, shuffle=shuffle,
                                            drop_last=drop_last, num_workers=32, pin_memory=True)
             return train_data_loader
         elif split == 'std_test' or split == 'full_test':
-            test_data = datasets.ImageFolder(os.path.join(dataset_path, 'val'), data_transform)
+            test_data = image_folder(os.path.join(dataset_path, 'val'), data_transform, shard_dir)
             test_data_loader = torch.utils.data.DataLoader(dataset=test_data, batch_size=batch_size, shuffle=shuffle,
                                           drop_last=drop_last, num_workers=32, pin_memory=True)
             return test_data_loader
@@ -296,12 +327,12 @@ def generate_dataloader(dataset='cifar10', dataset_path='./data/', batch_size=12
         dataset_path = os.path.join(dataset_path, 'imagenet200')
 
         if split == 'train':
-            train_data = datasets.ImageFolder(os.path.join(dataset_path, 'train'), data_transform)
+            train_data = image_folder(os.path.join(dataset_path, 'train'), data_transform, shard_dir)
             train_data_loader = torch.utils.data.DataLoader(dataset=train_data, batch_size=batch_size, shuffle=shuffle,
                                            drop_last=drop_last, num_workers=32, pin_memory=True)
             return train_data_loader
         elif split == 'std_test' or split == 'full_test':
-            test_data = datasets.ImageFolder(os.path.join(dataset_path, 'val'), data_transform)
+            test_data = image_folder(os.path.join(dataset_path, 'val'), data_transform, shard_dir)
             test_data_loader = torch.utils.data.DataLoader(dataset=test_data, batch_size=batch_size, shuffle=shuffle,
                                           drop_last=drop_last, num_workers=32, pin_memory=True)
             return test_data_loader
@@ -323,8 +354,8 @@ def generate_dataloader(dataset='cifar10', dataset_path='./data/', batch_size=12
 
             from torch.utils.data import ConcatDataset, DataLoader
 
-            test_data = datasets.ImageFolder(os.path.join(dataset_path, 'test'), data_transform)
-            val_data = datasets.ImageFolder(os.path.join(dataset_path, 'val'), data_transform)
+            test_data = image_folder(os.path.join(dataset_path, 'test'), data_transform, shard_dir)
+            val_data = image_folder(os.path.join(dataset_path, 'val'), data_transform, shard_dir)
 
             merged_data = ConcatDataset([test_data, val_data])
             test_loader = DataLoader(dataset=merged_data, batch_size=batch_size, shuffle=shuffle,
@@ -346,12 +377,12 @@ def generate_dataloader(dataset='cifar10', dataset_path='./data/', batch_size=12
         dataset_path = os.path.join(dataset_path, 'tinyimagenet200')
 
         if split == 'train':
-            train_data = datasets.ImageFolder(os.path.join(dataset_path, 'train'), data_transform)
+            train_data = image_folder(os.path.join(dataset_path, 'train'), data_transform, shard_dir)
             train_data_loader = torch.utils.data.DataLoader(dataset=train_data, batch_size=batch_size, shuffle=shuffle,
                                            drop_last=drop_last, num_workers=32, pin_memory=True)
             return train_data_loader
         elif split == 'std_test' or split == 'full_test':
-            test_data = datasets.ImageFolder(os.path.join(dataset_path, 'val'), data_transform)
+            test_data = image_folder(os.path.join(dataset_path, 'val'), data_transform, shard_dir)
             test_data_loader = torch.utils.data.DataLoader(dataset=test_data, batch_size=batch_size, shuffle=shuffle,
                                           drop_last=drop_last, num_workers=32, pin_memory=True)
             return test_data_loader
@@ -373,8 +404,8 @@ def generate_dataloader(dataset='cifar10', dataset_path='./data/', batch_size=12
 
             from torch.utils.data import ConcatDataset, DataLoader
 
-            test_data = datasets.ImageFolder(os.path.join(dataset_path, 'test'), data_transform)
-            val_data = datasets.ImageFolder(os.path.join(dataset_path, 'val'), data_transform)
+            test_data = image_folder(os.path.join(dataset_path, 'test'), data_transform, shard_dir)
+            val_data = image_folder(os.path.join(dataset_path, 'val'), data_transform, shard_dir)
 
             merged_data = ConcatDataset([test_data, val_data])
             test_loader = DataLoader(dataset=merged_data, batch_size=batch_size, shuffle=shuffle,
@@ -399,18 +430,24 @@ def generate_dataloader(dataset='cifar10', dataset_path='./data/', batch_size=12
         train_set_dir = os.path.join(config.imagenet_dir, 'train')
         test_set_dir = os.path.join(config.imagenet_dir, 'val')
         if split == 'train':
-            train_data = imagenet.imagenet_dataset(directory=train_set_dir, data_transform=data_transform, poison_directory=None,
-                                             poison_indices=None, target_class=config.target_class['imagenet'], num_classes=1000)
+            train_data = open_shards(shard_dir, train_set_dir, data_transform)
+            if train_data is None:
+                train_data = imagenet.imagenet_dataset(directory=train_set_dir, data_transform=data_transform, poison_directory=None,
+                                                 poison_indices=None, target_class=config.target_class['imagenet'], num_classes=1000)
             train_data_loader = torch.utils.data.DataLoader(dataset=train_data, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last, num_workers=32, pin_memory=True)
             return train_data_loader
         elif split == 'std_test' or split == 'full_test':
-            test_data = imagenet.imagenet_dataset(directory=test_set_dir, shift=False, data_transform=data_transform,
-                                                label_file=imagenet.test_set_labels, num_classes=1000)
+            test_data = open_shards(shard_dir, test_set_dir, data_transform)
+            if test_data is None:
+                test_data = imagenet.imagenet_dataset(directory=test_set_dir, shift=False, data_transform=data_transform,
+                                                    label_file=imagenet.test_set_labels, num_classes=1000)
             test_data_loader = torch.utils.data.DataLoader(dataset=test_data, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last, num_workers=32, pin_memory=True)
             return test_data_loader
         elif split == 'valid' or split == 'val':
-            test_data = imagenet.imagenet_dataset(directory=test_set_dir, shift=False, data_transform=data_transform,
-                                                label_file=imagenet.test_set_labels, num_classes=1000)
+            test_data = open_shards(shard_dir, test_set_dir, data_transform)
+            if test_data is None:
+                test_data = imagenet.imagenet_dataset(directory=test_set_dir, shift=False, data_transform=data_transform,
+                                                    label_file=imagenet.test_set_labels, num_classes=1000)
             val_split_meta_dir = os.path.join('clean_set', 'imagenet', 'clean_split')
             val_split_indices = torch.load(os.path.join(val_split_meta_dir, 'clean_split_indices'))
             val_set = torch.utils.data.Subset(test_data, val_split_indices)
@@ -418,8 +455,10 @@ def generate_dataloader(dataset='cifar10', dataset_path='./data/', batch_size=12
             val_loader = torch.utils.data.DataLoader(val_set, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last, num_workers=32, pin_memory=True)
             return val_loader
         elif split == 'test':
-            test_data = imagenet.imagenet_dataset(directory=test_set_dir, shift=False, data_transform=data_transform,
-                                                label_file=imagenet.test_set_labels, num_classes=1000)
+            test_data = open_shards(shard_dir, test_set_dir, data_transform)
+            if test_data is None:
+                test_data = imagenet.imagenet_dataset(directory=test_set_dir, shift=False, data_transform=data_transform,
+                                                    label_file=imagenet.test_set_labels, num_classes=1000)
             test_split_meta_dir = os.path.join('clean_set', 'imagenet', 'test_split')
             test_indices = torch.load(os.path.join(test_split_meta_dir, 'test_indices'))
             test_data = torch.utils.data.Subset(test_data, test_indices)
@@ -430,9 +469,10 @@ def generate_dataloader(dataset='cifar10', dataset_path='./data/', batch_size=12
         print('<To Be Implemented> Dataset = %s' % dataset)
         exit(0)
 
-def unpack_poisoned_train_set(args, batch_size=128, shuffle=False, data_transform=None):
+def unpack_poisoned_train_set(args, batch_size=128, shuffle=False, data_transform=None, backend=None):
     """
     Return with `poison_set_dir`, `poisoned_set_loader`, `poison_indices`, and `cover_indices` if available
+    `backend='ffcv'` loads the poisoned set through a CPU FFCV Loader (see generate_dataloader)
     """
     if data_transform is None:
         data_transform_aug, data_transform, trigger_transform, normalizer, denormalizer = supervisor.get_transforms(args)
@@ -450,7 +490,15 @@ def unpack_poisoned_train_set(args, batch_size=128, shuffle=False, data_transfor
     poisoned_set = IMG_Dataset(data_dir=poisoned_set_img_dir,
                                 label_path=poisoned_set_label_path, transforms=data_transform)
 
-    poisoned_set_loader = torch.utils.data.DataLoader(poisoned_set, batch_size=batch_size, shuffle=shuffle, num_workers=32, pin_memory=True)
+    if backend is None:
+        backend = config.loader_backend
+    if backend == 'ffcv':
+        from utils import imagenet_ffcv
+        poisoned_set_loader = imagenet_ffcv.get_cpu_ffcv_loader(poisoned_set, os.path.join(poison_set_dir, 'ffcv_cache'),
+                                                                'poisoned_set', batch_size=batch_size, num_workers=32,
+                                                                shuffle=shuffle)
+    else:
+        poisoned_set_loader = torch.utils.data.DataLoader(poisoned_set, batch_size=batch_size, shuffle=shuffle, num_workers=32, pin_memory=True)
 
     poison_indices = torch.load(poison_indices_path)
     
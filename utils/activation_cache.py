@@ -0,0 +1,196 @@
+"""
+Disk-backed activation cache shared by TED, TEDPLUS and the layer visualization scripts.
+
+An entry lives in <root>/<key>/: one .npy file per array (per-layer activations, labels, predictions, ...)
+and a manifest.json holding the key components (checkpoint sha256, dataset signature with split indices and
+transform, hooked layers, reduction, ...), the stored arrays, the entry size and its last use time.
+The key is the sha256 of the components, so changing any component addresses another entry, and an entry
+whose manifest does not match its components is dropped. Entries are written once (to a temporary directory
+renamed into place, so concurrent writers never expose half an entry), read back as zero-copy memory maps,
+and the cache directory is kept under `max_mb` by evicting the least recently used entries.
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+import torch
+from torch.utils import data
+
+
+def fingerprint(obj):
+    """sha256 hex digest of a JSON-serializable object (keys sorted, unknown types through str)."""
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def array_sha256(array):
+    if torch.is_tensor(array):
+        array = array.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy()
+    return hashlib.sha256(np.ascontiguousarray(array).tobytes()).hexdigest()
+
+
+def file_stats(path):
+    """
+    [size, mtime_ns] of the file `path`, or one [name, size, mtime_ns] per entry directly under the directory
+    `path` (so rewriting an image or label file in place changes it); None if `path` does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+    if os.path.isdir(path):
+        return sorted([entry.name, entry.stat().st_size, entry.stat().st_mtime_ns] for entry in os.scandir(path))
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def dataset_signature(dataset):
+    """
+    What the samples of `dataset` depend on: Subsets by their indices, in-memory tensor datasets by their
+    content, file-backed datasets by their type, location, length, transform and the size and mtime of their
+    image and label files.
+    """
+    if isinstance(dataset, data.Subset):
+        return {'subset': array_sha256(np.asarray(dataset.indices, dtype=np.int64)),
+                'dataset': dataset_signature(dataset.dataset)}
+    for attr in ['images', 'tensors']:
+        content = getattr(dataset, attr, None)
+        if torch.is_tensor(content) or isinstance(content, np.ndarray):
+            return {'type': type(dataset).__name__, 'content': array_sha256(content)}
+    transform = getattr(dataset, 'transforms', None) or getattr(dataset, 'transform', None)
+    paths = [getattr(dataset, attr, None) for attr in ['dir', 'directory', 'root', 'label_path', 'label_file']]
+    return {
+        'type': type(dataset).__name__,
+        'location': getattr(dataset, 'dir', None) or getattr(dataset, 'root', None),
+        'length': len(dataset),
+        'transform': repr(transform),
+        'files': {str(path): file_stats(path) for path in paths if isinstance(path, (str, os.PathLike))},
+    }
+
+
+class ActivationCache:
+    """
+    Usage:
+        cache = ActivationCache('cache/activations', max_mb=20000)
+        arrays = cache.load(components)          # dict name -> tensor backed by a memory map, or None
+        if arrays is None:
+            cache.store(components, arrays)      # dict name -> tensor / ndarray
+    """
+    manifest_name = 'manifest.json'
+
+    def __init__(self, root, max_mb=None):
+        self.root = root
+        self.max_mb = max_mb
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def normalize(components):
+        return json.loads(json.dumps(components, sort_keys=True, default=str))
+
+    def key(self, components):
+        return fingerprint(self.normalize(components))
+
+    def entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def read_manifest(self, key):
+        try:
+            with open(os.path.join(self.entry_dir(key), self.manifest_name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_manifest(self, directory, manifest):
+        tmp_path = os.path.join(directory, self.manifest_name + f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, os.path.join(directory, self.manifest_name))
+
+    def load(self, components):
+        """
+        The arrays stored under `components` as CPU tensors over copy-on-write memory maps (nothing is read
+        until it is used), or None on a miss. A hit refreshes the entry's last use time.
+        """
+        key = self.key(components)
+        manifest = self.read_manifest(key)
+        if manifest is None:
+            return None
+        if manifest['components'] != self.normalize(components):
+            self.invalidate(key)
+            return None
+        arrays = {}
+        try:
+            for name, dtype in manifest['arrays'].items():
+                array = torch.from_numpy(np.load(os.path.join(self.entry_dir(key), name + '.npy'), mmap_mode='c'))
+                arrays[name] = array.view(torch.bfloat16) if dtype == 'torch.bfloat16' else array
+        except (OSError, ValueError):
+            self.invalidate(key)
+            return None
+        manifest['last_used'] = time.time()
+        self.write_manifest(self.entry_dir(key), manifest)
+        return arrays
+
+    def store(self, components, arrays):
+        """
+        Write `arrays` (dict name -> tensor / ndarray) once under `components`, then evict down to max_mb.
+        Returns the entry key.
+        """
+        key = self.key(components)
+        tmp_dir = os.path.join(self.root, f'.{key}.{os.getpid()}.tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        dtypes, size = {}, 0
+        for name, array in arrays.items():
+            if torch.is_tensor(array):
+                dtypes[name] = str(array.dtype)
+                array = array.detach().cpu()
+                array = (array.view(torch.int16) if array.dtype == torch.bfloat16 else array).numpy()
+            else:
+                dtypes[name] = str(array.dtype)
+            np.save(os.path.join(tmp_dir, name + '.npy'), np.ascontiguousarray(array))
+            size += array.nbytes
+        now = time.time()
+        self.write_manifest(tmp_dir, {'components': self.normalize(components), 'arrays': dtypes,
+                                      'size_mb': size / 2 ** 20, 'created': now, 'last_used': now})
+        try:
+            os.rename(tmp_dir, self.entry_dir(key))
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict(keep=key)
+        return key
+
+    def entries(self):
+        """(key, manifest) of every complete entry."""
+        entries = []
+        for key in os.listdir(self.root):
+            if key.startswith('.'):
+                continue
+            manifest = self.read_manifest(key)
+            if manifest is not None:
+                entries.append((key, manifest))
+        return entries
+
+    def size_mb(self):
+        return sum(manifest['size_mb'] for _, manifest in self.entries())
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries (never `keep`) until the cache fits in max_mb.
+        """
+        if self.max_mb is None:
+            return
+        entries = sorted(self.entries(), key=lambda entry: entry[1]['last_used'])
+        total = sum(manifest['size_mb'] for _, manifest in entries)
+        for key, manifest in entries:
+            if total <= self.max_mb:
+                break
+            if key == keep:
+                continue
+            self.invalidate(key)
+            total -= manifest['size_mb']
+
+    def invalidate(self, key):
+        shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+
+    def clear(self):
+        for key, _ in self.entries():
+            self.invalidate(key)
@@ -0,0 +1,127 @@
+"""
+In-memory evaluation splits shared by every loader of a run (opt-in: config.eval_cache_mb > 0).
+
+The clean evaluation splits of CIFAR-10 / GTSRB / MNIST fit in memory as one transformed tensor, yet STRIP,
+ScaleUp, CD, Frequency, ... iterate them through DataLoaders with per-sample PIL transforms to score, again for
+inspect_correct_predition_only, and tools.test once more. With the cache enabled, generate_dataloader wraps the
+DataLoader of the 'test', 'val' / 'valid' and 'std_test' / 'full_test' splits in a TensorSplitLoader (see
+cached_loader). Nothing is read when it is created: the first pass over any loader of a key (dataset, split,
+dataset signature with the transform) runs the split through its transform once with the DataLoader's workers,
+and every later pass of every loader of that key slices the resulting contiguous tensor. Splits with random
+transforms, custom samplers or more than config.eval_cache_mb of samples are iterated by their DataLoader.
+"""
+import time
+import torch
+from torch.utils import data
+from utils.activation_cache import dataset_signature, fingerprint
+from utils.tools import flatten_transform, dataset_leaves, transform_attr
+
+EVAL_SPLITS = ('test', 'val', 'valid', 'std_test', 'full_test')
+
+splits = {}  # key -> EvalSplit, or None for a split found too large to cache
+
+
+class EvalSplit:
+    def __init__(self, name, images, labels, build_time):
+        self.name = name
+        self.images = images
+        self.labels = labels
+        self.build_time = build_time
+        self.passes = 0
+
+    def size_mb(self):
+        return (self.images.numel() * self.images.element_size() + self.labels.numel() * 8) / 2 ** 20
+
+
+def build_split(name, loader, max_mb):
+    """Run `loader.dataset` through its transform once in order; None if it exceeds max_mb."""
+    dataset = loader.dataset
+    start = time.perf_counter()
+    first, _ = dataset[0]
+    if not torch.is_tensor(first) or len(dataset) * first.numel() * first.element_size() > max_mb * 2 ** 20:
+        return None
+    pin_memory = loader.pin_memory and torch.cuda.is_available()
+    images = torch.empty((len(dataset),) + tuple(first.shape), dtype=first.dtype, pin_memory=pin_memory)
+    labels = torch.empty(len(dataset), dtype=torch.long, pin_memory=pin_memory)
+    offset = 0
+    for x, y in data.DataLoader(dataset, batch_size=loader.batch_size, shuffle=False,
+                                num_workers=loader.num_workers):
+        images[offset:offset + len(x)] = x
+        labels[offset:offset + len(x)] = torch.as_tensor(y)
+        offset += len(x)
+    return EvalSplit(name, images, labels, time.perf_counter() - start)
+
+
+class TensorSplitLoader:
+    """
+    Wraps the DataLoader of an evaluation split. Batches are copies of contiguous slices of the cached split (of
+    a random permutation per pass when the DataLoader shuffles), so callers may modify them in place; the split
+    is built on the first pass. `dataset`, `batch_size`, `drop_last`, `num_workers`, `pin_memory` and `sampler`
+    are the DataLoader's.
+    """
+
+    def __init__(self, loader, key, name, max_mb):
+        self.loader = loader
+        self.key = key
+        self.name = name
+        self.max_mb = max_mb
+        self.dataset = loader.dataset
+        self.batch_size = loader.batch_size
+        self.drop_last = loader.drop_last
+        self.num_workers = loader.num_workers
+        self.pin_memory = loader.pin_memory
+        self.sampler = loader.sampler
+        self.shuffle = isinstance(loader.sampler, data.RandomSampler)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def split(self):
+        if self.key not in splits:
+            splits[self.key] = build_split(self.name, self.loader, self.max_mb)
+        return splits[self.key]
+
+    def __iter__(self):
+        split = self.split()
+        if split is None:
+            yield from self.loader
+            return
+        split.passes += 1
+        images, labels = split.images, split.labels
+        order = torch.randperm(len(labels)) if self.shuffle else None
+        for i in range(len(self)):
+            start, end = i * self.batch_size, min((i + 1) * self.batch_size, len(labels))
+            if order is None:
+                yield images[start:end].clone(), labels[start:end].clone()
+            else:
+                yield images[order[start:end]], labels[order[start:end]]
+
+
+def has_random_transform(dataset):
+    for leaf in dataset_leaves(dataset):
+        for t in flatten_transform(getattr(leaf, transform_attr(leaf), None)):
+            if type(t).__name__.startswith('Random') or type(t).__name__ == 'Lambda':
+                return True
+    return False
+
+
+def cached_loader(loader, name, max_mb):
+    """
+    A TensorSplitLoader over `loader` sharing the cached split of its key, or `loader` itself when the split
+    cannot be cached (random transform, batch sampler, sampler other than sequential / random permutation).
+    Reads nothing.
+    """
+    sampler = loader.sampler
+    permutation = isinstance(sampler, data.RandomSampler) and not sampler.replacement \
+        and len(sampler) == len(loader.dataset)
+    if loader.batch_size is None or not (type(sampler) is data.SequentialSampler or permutation) \
+            or has_random_transform(loader.dataset):
+        return loader
+    return TensorSplitLoader(loader, fingerprint([name, dataset_signature(loader.dataset)]), name, max_mb)
+
+
+def report():
+    for split in splits.values():
+        if split is not None:
+            print('[Eval cache] %s: %d samples, %.1f MB, built in %.2fs, %d passes'
+                  % (split.name, len(split.labels), split.size_mb(), split.build_time, split.passes))
@@ -0,0 +1,196 @@
+"""
+Pre-resized uint8 image shards for the ImageFolder / utils.imagenet.imagenet_dataset splits.
+
+Decoding and resizing full-resolution JPEGs dominates every pass over imagenette, imagenet50/100/200/1k and
+tinyimagenet200. build_image_shards.py decodes and resizes each image of a split once, in a process pool, into
+<shard_dir>/<dataset folder>/<split folder>/ (see shard_path):
+    shard_00000.npy, ...   uint8 (n, size, size, 3), `shard_size` images per shard
+    labels.npy             int64 labels in source order
+    header.json            format, version, size, resize mode, number of images, shard size, source directory
+ShardedImageDataset reads them back through memory maps and hands every sample to the unchanged transform as
+an RGB PIL image, so the loaders only swap the dataset (image_folder / open_shards).
+
+Resize modes:
+    short  resize the short side to `size` (transforms.Resize(size)), then center crop size x size:
+           Resize(256) + CenterCrop(224) gives the same pixels on `short 256` shards as on the source.
+    fixed  resize to size x size (transforms.Resize((size, size))): utils.imagenet with 256,
+           defense_dataloader / confusion training with 64.
+Random crops see the center crop only on `short` shards. One shard_dir holds one geometry: keep e.g.
+data/shards/short256 and data/shards/fixed64 side by side and point the loaders at the one their transform expects.
+"""
+import os
+import json
+import time
+import shutil
+import multiprocessing
+import numpy as np
+from PIL import Image
+from torch.utils import data
+from torchvision import datasets
+import torchvision.transforms.functional as Ft
+from utils.tools import LabeledDataset
+
+FORMAT = 'uint8-shards'
+VERSION = 1
+HEADER_NAME = 'header.json'
+SHARD_NAME = 'shard_%05d.npy'
+
+
+def shard_path(shard_dir, source_dir):
+    """The shards of `source_dir` in `shard_dir`: <shard_dir>/<parent folder>/<folder>, e.g. .../imagenette2/train."""
+    source_dir = os.path.abspath(source_dir)
+    return os.path.join(shard_dir, os.path.basename(os.path.dirname(source_dir)), os.path.basename(source_dir))
+
+
+def read_header(path):
+    """The header of the shards in `path`, or None if there are none."""
+    try:
+        with open(os.path.join(path, HEADER_NAME)) as f:
+            header = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return header if header.get('format') == FORMAT else None
+
+
+def image_sources(dataset):
+    """
+    (source directory, image paths, labels) of every leaf of `dataset` that can be sharded: ImageFolder and
+    clean, unshifted imagenet_dataset, also inside ConcatDataset, Subset (the shards cover the whole source,
+    the subset is applied on top of them) and wrappers keeping the real dataset in `.data`.
+    """
+    if isinstance(dataset, data.ConcatDataset):
+        return [source for part in dataset.datasets for source in image_sources(part)]
+    if isinstance(dataset, data.Subset):
+        return image_sources(dataset.dataset)
+    if isinstance(dataset, datasets.ImageFolder):
+        return [(dataset.root, [path for path, _ in dataset.samples], [label for _, label in dataset.samples])]
+    if hasattr(dataset, 'img_id_to_path') and hasattr(dataset, 'img_labels'):
+        if dataset.shift or any(dataset.is_poison):
+            return []
+        return [(dataset.directory, list(dataset.img_id_to_path), dataset.img_labels.tolist())]
+    if isinstance(getattr(dataset, 'data', None), data.Dataset):
+        return image_sources(dataset.data)
+    return []
+
+
+def load_resized(path, size, resize='short'):
+    """One image as a (size, size, 3) uint8 array, resized the way the shards store it."""
+    img = Image.open(path).convert('RGB')
+    if resize == 'short':
+        img = Ft.center_crop(Ft.resize(img, size), [size, size])
+    elif resize == 'fixed':
+        img = Ft.resize(img, [size, size])
+    else:
+        raise ValueError('Unknown resize mode %s' % resize)
+    return np.asarray(img, dtype=np.uint8)
+
+
+def build_shard(job):
+    """Pool worker: decode, resize and save one shard. Returns (number of images, CPU seconds spent)."""
+    path, paths, size, resize = job
+    start = time.process_time()
+    images = np.empty((len(paths), size, size, 3), dtype=np.uint8)
+    for i, image_path in enumerate(paths):
+        images[i] = load_resized(image_path, size, resize)
+    np.save(path, images)
+    return len(paths), time.process_time() - start
+
+
+def build_shards(source_dir, paths, labels, path, size=256, resize='short', shard_size=1024, num_workers=None):
+    """
+    Decode and resize `paths` once into shards under `path`, `num_workers` processes writing one shard at a
+    time each. The shards are written to a temporary directory renamed into place, replacing older shards.
+    Returns the throughput: images, wall seconds, images/s, and images/s per core (images over the CPU time
+    summed over the workers, i.e. what one core sustains; images/s divided by it is the parallel speedup).
+    """
+    num_workers = num_workers or os.cpu_count()
+    path = path.rstrip(os.sep)
+    tmp_dir = path + f'.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    jobs = [(os.path.join(tmp_dir, SHARD_NAME % i), paths[start:start + shard_size], size, resize)
+            for i, start in enumerate(range(0, len(paths), shard_size))]
+
+    start = time.perf_counter()
+    cpu_time = 0.
+    with multiprocessing.Pool(num_workers) as pool:
+        for done, (count, seconds) in enumerate(pool.imap_unordered(build_shard, jobs), 1):
+            cpu_time += seconds
+            if done % 10 == 0 or done == len(jobs):
+                print('[Shards] %s: %d / %d shards' % (source_dir, done, len(jobs)))
+    wall_time = time.perf_counter() - start
+
+    np.save(os.path.join(tmp_dir, 'labels.npy'), np.asarray(labels, dtype=np.int64))
+    header = {'format': FORMAT, 'version': VERSION, 'size': size, 'resize': resize, 'num_images': len(paths),
+              'shard_size': shard_size, 'num_shards': len(jobs), 'source': os.path.abspath(source_dir)}
+    with open(os.path.join(tmp_dir, HEADER_NAME), 'w') as f:
+        json.dump(header, f, indent=1)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    os.rename(tmp_dir, path)
+
+    return {'images': len(paths), 'workers': num_workers, 'wall_s': wall_time, 'cpu_s': cpu_time,
+            'images_per_s': len(paths) / max(wall_time, 1e-9),
+            'images_per_s_per_core': len(paths) / max(cpu_time, 1e-9)}
+
+
+class ShardedImageDataset(LabeledDataset, data.Dataset):
+    """
+    The images of a split from its shards. Shards are memory-mapped on first use in every process (the maps
+    are not pickled into DataLoader workers), and every image is copied out of its map into an RGB PIL image
+    before `transform`.
+    """
+
+    def __init__(self, path, transform=None):
+        self.header = read_header(path)
+        if self.header is None:
+            raise FileNotFoundError('No image shards under %s' % path)
+        self.root = path
+        self.transform = transform
+        self.targets = np.load(os.path.join(path, 'labels.npy'))
+        self.shard_size = self.header['shard_size']
+        self.shards = None
+
+    def __len__(self):
+        return self.header['num_images']
+
+    def labels(self):
+        return self.targets
+
+    def shard(self, i):
+        if self.shards is None:
+            self.shards = [None] * self.header['num_shards']
+        if self.shards[i] is None:
+            self.shards[i] = np.load(os.path.join(self.root, SHARD_NAME % i), mmap_mode='r')
+        return self.shards[i]
+
+    def __getitem__(self, index):
+        index = int(index)
+        shard, offset = divmod(index, self.shard_size)
+        img = Image.fromarray(np.array(self.shard(shard)[offset]))
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, int(self.targets[index])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+
+def open_shards(shard_dir, source_dir, transform=None):
+    """ShardedImageDataset over the shards of `source_dir`, or None if shard_dir is None or they are not built."""
+    if shard_dir is None:
+        return None
+    path = shard_path(shard_dir, source_dir)
+    if read_header(path) is None:
+        print('[Shards] No shards of %s under %s, reading the source images' % (source_dir, path))
+        return None
+    return ShardedImageDataset(path, transform)
+
+
+def image_folder(root, transform=None, shard_dir=None):
+    """datasets.ImageFolder(root, transform), read from its shards in `shard_dir` when they are built."""
+    dataset = open_shards(shard_dir, root, transform)
+    return dataset if dataset is not None else datasets.ImageFolder(root, transform=transform)
@@ -9,6 +9,7 @@ from torch.utils.data import Dataset
 import torchvision.transforms as transforms
 from torchvision.utils import save_image
 import config
+from utils.tools import LabeledDataset
 
 
 
@@ -112,7 +113,7 @@ def assign_img_identifier(directory, classes):
 
 
 
-class imagenet_dataset(Dataset):
+class imagenet_dataset(LabeledDataset, Dataset):
 
     def __init__(self, directory, shift=False, data_transform=None,
                  poison_directory=None, poison_indices=None,
@@ -144,6 +145,7 @@ class imagenet_dataset(Dataset):
 
         self.poison_directory = poison_directory
         self.directory = directory
+        self.label_file = label_file
         self.target_class = target_class
         if self.target_class is not None:
             self.target_class = torch.tensor(self.target_class).long()
@@ -164,6 +166,9 @@ class imagenet_dataset(Dataset):
     def __len__(self):
         return self.num_imgs
 
+    def labels(self):
+        return self.img_labels.numpy()
+
     def __getitem__(self, idx):
 
         idx = int(idx)
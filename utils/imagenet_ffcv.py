@@ -3,9 +3,11 @@ import numpy as np
 
 import os
 import os.path
+import json
 from typing import Any, Callable, cast, Dict, List, Optional, Tuple, Union
 from PIL import Image
 from torch.utils.data import Dataset
+from torch.utils import data
 import torchvision.transforms as transforms
 from torchvision.utils import save_image
 
@@ -16,11 +18,14 @@ from ffcv.fields import RGBImageField, IntField
 from ffcv.pipeline.operation import Operation
 from ffcv.loader import Loader, OrderOption
 from ffcv.transforms import ToTensor, ToDevice, Squeeze, NormalizeImage, \
-    RandomHorizontalFlip, ToTorchImage
+    RandomHorizontalFlip, ToTorchImage, RandomTranslate, Convert
 from ffcv.fields.rgb_image import CenterCropRGBImageDecoder, \
     RandomResizedCropRGBImageDecoder, SimpleRGBImageDecoder
 from ffcv.fields.basics import IntDecoder
 
+from utils.activation_cache import dataset_signature, fingerprint
+from utils.tools import flatten_transform, dataset_leaves, transform_attr
+
 
 root_dir = './data/imagenet/' #'/shadowdata/xiangyu/imagenet_256/'
 test_set_labels = os.path.join(root_dir, 'ILSVRC2012_validation_ground_truth.txt')
@@ -206,4 +211,155 @@ def get_ffcv_loader(dataset, nick_name, batch_size = 128,
     loader = Loader(write_path, batch_size=batch_size, num_workers=num_workers,
                     order=OrderOption.RANDOM, pipelines=pipelines)"""
 
-    return loader
\ No newline at end of file
+    return loader
+
+
+
+# CPU-only FFCV backend for the defense / cleanser / test loaders (other_defenses_tool_box.tools.generate_dataloader
+# and utils.tools.unpack_poisoned_train_set with backend='ffcv').
+#
+# The deterministic part of the loader transform (Resize, CenterCrop, ToTensor, ...) runs once, when the dataset is
+# written to a .beton of raw uint8 images. The FFCV pipeline decodes them, applies the supported random
+# augmentations on the uint8 images (RandomHorizontalFlip, RandomCrop(size, padding) as RandomTranslate), scales
+# the batch to [0, 1] and applies the transform's Normalize, so batches match the torch DataLoader's and stay on the CPU.
+
+DETERMINISTIC_TRANSFORMS = (transforms.Resize, transforms.CenterCrop, transforms.Grayscale, transforms.Pad,
+                            transforms.ToTensor, transforms.ToPILImage)
+
+
+class ScaleNormalize(torch.nn.Module):
+    """uint8 (N, 3, H, W) batch -> its first `channels` channels in [0, 1] as float32, then normalized."""
+
+    def __init__(self, channels=3, mean=None, std=None):
+        super().__init__()
+        self.channels = channels
+        self.mean = None if mean is None else torch.as_tensor(mean, dtype=torch.float32).view(-1, 1, 1)
+        self.std = None if std is None else torch.as_tensor(std, dtype=torch.float32).view(-1, 1, 1)
+
+    def forward(self, x):
+        x = x[:, :self.channels].float().div_(255)
+        if self.mean is not None:
+            x = x.sub_(self.mean).div_(self.std)
+        return x
+
+
+def split_transform(transform):
+    """
+    (write transform, FFCV image operations, Normalize or None) of a torchvision transform. Normalize may only be
+    followed by CenterCrop, random augmentations (RandomCrop of the image size with constant padding) only by
+    ToTensor and Normalize; anything else raises ValueError (use the torch backend for it).
+    """
+    write_ops, image_ops, normalize = [], [], None
+    for t in flatten_transform(transform):
+        if isinstance(t, transforms.Normalize):
+            if normalize is not None:
+                raise ValueError('FFCV backend: more than one Normalize in %r' % transform)
+            normalize = t
+        elif isinstance(t, transforms.RandomHorizontalFlip):
+            image_ops.append(RandomHorizontalFlip(flip_prob=t.p))
+        elif isinstance(t, transforms.RandomCrop) and t.padding is not None and not t.pad_if_needed \
+                and t.padding_mode == 'constant':
+            padding = t.padding if isinstance(t.padding, int) else max(t.padding)
+            image_ops.append(RandomTranslate(padding=padding, fill=(t.fill,) * 3 if isinstance(t.fill, int) else t.fill))
+        elif isinstance(t, DETERMINISTIC_TRANSFORMS):
+            if normalize is not None and not isinstance(t, transforms.CenterCrop):
+                raise ValueError('FFCV backend: %r after Normalize is not supported' % t)
+            if image_ops and not isinstance(t, transforms.ToTensor):
+                raise ValueError('FFCV backend: %r after a random augmentation is not supported' % t)
+            write_ops.append(t)
+        else:
+            raise ValueError('FFCV backend: %r is not supported' % t)
+    return transforms.Compose(write_ops), image_ops, normalize
+
+
+def set_transform(dataset, transform):
+    for leaf in dataset_leaves(dataset):
+        setattr(leaf, transform_attr(leaf), transform)
+
+
+def source_mtimes(dataset):
+    mtimes = []
+    for leaf in dataset_leaves(dataset):
+        location = getattr(leaf, 'dir', None) or getattr(leaf, 'directory', None) or getattr(leaf, 'root', None)
+        mtimes.append(os.path.getmtime(location) if location is not None and os.path.exists(location) else None)
+    return mtimes
+
+
+class UInt8Images(Dataset):
+    """(uint8 (H, W, 3) image, int label) view of a dataset returning PIL images or [0, 1] float tensors."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        img, label = self.dataset[idx]
+        if isinstance(img, Image.Image):
+            img = np.asarray(img, dtype=np.uint8)
+            img = img[:, :, None] if img.ndim == 2 else img
+        else:
+            img = torch.as_tensor(img).mul(255).round_().clamp_(0, 255).byte().permute(1, 2, 0).numpy()
+        if img.shape[2] != 3:
+            img = np.repeat(img[:, :, :1], 3, axis=2)
+        return np.ascontiguousarray(img), int(label)
+
+
+def write_beton(dataset, path, num_workers=8, write_mode='raw'):
+    """
+    Write `dataset` (its samples as PIL images or [0, 1] tensors, all of one size) to the .beton `path` as uint8
+    RGB images and int labels, plus a `path`.json with the number of images and channels. Written under a
+    temporary name and renamed into place.
+    """
+    img = dataset[0][0]
+    channels = len(img.getbands()) if isinstance(img, Image.Image) else int(img.shape[0])
+    tmp_path = path + f'.{os.getpid()}.tmp'
+    writer = DatasetWriter(tmp_path, {
+        'image': RGBImageField(write_mode=write_mode),
+        'label': IntField(),
+    }, num_workers=num_workers)
+    writer.from_indexed_dataset(UInt8Images(dataset))
+    with open(path + '.json', 'w') as f:
+        json.dump({'num_images': len(dataset), 'channels': channels, 'write_mode': write_mode}, f)
+    os.replace(tmp_path, path)
+
+
+def get_cpu_ffcv_loader(dataset, cache_dir, name, batch_size=128, num_workers=8, shuffle=False, drop_last=False,
+                        write_mode='raw'):
+    """
+    FFCV Loader over `dataset` with its current transform, on the CPU. The dataset is written to
+    <cache_dir>/<name>_<key>.beton on first use, the key covering the dataset signature, the write transform and
+    the modification times of the source directories. The loader keeps `dataset` as `loader.dataset`.
+    """
+    leaves = dataset_leaves(dataset)
+    transform = getattr(leaves[0], transform_attr(leaves[0]))
+    write_transform, image_ops, normalize = split_transform(transform)
+
+    set_transform(dataset, write_transform)
+    try:
+        key = fingerprint([dataset_signature(dataset), repr(write_transform), source_mtimes(dataset)])[:16]
+        os.makedirs(cache_dir, exist_ok=True)
+        write_path = os.path.join(cache_dir, '%s_%s.beton' % (name, key))
+        if not os.path.exists(write_path):
+            print('[FFCV] Writing %s (%d samples)' % (write_path, len(dataset)))
+            write_beton(dataset, write_path, num_workers=num_workers, write_mode=write_mode)
+    finally:
+        set_transform(dataset, transform)
+    with open(write_path + '.json') as f:
+        channels = json.load(f)['channels']
+
+    image_pipeline: List[Operation] = [SimpleRGBImageDecoder()] + image_ops + [
+        ToTensor(),
+        ToTorchImage(channels_last=False),
+        ScaleNormalize(channels,
+                       None if normalize is None else normalize.mean,
+                       None if normalize is None else normalize.std),
+    ]
+    label_pipeline: List[Operation] = [IntDecoder(), ToTensor(), Squeeze(), Convert(torch.int64)]
+
+    loader = Loader(write_path, batch_size=batch_size, num_workers=max(1, min(num_workers, os.cpu_count())),
+                    order=OrderOption.RANDOM if shuffle else OrderOption.SEQUENTIAL, os_cache=True,
+                    drop_last=drop_last, pipelines={'image': image_pipeline, 'label': label_pipeline})
+    loader.dataset = dataset
+    return loader
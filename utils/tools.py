@@ -3,6 +3,11 @@ from torch import nn
 import  torch.nn.functional as F
 from torch.utils.data import Dataset
 import os
+import json
+import shutil
+import zlib
+import time
+import resource
 from PIL import Image
 from torchvision import transforms, datasets
 from torch.utils.data import DataLoader
@@ -13,7 +18,20 @@ import config
 from utils import supervisor
 from tqdm import tqdm
 
-class IMG_Dataset(Dataset):
+class LabeledDataset:
+    """
+    Mixin giving a dataset `labels()` (int64 numpy array, read from the label storage the dataset already holds,
+    never by decoding images) and `indices_by_class()`, for class-stratified sampling.
+    """
+
+    def labels(self):
+        raise NotImplementedError
+
+    def indices_by_class(self):
+        return indices_by_class(self)
+
+
+class IMG_Dataset(LabeledDataset, Dataset):
     def __init__(self, data_dir, label_path, transforms = None, num_classes = 10, shift = False, random_labels = False,
                  fixed_label = None):
         """
@@ -24,11 +42,13 @@ class IMG_Dataset(Dataset):
         """
         self.dir = data_dir
         self.img_set = None
-        if 'data' not in self.dir: # if new version
+        self.header = read_image_set_header(data_dir) # compact uint8 version, memory-mapped on first access
+        if self.header is None and 'data' not in self.dir: # if new version
             self.img_set = torch.load(data_dir)
+        self.label_path = label_path
         self.gt = torch.load(label_path)
         self.transforms = transforms
-        if 'data' not in self.dir: # if new version, remove ToTensor() from the transform list
+        if 'data' not in self.dir or self.header is not None: # if new version, remove ToTensor() from the transform list
             self.transforms = []
             for t in transforms.transforms:
                 if not isinstance(t, torchvision.transforms.ToTensor):
@@ -46,10 +66,33 @@ class IMG_Dataset(Dataset):
     def __len__(self):
         return len(self.gt)
 
+    def labels(self):
+        if self.random_labels:
+            raise ValueError('IMG_Dataset with random_labels has no fixed labels')
+        labels = torch.as_tensor(self.gt).long()
+        if self.shift:
+            labels = (labels + 1) % self.num_classes
+        if self.fixed_label is not None:
+            labels = torch.full_like(labels, int(self.fixed_label))
+        return labels.numpy()
+
+    def __getstate__(self):
+        # DataLoader workers map the compact image file themselves instead of receiving a pickled copy
+        state = self.__dict__.copy()
+        if self.header is not None:
+            state['img_set'] = None
+        return state
+
     def __getitem__(self, idx):
         idx = int(idx)
         
-        if self.img_set is not None: # if new version
+        if self.header is not None: # if compact uint8 version
+            if self.img_set is None:
+                self.img_set = np.load(os.path.join(self.dir, 'images.npy'), mmap_mode='r')
+            img = torch.from_numpy(np.array(self.img_set[idx])).float().div_(255)
+            if self.header['layout'] == 'NHWC':
+                img = img.permute(2, 0, 1)
+        elif self.img_set is not None: # if new version
             img = self.img_set[idx]
         else: # if old version
             img = Image.open(os.path.join(self.dir, '%d.png' % idx))
@@ -70,6 +113,61 @@ class IMG_Dataset(Dataset):
         return img, label
 
 
+def read_image_set_header(path):
+    """
+    The JSON header of a compact image set directory written by save_image_set, None for the legacy formats
+    (a torch-saved float tensor or a directory of PNGs).
+    """
+    header_path = os.path.join(path, 'header.json')
+    if not os.path.isfile(header_path):
+        return None
+    with open(header_path) as f:
+        return json.load(f)
+
+
+def save_image_set(img_set, path, labels=None, poison_indices=None, layout='NCHW', chunk_size=1024):
+    """
+    Write images ((N, C, H, W) float in [0, 1], a tensor or a sequence of (C, H, W) tensors) as a compact image
+    set directory at `path`: images.npy (uint8, NCHW or NHWC, read back through a shared memory map by
+    IMG_Dataset), labels.npy / poison_indices.npy sidecars and header.json.
+    Returns the largest rounding error of the uint8 conversion (in [0, 1] units).
+    """
+    if layout not in ['NCHW', 'NHWC']:
+        raise NotImplementedError('Image set layout %s is not supported' % layout)
+    num_samples = len(img_set)
+    shape = tuple(img_set[0].shape)
+    if layout == 'NHWC':
+        shape = shape[1:] + shape[:1]
+    tmp_path = path + '.tmp'
+    os.makedirs(tmp_path, exist_ok=True)
+    images = np.lib.format.open_memmap(os.path.join(tmp_path, 'images.npy'), mode='w+', dtype=np.uint8,
+                                       shape=(num_samples,) + shape)
+    max_error = 0.0
+    for start in range(0, num_samples, chunk_size):
+        chunk = img_set[start:start + chunk_size]
+        chunk = chunk.float() if torch.is_tensor(chunk) else torch.stack([torch.as_tensor(img).float() for img in chunk])
+        quantized = (chunk * 255).round_().clamp_(0, 255)
+        max_error = max(max_error, (quantized / 255 - chunk).abs().max().item())
+        if layout == 'NHWC':
+            quantized = quantized.permute(0, 2, 3, 1)
+        images[start:start + len(quantized)] = quantized.to(torch.uint8).numpy()
+    images.flush()
+    del images
+    if labels is not None:
+        np.save(os.path.join(tmp_path, 'labels.npy'), np.asarray(labels, dtype=np.int64))
+    if poison_indices is not None:
+        np.save(os.path.join(tmp_path, 'poison_indices.npy'), np.asarray(poison_indices, dtype=np.int64))
+    with open(os.path.join(tmp_path, 'header.json'), 'w') as f:
+        json.dump({'format': 'uint8-memmap', 'version': 1, 'layout': layout, 'shape': [num_samples] + list(shape),
+                   'dtype': 'uint8', 'scale': 255, 'max_rounding_error': max_error}, f, indent=1)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+    return max_error
+
+
 class EMBER_Dataset(Dataset):
     def __init__(self, x_path, y_path, normalizer = None, inverse=False):
         """
@@ -365,9 +463,118 @@ def save_dataset(dataset, path):
     print('[Generate Test Set] Save %s' % label_path)
 
 
-def unpack_poisoned_train_set(args, batch_size=128, shuffle=False, data_transform=None):
+def dataset_labels(dataset):
+    """
+    Labels of every sample of `dataset` as an int64 numpy array, read from the label storage the dataset
+    already holds so no image is decoded: its `labels()` (LabeledDataset), torchvision `targets` / `_samples`,
+    `img_labels` or a `labels` array. Subset, ConcatDataset and wrappers keeping the real dataset in `.data`
+    are resolved recursively. Datasets without a known label storage are iterated once and the result is kept
+    in a sidecar file next to their data (see label_sidecar_path).
+    """
+    if isinstance(dataset, torch.utils.data.Subset):
+        return dataset_labels(dataset.dataset)[np.asarray(dataset.indices, dtype=np.int64)]
+    if isinstance(dataset, torch.utils.data.ConcatDataset):
+        return np.concatenate([dataset_labels(d) for d in dataset.datasets])
+    if isinstance(dataset, LabeledDataset) and not getattr(dataset, 'random_labels', False):
+        return np.asarray(dataset.labels(), dtype=np.int64)
+    if isinstance(getattr(dataset, 'data', None), Dataset):
+        return dataset_labels(dataset.data)
+    if getattr(dataset, 'target_transform', None) is None:
+        for attr in ['targets', 'img_labels', 'labels']:
+            labels = getattr(dataset, attr, None)
+            if labels is not None and not callable(labels):
+                return np.asarray(labels, dtype=np.int64)
+        samples = getattr(dataset, '_samples', None)  # torchvision GTSRB: (path, label) pairs
+        if isinstance(samples, list) and samples and isinstance(samples[0], tuple):
+            return np.array([label for _, label in samples], dtype=np.int64)
+
+    sidecar = label_sidecar_path(dataset)
+    if sidecar is not None and os.path.exists(sidecar):
+        return np.load(sidecar)
+    labels = np.array([int(dataset[i][1]) for i in range(len(dataset))], dtype=np.int64)
+    if sidecar is not None:
+        try:
+            np.save(sidecar, labels)
+        except OSError:
+            pass
+    return labels
+
+
+def flatten_transform(transform):
+    if transform is None:
+        return []
+    if isinstance(transform, transforms.Compose):
+        return [t for inner in transform.transforms for t in flatten_transform(inner)]
+    return [transform]
+
+
+def dataset_leaves(dataset):
+    """The datasets holding samples and transforms under Subset / ConcatDataset / `.data` wrappers."""
+    if isinstance(dataset, torch.utils.data.Subset):
+        return dataset_leaves(dataset.dataset)
+    if isinstance(dataset, torch.utils.data.ConcatDataset):
+        return [leaf for part in dataset.datasets for leaf in dataset_leaves(part)]
+    if isinstance(getattr(dataset, 'data', None), Dataset):
+        return dataset_leaves(dataset.data)
+    return [dataset]
+
+
+def transform_attr(leaf):
+    """The attribute the dataset's __getitem__ reads its transform from."""
+    if hasattr(leaf, 'data_transform'):  # utils.imagenet.imagenet_dataset
+        return 'data_transform'
+    if hasattr(leaf, 'transforms') and not hasattr(leaf, 'transform'):  # utils.tools.IMG_Dataset
+        return 'transforms'
+    return 'transform'  # torchvision datasets, utils.image_shards.ShardedImageDataset
+
+
+def label_sidecar_path(dataset):
+    """
+    Where the labels of a dataset without label storage are cached: a file in its data directory named after
+    the dataset type, size and transforms (None when the dataset has no directory or is randomly labelled).
+    """
+    directory = getattr(dataset, 'dir', None) or getattr(dataset, 'root', None)
+    if not isinstance(directory, str) or not os.path.isdir(directory) or getattr(dataset, 'random_labels', False):
+        return None
+    transforms = repr(getattr(dataset, 'target_transform', None)) + repr(getattr(dataset, 'transform', None))
+    key = '%s_%d_%08x' % (type(dataset).__name__, len(dataset), zlib.crc32(transforms.encode()))
+    return os.path.join(directory, '.labels_%s.npy' % key)
+
+
+def indices_by_class(dataset):
+    """
+    {label: int64 array of the positions in `dataset` holding that label}, from dataset_labels (no image
+    is decoded). Positions index `dataset` itself, so for a Subset they are positions in the subset.
+    """
+    labels = dataset_labels(dataset)
+    order = np.argsort(labels, kind='stable')
+    classes, starts = np.unique(labels[order], return_index=True)
+    return {int(label): indices for label, indices in zip(classes, np.split(order, starts[1:]))}
+
+
+def loader_throughput(loader):
+    """
+    One pass over `loader`: (images, images/s, images/s per core), the last over the CPU time of this process
+    and its finished children (DataLoader workers are joined at the end of the pass).
+    """
+    who = (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+    before = [resource.getrusage(w) for w in who]
+    start = time.perf_counter()
+    images = 0
+    for batch in loader:
+        images += len(batch[0])
+    wall_time = time.perf_counter() - start
+    after = [resource.getrusage(w) for w in who]
+    cpu_time = sum(a.ru_utime + a.ru_stime - b.ru_utime - b.ru_stime for a, b in zip(after, before))
+    return images, images / max(wall_time, 1e-9), images / max(cpu_time, 1e-9)
+
+
+def unpack_poisoned_train_set(args, batch_size=128, shuffle=False, data_transform=None, backend=None):
     """
     Return with `poison_set_dir`, `poisoned_set_loader`, `poison_indices`, and `cover_indices` if available
+    `backend='ffcv'` loads the poisoned set through a CPU FFCV Loader over a .beton written once to
+    <poison_set_dir>/ffcv_cache (see utils.imagenet_ffcv.get_cpu_ffcv_loader; needs ffcv installed);
+    None falls back to config.loader_backend
     """
     if data_transform is None:
         data_transform_aug, data_transform, trigger_transform, normalizer, denormalizer = supervisor.get_transforms(args)
@@ -385,7 +592,15 @@ def unpack_poisoned_train_set(args, batch_size=128, shuffle=False, data_transfor
     poisoned_set = IMG_Dataset(data_dir=poisoned_set_img_dir,
                                 label_path=poisoned_set_label_path, transforms=data_transform)
 
-    poisoned_set_loader = torch.utils.data.DataLoader(poisoned_set, batch_size=batch_size, shuffle=shuffle, num_workers=4, pin_memory=True)
+    if backend is None:
+        backend = config.loader_backend
+    if backend == 'ffcv':
+        from utils import imagenet_ffcv
+        poisoned_set_loader = imagenet_ffcv.get_cpu_ffcv_loader(poisoned_set, os.path.join(poison_set_dir, 'ffcv_cache'),
+                                                                'poisoned_set', batch_size=batch_size, num_workers=4,
+                                                                shuffle=shuffle)
+    else:
+        poisoned_set_loader = torch.utils.data.DataLoader(poisoned_set, batch_size=batch_size, shuffle=shuffle, num_workers=4, pin_memory=True)
 
     poison_indices = torch.load(poison_indices_path)
     
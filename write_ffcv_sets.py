@@ -0,0 +1,67 @@
+"""
+Write the FFCV .beton files of a poisoned set and of the clean_set splits ahead of the defense runs, and compare
+the CPU throughput of the torch DataLoader and the FFCV Loader (images/s and images/s per core).
+The loaders write the same files on first use with `-loader_backend ffcv` (other_defense.py) or
+backend='ffcv' (generate_dataloader / unpack_poisoned_train_set); see utils.imagenet_ffcv.get_cpu_ffcv_loader.
+
+    python write_ffcv_sets.py -dataset cifar10 -poison_type badnet -poison_rate 0.003
+    python write_ffcv_sets.py -dataset gtsrb -poison_type blend -poison_rate 0.003 -split test -bench
+"""
+import argparse
+
+import config
+from other_defenses_tool_box import tools
+from utils import supervisor, default_args
+from utils.tools import unpack_poisoned_train_set, loader_throughput
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-dataset', type=str, required=False,
+                    default=default_args.parser_default['dataset'],
+                    choices=default_args.parser_choices['dataset'])
+parser.add_argument('-poison_type', type=str, required=False,
+                    choices=default_args.parser_choices['poison_type'],
+                    default=default_args.parser_default['poison_type'])
+parser.add_argument('-poison_rate', type=float, required=False,
+                    choices=default_args.parser_choices['poison_rate'],
+                    default=default_args.parser_default['poison_rate'])
+parser.add_argument('-cover_rate', type=float, required=False,
+                    choices=default_args.parser_choices['cover_rate'],
+                    default=default_args.parser_default['cover_rate'])
+parser.add_argument('-alpha', type=float, required=False,
+                    default=default_args.parser_default['alpha'])
+parser.add_argument('-trigger', type=str, required=False, default=None)
+parser.add_argument('-no_normalize', default=False, action='store_true')
+parser.add_argument('-split', type=str, nargs='*', required=False, default=['val', 'test'],
+                    help='clean splits of generate_dataloader to write')
+parser.add_argument('-no_poisoned_set', default=False, action='store_true')
+parser.add_argument('-batch_size', type=int, required=False, default=128)
+parser.add_argument('-bench', default=False, action='store_true',
+                    help='one pass through the torch and the FFCV loader of every set')
+
+
+def report(name, torch_loader, ffcv_loader, bench):
+    print('[FFCV] %s: %d samples' % (name, len(ffcv_loader.dataset)))
+    if not bench:
+        return
+    for backend, loader in [('torch', torch_loader), ('ffcv', ffcv_loader)]:
+        images, images_per_s, images_per_s_per_core = loader_throughput(loader)
+        print('  %-5s %8d images  %9.1f images/s  %8.1f images/s per core'
+              % (backend, images, images_per_s, images_per_s_per_core))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.trigger is None:
+        args.trigger = config.trigger_default[args.dataset][args.poison_type]
+    data_transform_aug, data_transform, trigger_transform, normalizer, denormalizer = supervisor.get_transforms(args)
+
+    if not args.no_poisoned_set:
+        loaders = [unpack_poisoned_train_set(args, batch_size=args.batch_size, data_transform=data_transform,
+                                             backend=backend)[1] for backend in ['torch', 'ffcv']]
+        report('poisoned set %s' % supervisor.get_poison_set_dir(args), *loaders, args.bench)
+    for split in args.split:
+        loaders = [tools.generate_dataloader(dataset=args.dataset, dataset_path=config.data_dir,
+                                             batch_size=args.batch_size, split=split, shuffle=False,
+                                             data_transform=data_transform, backend=backend)
+                   for backend in ['torch', 'ffcv']]
+        report('%s %s split' % (args.dataset, split), *loaders, args.bench)